@@ -0,0 +1 @@
+default_app_config = 'opro_payments.apps.OproPaymentsConfig'
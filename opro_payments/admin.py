@@ -1,8 +1,37 @@
 # coding: utf-8
 
-from django.contrib import admin
-from .admin_forms import UpsaleForm, UpsaleLinkForm, ObjectEnrollmentForm
-from .models import Upsale, UpsaleLink, ObjectEnrollment, OuterPayment
+from django.conf.urls import url
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.utils.functional import cached_property
+from django.utils.translation import ugettext_lazy as _
+from .admin_forms import UpsaleForm, UpsaleLinkForm, ObjectEnrollmentForm, BulkGrantUpsaleForm
+from .models import Upsale, UpsaleLink, ObjectEnrollment, OuterPayment, PaymentTask, PaymentOrder, PaymentOrderLine
+from .utils import get_users_by_emails
+
+
+class ApproximateCountPaginator(Paginator):
+    """
+    Пагинатор для больших таблиц: для выборки без фильтров количество строк берется из статистики
+    postgresql вместо COUNT(*). Небольшие таблицы и отфильтрованные выборки считаются точно
+    """
+    EXACT_COUNT_LIMIT = 10000
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where and connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [query.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] > self.EXACT_COUNT_LIMIT:
+                return int(row[0])
+        return super(ApproximateCountPaginator, self).count
 
 
 @admin.register(Upsale)
@@ -13,6 +42,24 @@ class UpsaleAdmin(admin.ModelAdmin):
 @admin.register(UpsaleLink)
 class UpsaleLinkAdmin(admin.ModelAdmin):
     form = UpsaleLinkForm
+    readonly_fields = ('promocodes_left', )
+    actions = ['grant_to_users']
+
+    def promocodes_left(self, obj):
+        return obj.get_promocodes_left() if obj.pk else 0
+    promocodes_left.short_description = _(u'Осталось промокодов')
+
+    def grant_to_users(self, request, queryset):
+        """
+        действие списка апсейлов: переход к форме массовой записи на выбранный апсейл, список
+        пользователей (или csv-файл с email) вводится на ней
+        """
+        if queryset.count() != 1:
+            self.message_user(request, _(u'Выберите один апсейл'), level=messages.ERROR)
+            return None
+        return redirect('%s?upsale_link=%s' % (reverse('admin:opro_payments_objectenrollment_bulk_grant'),
+                                               queryset.get().id))
+    grant_to_users.short_description = _(u'Записать пользователей на апсейл')
 
 
 @admin.register(ObjectEnrollment)
@@ -27,7 +74,74 @@ class ObjectEnrollmentAdmin(admin.ModelAdmin):
             field.queryset = field.queryset.filter(is_active=True)
         return field
 
+    def get_urls(self):
+        urls = [
+            url(r'^bulk-grant/$', self.admin_site.admin_view(self.bulk_grant_view),
+                name='opro_payments_objectenrollment_bulk_grant'),
+        ]
+        return urls + super(ObjectEnrollmentAdmin, self).get_urls()
+
+    def bulk_grant_view(self, request):
+        """
+        массовая запись пользователей по списку email на апсейл
+        """
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        form = BulkGrantUpsaleForm(request.POST or None, request.FILES or None,
+                                   initial={'upsale_link': request.GET.get('upsale_link')})
+        if form.is_valid():
+            data = form.cleaned_data
+            users, not_found = get_users_by_emails(data['email_list'])
+            created, skipped = ObjectEnrollment.objects.grant(
+                data['upsale_link'], users,
+                enrollment_type=data['enrollment_type'],
+                payment_type=data['payment_type'],
+                payment_descriptions=data['payment_descriptions'] or None,
+            )
+            self.message_user(request, _(u'Создано записей: %(created)s, уже были записаны: %(skipped)s') % {
+                'created': created, 'skipped': skipped})
+            if not_found:
+                self.message_user(request, _(u'Не найдены пользователи: %s') % u', '.join(not_found),
+                                  level=messages.WARNING)
+            return redirect('admin:opro_payments_objectenrollment_changelist')
+        context = dict(
+            self.admin_site.each_context(request),
+            title=_(u'Массовая запись на апсейл'),
+            opts=self.model._meta,
+            form=form,
+        )
+        return TemplateResponse(request, 'admin/opro_payments/objectenrollment/bulk_grant.html', context)
+
 
 @admin.register(OuterPayment)
 class OuterPaymentAdmin(admin.ModelAdmin):
-    list_display = ('id', 'created_at', )
+    list_display = ('id', 'order_id', 'created_at', 'status', 'attempts', )
+    list_filter = ('status', )
+    search_fields = ('order_id', )
+    paginator = ApproximateCountPaginator
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        # тело запроса не выводится в списке, на странице редактирования оно подгрузится отдельно
+        return super(OuterPaymentAdmin, self).get_queryset(request).defer('data')
+
+
+@admin.register(PaymentTask)
+class PaymentTaskAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'status', 'attempts', 'next_attempt_at', 'created_at', )
+    list_filter = ('status', 'kind', )
+
+
+class PaymentOrderLineInline(admin.TabularInline):
+    model = PaymentOrderLine
+    raw_id_fields = ('upsale_link', )
+    extra = 0
+
+
+@admin.register(PaymentOrder)
+class PaymentOrderAdmin(admin.ModelAdmin):
+    list_display = ('id', 'payment', 'user', 'content_type', 'object_id', 'mode', 'is_paid', 'created_at', )
+    list_filter = ('is_paid', 'content_type', )
+    search_fields = ('payment__order_number', 'user__username', 'user__email', )
+    raw_id_fields = ('payment', 'user', 'gift_receiver', )
+    inlines = [PaymentOrderLineInline]
@@ -6,6 +6,7 @@ from django.core.validators import validate_email
 from django.utils.translation import ugettext_lazy as _, ungettext_lazy
 import autocomplete_light
 from .models import Upsale, UpsaleLink, ObjectEnrollment
+from .utils import read_emails
 
 
 class UpsaleFormCheckerMixin(object):
@@ -172,19 +173,21 @@ class UpsaleLinkForm(UpsaleFormCheckerMixin, forms.ModelForm):
         js = ('dependant_autocomplete.js',)
 
 
+def _check_enrollment_payment_type(enrollment_type, payment_type):
+    if enrollment_type is not None and payment_type is not None:
+        paid_enrollment = enrollment_type == ObjectEnrollment.ENROLLMENT_TYPE_CHOICES.paid
+        paid = payment_type != ObjectEnrollment.PAYMENT_TYPE_CHOICES.none
+        if paid_enrollment and not paid or paid and not paid_enrollment:
+            raise forms.ValidationError(_(u'Тип записи несовместим со способом платежа'))
+
+
 class ObjectEnrollmentForm(forms.ModelForm):
     is_active = forms.ChoiceField(label=ObjectEnrollment._meta.get_field('is_active').verbose_name,
                                   choices=((False, 'Inactive'), (True, 'Active')), required=False)
 
     def clean(self):
         data = super(ObjectEnrollmentForm, self).clean()
-        enrollment_type = data.get('enrollment_type')
-        payment_type = data.get('payment_type')
-        if enrollment_type is not None and payment_type is not None:
-            paid_enrollment = enrollment_type == ObjectEnrollment.ENROLLMENT_TYPE_CHOICES.paid
-            paid = payment_type != ObjectEnrollment.PAYMENT_TYPE_CHOICES.none
-            if paid_enrollment and not paid or paid and not paid_enrollment:
-                raise forms.ValidationError(_(u'Тип записи несовместим со способом платежа'))
+        _check_enrollment_payment_type(data.get('enrollment_type'), data.get('payment_type'))
         return data
 
     class Meta:
@@ -193,3 +196,31 @@ class ObjectEnrollmentForm(forms.ModelForm):
         widgets = {
             'user': autocomplete_light.ChoiceWidget(autocomplete='UserAutocomplete'),
         }
+
+
+class BulkGrantUpsaleForm(forms.Form):
+    upsale_link = forms.ModelChoiceField(queryset=UpsaleLink.objects.filter(is_active=True).select_related('upsale'),
+                                         label=_(u'Апсейл'))
+    emails = forms.CharField(widget=forms.Textarea, required=False, label=_(u'Список email'),
+                             help_text=_(u'По одному адресу в строке'))
+    emails_file = forms.FileField(required=False, label=_(u'Файл со списком email'),
+                                  help_text=_(u'csv-файл, email в первой колонке'))
+    enrollment_type = forms.TypedChoiceField(choices=ObjectEnrollment.ENROLLMENT_TYPE_CHOICES.choices, coerce=int,
+                                             initial=ObjectEnrollment.ENROLLMENT_TYPE_CHOICES.free,
+                                             label=ObjectEnrollment._meta.get_field('enrollment_type').verbose_name)
+    payment_type = forms.TypedChoiceField(choices=ObjectEnrollment.PAYMENT_TYPE_CHOICES.choices, coerce=int,
+                                          initial=ObjectEnrollment.PAYMENT_TYPE_CHOICES.none,
+                                          label=ObjectEnrollment._meta.get_field('payment_type').verbose_name)
+    payment_descriptions = forms.CharField(widget=forms.Textarea, required=False,
+                                           label=ObjectEnrollment._meta.get_field('payment_descriptions').verbose_name)
+
+    def clean(self):
+        data = super(BulkGrantUpsaleForm, self).clean()
+        emails = read_emails((data.get('emails') or '').splitlines())
+        if data.get('emails_file'):
+            emails = read_emails(list(data['emails_file']) + emails)
+        if not emails:
+            raise forms.ValidationError(_(u'Не указано ни одного email'))
+        data['email_list'] = emails
+        _check_enrollment_payment_type(data.get('enrollment_type'), data.get('payment_type'))
+        return data
@@ -0,0 +1,11 @@
+# coding: utf-8
+
+from django.apps import AppConfig
+
+
+class OproPaymentsConfig(AppConfig):
+    name = 'opro_payments'
+
+    def ready(self):
+        # обработчики сигналов инвалидации кэшей
+        from . import signals
@@ -4,17 +4,18 @@ from django.contrib.contenttypes.models import ContentType
 import autocomplete_light
 from plp.models import CourseSession
 from plp_edmodule.models import EducationalModule
+from .db_router import ReplicaAutocompleteMixin
 from .models import Upsale
 
 
-class StaffAutocomplete(autocomplete_light.AutocompleteModelBase):
+class StaffAutocomplete(ReplicaAutocompleteMixin, autocomplete_light.AutocompleteModelBase):
     def choices_for_request(self):
         if self.request.user.is_staff:
             return super(StaffAutocomplete, self).choices_for_request()
         return []
 
 
-class UpsaleLinkMultisearch(autocomplete_light.AutocompleteGenericBase):
+class UpsaleLinkMultisearch(ReplicaAutocompleteMixin, autocomplete_light.AutocompleteGenericBase):
     """
     Подсказки по связанным объектам UpsaleLink.
     При расширении content_type обновлять choices и search_fields здесь
@@ -0,0 +1,65 @@
+# coding: utf-8
+
+import time
+from functools import partial
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+CACHE_TIMEOUT = getattr(settings, 'OPRO_PAYMENTS_CACHE_TIMEOUT', 60 * 60)
+
+
+def _version_key(namespace):
+    return 'opro_payments:%s:version' % namespace
+
+
+def get_version(namespace):
+    """
+    текущая версия данных пространства имен namespace, входит в ключи всех его записей кэша
+    """
+    version = cache.get(_version_key(namespace))
+    if version is None:
+        # начальная версия не повторяет ранее использованные, если ключ версии был вытеснен из кэша
+        cache.add(_version_key(namespace), int(time.time() * 1000), None)
+        version = cache.get(_version_key(namespace), 0)
+    return version
+
+
+def bump_version(namespace):
+    """
+    инвалидация всех записей кэша пространства имен namespace
+    """
+    try:
+        cache.incr(_version_key(namespace))
+    except ValueError:
+        get_version(namespace)
+
+
+def bump_version_on_commit(namespace):
+    """
+    инвалидация пространства имен namespace после фиксации текущей транзакции. Если сбросить кэш
+    до фиксации, параллельный запрос может прочитать еще не зафиксированное состояние и сохранить
+    его под новой версией. Вне транзакции версия увеличивается сразу
+    """
+    on_commit = getattr(transaction, 'on_commit', None)
+    if on_commit is None:
+        # django без transaction.on_commit
+        bump_version(namespace)
+    else:
+        on_commit(partial(bump_version, namespace))
+
+
+def make_key(namespace, *parts):
+    return 'opro_payments:%s:%s:%s' % (namespace, get_version(namespace), ':'.join(map(unicode, parts)))
+
+
+def get_or_set(namespace, parts, func, timeout=CACHE_TIMEOUT):
+    """
+    значение из кэша по ключу (namespace, *parts), при отсутствии вычисляется func() и кэшируется
+    """
+    key = make_key(namespace, *parts)
+    value = cache.get(key)
+    if value is None:
+        value = func()
+        cache.set(key, value, timeout)
+    return value
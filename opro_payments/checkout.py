@@ -0,0 +1,149 @@
+# coding: utf-8
+
+from django.shortcuts import get_object_or_404
+from django.utils.functional import cached_property
+from plp.models import CourseSession
+from plp_edmodule.models import EducationalModule
+from .entitlements import get_paid_upsale_ids, has_paid_session, has_paid_module
+from .models import UpsaleLink
+from .utils import get_merchant_receipt, get_edmodule_price
+
+
+class CheckoutQuoteError(Exception):
+    pass
+
+
+class CheckoutQuote(object):
+    """
+    Расчет заказа на странице оплаты сессии или модуля: цена объекта, апсейлы, скидка по промокоду,
+    товары и чек для яндекс-кассы. Каждое значение вычисляется при первом обращении и
+    запоминается, поэтому в рамках запроса запросы к бд не повторяются
+    """
+    def __init__(self, session_id=None, module_id=None, upsale_link_ids=(), only_first_course=False, user=None):
+        """
+        :param user: пользователь, для которого учитываются уже оплаченные объект и апсейлы,
+            None - если пользователь неизвестен (оплата с лэндинга)
+        """
+        self.session_id = session_id
+        self.module_id = module_id
+        self.upsale_link_ids = upsale_link_ids
+        self.only_first_course = only_first_course
+        self.user = user
+        self.new_price = None
+
+    @classmethod
+    def from_request(cls, request, user=None):
+        return cls(
+            session_id=request.GET.get('course_session_id', ''),
+            module_id=request.GET.get('edmodule_id', ''),
+            upsale_link_ids=[i for i in request.GET.getlist('upsale_link_ids') if i.isdigit()],
+            only_first_course=bool(request.GET.get('only_first_course', False)),
+            user=user,
+        )
+
+    def apply_promo_price(self, new_price):
+        """
+        цена объекта со скидкой по промокоду, промокод может сделать объект бесплатным (Decimal('0'))
+        """
+        if new_price is not None:
+            self.new_price = new_price
+            for attr in ('obj_price', 'products', 'total_price'):
+                self.__dict__.pop(attr, None)
+
+    @cached_property
+    def obj(self):
+        if self.session_id:
+            return get_object_or_404(CourseSession.objects.select_related('course'), id=self.session_id)
+        return get_object_or_404(EducationalModule, id=self.module_id)
+
+    @cached_property
+    def verified_enrollment(self):
+        return self.obj.get_verified_mode_enrollment_type()
+
+    @cached_property
+    def upsales(self):
+        return list(UpsaleLink.objects.for_object(self.obj).filter(id__in=self.upsale_link_ids, is_active=True))
+
+    @cached_property
+    def paid_upsales(self):
+        if not self.user or not self.upsales:
+            return []
+        paid = get_paid_upsale_ids(self.user, [i.id for i in self.upsales])
+        return [i for i in self.upsales if i.id in paid]
+
+    @cached_property
+    def upsales_to_buy(self):
+        return [i for i in self.upsales if i not in self.paid_upsales]
+
+    @cached_property
+    def obj_is_paid(self):
+        if not self.user:
+            return False
+        if self.session_id:
+            return has_paid_session(self.user, self.obj.id, self.verified_enrollment.mode)
+        return has_paid_module(self.user, self.obj.id, full_paid=not self.only_first_course)
+
+    @cached_property
+    def first_session_to_buy(self):
+        """
+        (сессия, цена) первого курса модуля, который нужно оплатить, или (None, None)
+        """
+        if self.session_id or not self.only_first_course:
+            return None, None
+        return self.obj.get_first_session_to_buy(self.user) or (None, None)
+
+    @property
+    def first_session(self):
+        return self.first_session_to_buy[0]
+
+    @property
+    def first_session_id(self):
+        return self.first_session and self.first_session.id
+
+    @cached_property
+    def obj_price(self):
+        if self.session_id:
+            price = self.verified_enrollment.price
+        elif self.only_first_course:
+            price = self.first_session_to_buy[1]
+            if self.first_session is None:
+                if not self.obj_is_paid:
+                    raise CheckoutQuoteError(u'No course to buy for education module with id=%s' % self.obj.id)
+                price = 0
+        else:
+            price = get_edmodule_price(self.obj)
+        return price if self.new_price is None else self.new_price
+
+    @cached_property
+    def obj_title(self):
+        if self.session_id:
+            return self.obj.course.title
+        if self.only_first_course:
+            return self.first_session and self.first_session.course.title
+        return self.obj.title
+
+    @cached_property
+    def products(self):
+        products = []
+        if not self.obj_is_paid:
+            products.append({
+                'title': self.obj_title,
+                'price': self.obj_price
+            })
+        for i in self.upsales_to_buy:
+            products.append({
+                'title': i.upsale.title,
+                'price': i.get_payment_price()
+            })
+        return products
+
+    @cached_property
+    def upsales_price(self):
+        return sum(i.get_payment_price() for i in self.upsales_to_buy)
+
+    @cached_property
+    def total_price(self):
+        return (0 if self.obj_is_paid else float(self.obj_price)) + self.upsales_price
+
+    def merchant_receipt(self, contact):
+        return get_merchant_receipt(contact, self.products)
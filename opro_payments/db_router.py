@@ -0,0 +1,107 @@
+# coding: utf-8
+
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+# алиас реплики в DATABASES, None - чтение из основной бд
+REPLICA_DB = getattr(settings, 'OPRO_PAYMENTS_REPLICA_DB', None)
+# сколько секунд после записи данных пользователя его запросы читают из основной бд
+# (должно превышать отставание реплики)
+PIN_TIMEOUT = getattr(settings, 'OPRO_PAYMENTS_REPLICA_PIN_TIMEOUT', 60)
+
+_state = threading.local()
+
+
+class ReplicaRouter(object):
+    """
+    Роутер бд: внутри replica_reads (view с декоратором read_from_replica) чтение идет из реплики
+    OPRO_PAYMENTS_REPLICA_DB, все остальные запросы - в основную бд.
+    Подключается настройкой DATABASE_ROUTERS = ['opro_payments.db_router.ReplicaRouter']
+    """
+    def db_for_read(self, model, **hints):
+        if REPLICA_DB and getattr(_state, 'replica', False):
+            return REPLICA_DB
+        return None
+
+    def db_for_write(self, model, **hints):
+        # без явного алиаса django пишет в бд, из которой объект был прочитан, то есть в реплику
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # в реплике те же данные, что и в основной бд
+        return True
+
+    def allow_migrate(self, db, app_label, model=None, **hints):
+        if REPLICA_DB and db == REPLICA_DB:
+            return False
+        return None
+
+
+@contextmanager
+def replica_reads():
+    previous = getattr(_state, 'replica', False)
+    _state.replica = True
+    try:
+        yield
+    finally:
+        _state.replica = previous
+
+
+def _pin_key(user_id):
+    return 'opro_payments:db_pin:%s' % user_id
+
+
+def pin_to_primary(*user_ids):
+    """
+    Запросы пользователей user_ids в течение PIN_TIMEOUT секунд читают из основной бд, чтобы видеть
+    только что записанные для них данные. Метка хранится в кэше, а не в сессии, потому что запись
+    может делать обработчик уведомления яндекс-кассы, у которого нет запроса пользователя
+    """
+    user_ids = [i for i in user_ids if i]
+    if REPLICA_DB and user_ids:
+        cache.set_many({_pin_key(i): 1 for i in user_ids}, PIN_TIMEOUT)
+
+
+def is_pinned(user_id):
+    return bool(cache.get(_pin_key(user_id)))
+
+
+def read_from_replica(view=None, methods=('GET', 'HEAD')):
+    """
+    Декоратор view только для чтения: запросы methods читают из реплики, если пользователь
+    (из аргумента user_id view или request.user) недавно не оплачивал.
+    request.user и сессия загружаются из основной бд до перехода на реплику. Записи внутри view
+    (например, PromoCodeUsage на странице статуса оплаты или сохранение прочитанного из реплики
+    платежа) ReplicaRouter.db_for_write направляет в основную бд
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not REPLICA_DB or request.method not in methods:
+                return view(request, *args, **kwargs)
+            # request.user загружается лениво, первое обращение внутри replica_reads
+            # прочитало бы сессию и пользователя из отстающей реплики
+            user = getattr(request, 'user', None)
+            authenticated = user is not None and user.is_authenticated()
+            user_id = kwargs.get('user_id') or (authenticated and user.id)
+            if user_id and is_pinned(user_id):
+                return view(request, *args, **kwargs)
+            with replica_reads():
+                return view(request, *args, **kwargs)
+        return wrapper
+    if view is not None:
+        return decorator(view)
+    return decorator
+
+
+class ReplicaAutocompleteMixin(object):
+    """
+    миксин автокомплитов autocomplete_light: подсказки читаются из реплики
+    """
+    def autocomplete_html(self):
+        with replica_reads():
+            return super(ReplicaAutocompleteMixin, self).autocomplete_html()
@@ -0,0 +1,58 @@
+# coding: utf-8
+
+from plp.models import EnrollmentReason
+from plp_edmodule.models import EducationalModuleEnrollmentReason
+from .caching import bump_version_on_commit, get_or_set
+
+# у каждого пользователя свое пространство имен кэша, инвалидируется при изменении его
+# записей на апсейлы, сессии и модули (см. opro_payments.signals)
+CACHE_NAMESPACE = 'entitlements'
+
+
+def _namespace(user_id):
+    return '%s:%s' % (CACHE_NAMESPACE, user_id)
+
+
+def get_entitlements(user):
+    """
+    оплаченное пользователем: словарь
+        'upsale_links' - id UpsaleLink, на которые пользователь записан,
+        'sessions' - пары (id сессии, тип варианта записи) с основанием записи,
+        'modules' - пары (id модуля, full_paid) с основанием записи на модуль
+    """
+    def _build():
+        return {
+            'upsale_links': frozenset(user.bought_objects.values_list('upsale_id', flat=True)),
+            'sessions': frozenset(EnrollmentReason.objects.filter(participant__user=user).values_list(
+                'participant__session_id', 'session_enrollment_type__mode')),
+            'modules': frozenset(EducationalModuleEnrollmentReason.objects.filter(enrollment__user=user).values_list(
+                'enrollment__module_id', 'full_paid')),
+        }
+    return get_or_set(_namespace(user.id), [], _build)
+
+
+def invalidate_entitlements(*user_ids):
+    """
+    сброс кэша оплаченного после фиксации транзакции, в которой изменились записи пользователей
+    """
+    for user_id in set(user_ids):
+        bump_version_on_commit(_namespace(user_id))
+
+
+def has_paid_session(user, session_id, mode='verified'):
+    return (session_id, mode) in get_entitlements(user)['sessions']
+
+
+def has_paid_module(user, module_id, full_paid=None):
+    """
+    :param full_paid: None - любая оплата модуля, True/False - полная оплата или оплата только первого курса
+    """
+    return any(m == module_id and (full_paid is None or full_paid == f) for m, f in get_entitlements(user)['modules'])
+
+
+def get_paid_upsale_ids(user, upsale_link_ids):
+    """
+    id апсейлов из upsale_link_ids, на которые пользователь уже записан
+    """
+    bought = get_entitlements(user)['upsale_links']
+    return [i for i in upsale_link_ids if i in bought]
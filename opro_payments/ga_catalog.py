@@ -0,0 +1,51 @@
+# coding: utf-8
+
+from plp.models import CourseSession
+from plp_edmodule.models import EducationalModule
+from .caching import get_or_set
+
+# пространство имен кэша, инвалидируется при изменении курсов, сессий, модулей и их вариантов записи
+# (см. opro_payments.signals)
+CACHE_NAMESPACE = 'ga_catalog'
+
+
+def get_session_item(session_id):
+    """
+    данные сессии для товара гугл аналитики: {'in': название, 'ic': код, 'iv': тип, 'ip': цена}
+    """
+    def _build():
+        session = CourseSession.objects.select_related('course').get(id=session_id)
+        return {
+            'in': session.course.title,
+            'ic': session.course.slug,
+            'iv': 'course',
+            'ip': session.get_verified_mode_price(),
+        }
+    return get_or_set(CACHE_NAMESPACE, ['session', session_id], _build)
+
+
+def get_module_items(module_id):
+    """
+    данные модуля для товаров гугл аналитики: товар модуля с полной ценой
+    и товары курсов модуля с ненулевой ценой
+    """
+    def _build():
+        module = EducationalModule.objects.get(id=module_id)
+        price_data = module.get_price_list()
+        items = [{
+            'in': module.title,
+            'ic': module.code,
+            'iv': 'edmodule',
+            'ip': price_data['whole_price'],
+        }]
+        for course, course_price in price_data.get('courses', []):
+            if not course_price:
+                continue
+            items.append({
+                'in': course.title,
+                'ic': course.slug,
+                'iv': 'course',
+                'ip': course_price,
+            })
+        return items
+    return get_or_set(CACHE_NAMESPACE, ['module', module_id], _build)
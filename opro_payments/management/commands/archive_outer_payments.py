@@ -0,0 +1,59 @@
+# coding: utf-8
+
+import gzip
+import json
+import os
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils import timezone
+from opro_payments.models import OuterPayment, QueueItem
+
+ARCHIVE_FIELDS = ('id', 'order_id', 'body_digest', 'status', 'attempts', 'last_error', 'created_at', 'data')
+
+
+class Command(BaseCommand):
+    help = u'Перенос обработанных оплат с лендинга (OuterPayment) старше заданного срока в сжатый ' \
+           u'jsonl-архив с удалением из бд'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, dest='days', default=180,
+                            help=u'Срок хранения оплат в бд в днях')
+        parser.add_argument('--dir', dest='dir', default=getattr(settings, 'OPRO_PAYMENTS_ARCHIVE_DIR', None),
+                            help=u'Папка для архивов, по умолчанию OPRO_PAYMENTS_ARCHIVE_DIR')
+        parser.add_argument('--chunk-size', type=int, dest='chunk_size', default=1000,
+                            help=u'Количество оплат, читаемых и удаляемых одним запросом')
+
+    def handle(self, *args, **options):
+        if not options['dir'] or not os.path.isdir(options['dir']):
+            raise CommandError(u'Archive directory does not exist: %s' % options['dir'])
+        now = timezone.now()
+        qs = OuterPayment.objects.filter(
+            created_at__lt=now - timedelta(days=options['days']),
+            status__in=[QueueItem.STATUS.done, QueueItem.STATUS.failed],
+        ).order_by('id')
+        file_path = os.path.join(options['dir'], 'outer_payments_%s.jsonl.gz' % now.strftime('%Y%m%d%H%M%S'))
+        archived, last_id = 0, 0
+        with gzip.open(file_path, 'wb') as f:
+            while True:
+                # выборка по id вместо offset, чтобы каждая пачка читалась по индексу
+                chunk = list(qs.filter(id__gt=last_id).values(*ARCHIVE_FIELDS)[:options['chunk_size']])
+                if not chunk:
+                    break
+                for row in chunk:
+                    f.write(json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False).encode('utf-8'))
+                    f.write('\n')
+                # строки удаляются только после того, как попали в архив
+                f.flush()
+                ids = [row['id'] for row in chunk]
+                with transaction.atomic():
+                    OuterPayment.objects.filter(id__in=ids).delete()
+                archived += len(ids)
+                last_id = ids[-1]
+        if not archived:
+            os.remove(file_path)
+            self.stdout.write(u'Nothing to archive')
+        else:
+            self.stdout.write(u'Archived %s outer payments to %s' % (archived, file_path))
@@ -0,0 +1,104 @@
+# coding: utf-8
+
+import json
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from payments.models import YandexPayment
+from plp.models import User, CourseSession, SessionEnrollmentType
+from plp_edmodule.models import EducationalModule, EducationalModuleEnrollmentType
+from opro_payments.models import UpsaleLink, PaymentOrder, PaymentOrderLine
+
+
+class Command(BaseCommand):
+    help = u'Создание заказов PaymentOrder по metadata платежей, созданных до появления заказов. ' \
+           u'Платежи обрабатываются пачками, повторный запуск пропускает платежи, для которых заказ уже есть'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, dest='chunk_size', default=1000,
+                            help=u'Количество платежей, обрабатываемых за раз')
+
+    def handle(self, *args, **options):
+        qs = YandexPayment.objects.filter(opro_order__isnull=True).order_by('id')
+        last_id, created = 0, 0
+        while True:
+            chunk = list(qs.filter(id__gt=last_id).values_list('id', 'metadata', 'is_payed')[:options['chunk_size']])
+            if not chunk:
+                break
+            last_id = chunk[-1][0]
+            created += self.backfill_chunk(chunk)
+            self.stdout.write(u'Processed payments up to id=%s, %s orders created' % (last_id, created))
+
+    def backfill_chunk(self, chunk):
+        rows = []
+        for payment_id, metadata, is_payed in chunk:
+            try:
+                metadata = json.loads(metadata or '{}')
+            except ValueError:
+                continue
+            if isinstance(metadata, dict) and metadata.get('user') and \
+                    (metadata.get('new_mode') or metadata.get('edmodule')):
+                rows.append((payment_id, metadata, is_payed))
+        if not rows:
+            return 0
+
+        # справочники для всей пачки, чтобы не делать запросов на каждый платеж
+        user_ids, session_types, modules, upsale_ids = set(), set(), set(), set()
+        for payment_id, metadata, is_payed in rows:
+            user_ids.add(metadata['user']['id'])
+            if metadata.get('gift_receiver'):
+                user_ids.add(metadata['gift_receiver']['id'])
+            if metadata.get('new_mode'):
+                session_types.add(metadata['new_mode']['id'])
+            else:
+                modules.add(metadata['edmodule']['id'])
+            upsale_ids.update(metadata.get('upsale_links') or [])
+        existing_users = set(User.objects.filter(id__in=user_ids).values_list('id', flat=True))
+        session_by_type = dict(SessionEnrollmentType.objects.filter(id__in=session_types)
+                               .values_list('id', 'session_id'))
+        module_types = {(module_id, mode): type_id for type_id, module_id, mode in
+                        EducationalModuleEnrollmentType.objects.filter(module__id__in=modules)
+                        .values_list('id', 'module_id', 'mode')}
+        existing_upsales = set(UpsaleLink.objects.filter(id__in=upsale_ids).values_list('id', flat=True))
+        session_ct = ContentType.objects.get_for_model(CourseSession)
+        module_ct = ContentType.objects.get_for_model(EducationalModule)
+
+        orders, lines = [], {}
+        for payment_id, metadata, is_payed in rows:
+            user_id = metadata['user']['id']
+            gift_receiver_id = (metadata.get('gift_receiver') or {}).get('id')
+            if user_id not in existing_users:
+                continue
+            kwargs = dict(
+                payment_id=payment_id,
+                user_id=user_id,
+                gift_receiver_id=gift_receiver_id if gift_receiver_id in existing_users else None,
+                promocode=metadata.get('promocode') or '',
+                ga_cid=(metadata.get('google_analytics') or [{}])[0].get('cid') or '',
+                is_paid=bool(is_payed),
+            )
+            if metadata.get('new_mode'):
+                new_mode = metadata['new_mode']
+                if new_mode['id'] not in session_by_type:
+                    continue
+                kwargs.update(content_type=session_ct, object_id=session_by_type[new_mode['id']],
+                              enrollment_type_id=new_mode['id'], mode=new_mode['mode'])
+            else:
+                edmodule = metadata['edmodule']
+                type_id = module_types.get((edmodule['id'], edmodule['mode']))
+                if not type_id:
+                    continue
+                kwargs.update(content_type=module_ct, object_id=edmodule['id'], enrollment_type_id=type_id,
+                              mode=edmodule['mode'], only_first_course=bool(edmodule.get('only_first_course')),
+                              first_session_id=edmodule.get('first_session_id'))
+            orders.append(PaymentOrder(**kwargs))
+            lines[payment_id] = [i for i in (metadata.get('upsale_links') or []) if i in existing_upsales]
+
+        with transaction.atomic():
+            PaymentOrder.objects.bulk_create(orders)
+            order_ids = dict(PaymentOrder.objects.filter(payment_id__in=lines.keys()).values_list('payment_id', 'id'))
+            PaymentOrderLine.objects.bulk_create([
+                PaymentOrderLine(order_id=order_ids[payment_id], upsale_link_id=upsale_id)
+                for payment_id, upsale_ids in lines.items() for upsale_id in set(upsale_ids)
+            ])
+        return len(orders)
@@ -0,0 +1,67 @@
+# coding: utf-8
+
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import transaction, connection
+from django.utils import timezone
+from payments.models import YandexPayment
+from opro_payments.models import PaymentOrder, PaymentLookup, _select_locked_ids
+
+
+class Command(BaseCommand):
+    help = u'Удаление неоплаченных платежей (и их заказов), созданных раньше заданного срока. Платежи ' \
+           u'удаляются небольшими пачками в отдельных транзакциях, поэтому команду можно запускать под нагрузкой. ' \
+           u'Вместе с платежом удаляются все ссылающиеся на него записи, в том числе других приложений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, dest='days', default=30,
+                            help=u'Возраст неоплаченного заказа в днях, после которого он удаляется')
+        parser.add_argument('--batch-size', type=int, dest='batch_size', default=200,
+                            help=u'Количество платежей, удаляемых в одной транзакции')
+        parser.add_argument('--sleep', type=float, dest='sleep', default=0,
+                            help=u'Пауза в секундах между пачками')
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run', default=False,
+                            help=u'Только посчитать платежи, которые будут удалены')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        qs = PaymentOrder.objects.filter(is_paid=False, created_at__lt=cutoff).order_by('id')
+        last_id, deleted = 0, 0
+        while True:
+            # выборка по id вместо offset, каждая пачка читается по первичному ключу
+            chunk = list(qs.filter(id__gt=last_id).values_list('id', 'payment_id')[:options['batch_size']])
+            if not chunk:
+                break
+            last_id = chunk[-1][0]
+            deleted += self.delete_batch([payment_id for _id, payment_id in chunk], cutoff, options['dry_run'])
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        self.stdout.write(u'%s unpaid payments %s' % (deleted, 'to delete' if options['dry_run'] else 'deleted'))
+
+    def delete_batch(self, payment_ids, cutoff, dry_run):
+        """
+        Удаление пачки платежей. Платеж пропускается, если он или его заказ уже оплачен, заблокирован
+        параллельной транзакцией или пользователь недавно снова отправлял этот заказ на оплату.
+        Обработчик уведомления яндекс-кассы не блокирует строку платежа заранее, поэтому оплата
+        перепроверяется в том же запросе, что блокирует платежи, и еще раз при удалении.
+        Удаление YandexPayment каскадно удаляет все записи, ссылающиеся на платеж, в том числе в
+        таблицах других приложений (заказ PaymentOrder со строками, PaymentLookup и т.д.)
+        """
+        with transaction.atomic():
+            payment_table = connection.ops.quote_name(YandexPayment._meta.db_table)
+            where = '{payment_table}.id IN ({ids}) AND {payment_table}.{is_payed} = %s AND NOT EXISTS (' \
+                    'SELECT 1 FROM {order_table} WHERE {order_table}.payment_id = {payment_table}.id ' \
+                    'AND {order_table}.is_paid = %s)'.format(
+                        payment_table=payment_table,
+                        ids=', '.join(['%s'] * len(payment_ids)),
+                        is_payed=connection.ops.quote_name(YandexPayment._meta.get_field('is_payed').column),
+                        order_table=connection.ops.quote_name(PaymentOrder._meta.db_table),
+                    )
+            ids = _select_locked_ids(YandexPayment, where, payment_ids + [False, True], limit=len(payment_ids))
+            recent = set(PaymentLookup.objects.filter(payment__id__in=ids, updated_at__gte=cutoff)
+                         .values_list('payment_id', flat=True))
+            ids = [i for i in ids if i not in recent]
+            if ids and not dry_run:
+                YandexPayment.objects.filter(id__in=ids, is_payed=False).exclude(opro_order__is_paid=True).delete()
+        return len(ids)
@@ -0,0 +1,27 @@
+# coding: utf-8
+
+from django.core.management.base import BaseCommand
+from opro_payments.models import GoogleAnalyticsHit
+from opro_payments.utils import send_google_analytics_hits
+from opro_payments.workers import run_workers
+
+
+class Command(BaseCommand):
+    help = u'Отправка накопленных данных гугл аналитики по платежам пачками по %s строк. Неполная пачка ' \
+           u'отправляется, когда самая старая строка ждет дольше --max-wait секунд' % GoogleAnalyticsHit.BATCH_SIZE
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, dest='workers', default=1,
+                            help=u'Количество параллельных обработчиков')
+        parser.add_argument('--interval', type=int, dest='interval', default=10,
+                            help=u'Пауза в секундах между проверками очереди, за это время копятся новые строки')
+        parser.add_argument('--max-wait', type=int, dest='max_wait', default=GoogleAnalyticsHit.MAX_WAIT,
+                            help=u'Сколько секунд строка может ждать, пока накопится полная пачка')
+        parser.add_argument('--once', action='store_true', dest='once', default=False,
+                            help=u'Отправить все накопленные строки и завершить работу')
+
+    def handle(self, *args, **options):
+        run_workers(GoogleAnalyticsHit.objects, send_google_analytics_hits, workers=options['workers'],
+                    batch_size=GoogleAnalyticsHit.BATCH_SIZE, once=options['once'],
+                    idle_sleep=options['interval'], batch=True,
+                    ready=lambda: GoogleAnalyticsHit.objects.batch_ready(options['max_wait']))
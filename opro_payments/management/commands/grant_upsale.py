@@ -0,0 +1,39 @@
+# coding: utf-8
+
+import io
+from django.core.management.base import BaseCommand, CommandError
+from opro_payments.models import UpsaleLink, ObjectEnrollment
+from opro_payments.utils import read_emails, get_users_by_emails
+
+
+class Command(BaseCommand):
+    help = u'Массовая бесплатная запись пользователей на апсейл. Пользователи, уже записанные на апсейл, ' \
+           u'пропускаются, поэтому команду можно запускать повторно'
+
+    def add_arguments(self, parser):
+        parser.add_argument('upsale_link', type=int, help=u'id UpsaleLink')
+        parser.add_argument('emails_file', help=u'Файл со списком email (csv, email в первой колонке)')
+        parser.add_argument('--description', dest='description', default=None,
+                            help=u'Описание платежа\\заказа для создаваемых записей')
+        parser.add_argument('--batch-size', type=int, dest='batch_size', default=500,
+                            help=u'Количество записей, создаваемых одним запросом')
+
+    def handle(self, *args, **options):
+        try:
+            link = UpsaleLink.objects.select_related('upsale').get(id=options['upsale_link'])
+        except UpsaleLink.DoesNotExist:
+            raise CommandError(u'UpsaleLink with id=%s does not exist' % options['upsale_link'])
+        with io.open(options['emails_file'], encoding='utf-8') as f:
+            emails = read_emails(f)
+        users, not_found = get_users_by_emails(emails)
+        for email in not_found:
+            self.stderr.write(u'User not found: %s' % email)
+        created, skipped = ObjectEnrollment.objects.grant(
+            link, users,
+            enrollment_type=ObjectEnrollment.ENROLLMENT_TYPE_CHOICES.free,
+            payment_type=ObjectEnrollment.PAYMENT_TYPE_CHOICES.none,
+            payment_descriptions=options['description'],
+            batch_size=options['batch_size'],
+        )
+        self.stdout.write(u'UpsaleLink %s: created %s enrollments, %s users already enrolled, %s not found, '
+                          u'%s promocodes left' % (link.id, created, skipped, len(not_found), link.get_promocodes_left()))
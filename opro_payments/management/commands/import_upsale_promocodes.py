@@ -0,0 +1,59 @@
+# coding: utf-8
+
+import io
+import os
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max
+from opro_payments.models import UpsaleLink, UpsalePromoCode
+
+
+class Command(BaseCommand):
+    help = u'Загрузка промокодов апсейлов из файлов UPSALE_PROMOCODES_DIR в пул UpsalePromoCode. ' \
+           u'Файл читается построчно, повторный запуск догружает только новые строки файла'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--upsale-link', type=int, dest='upsale_link', default=None,
+                            help=u'id UpsaleLink, по умолчанию обрабатываются все апсейлы с файлом промокодов')
+        parser.add_argument('--batch-size', type=int, dest='batch_size', default=1000,
+                            help=u'Количество промокодов, сохраняемых одним запросом')
+
+    def handle(self, *args, **options):
+        links = UpsaleLink.objects.exclude(additional_info=None)
+        if options['upsale_link']:
+            links = links.filter(id=options['upsale_link'])
+        for link in links:
+            promo = (link.additional_info or {}).get('promo') or {}
+            if not promo.get('file'):
+                continue
+            file_path = os.path.join(UpsaleLink.get_promocode_dir(), promo['file'])
+            if not os.path.exists(file_path):
+                raise CommandError(u'Upsale promocodes path does not exist: %s' % file_path)
+            imported = self.import_file(link, file_path, promo.get('already_sent'), options['batch_size'])
+            self.stdout.write(u'UpsaleLink %s: imported %s promocodes, %s left' % (
+                link.id, imported, link.get_promocodes_left()))
+
+    def import_file(self, link, file_path, already_sent, batch_size):
+        """
+        Загрузка строк файла, которые еще не были загружены в пул и не были выданы
+        до появления пула (already_sent)
+        """
+        last_line = UpsalePromoCode.objects.filter(upsale_link=link).aggregate(m=Max('line'))['m'] or 0
+        try:
+            last_line = max(last_line, int(already_sent))
+        except (TypeError, ValueError):
+            pass
+        imported, batch = 0, []
+        with io.open(file_path, encoding='utf-8') as f:
+            for line, code in enumerate(f, 1):
+                code = code.strip()
+                if line <= last_line or not code:
+                    continue
+                batch.append(UpsalePromoCode(upsale_link=link, code=code, line=line))
+                if len(batch) >= batch_size:
+                    UpsalePromoCode.objects.bulk_create(batch)
+                    imported += len(batch)
+                    batch = []
+        if batch:
+            UpsalePromoCode.objects.bulk_create(batch)
+            imported += len(batch)
+        return imported
@@ -0,0 +1,22 @@
+# coding: utf-8
+
+from django.core.management.base import BaseCommand
+from opro_payments.models import OuterPayment
+from opro_payments.outer_payments import process_outer_payment
+from opro_payments.workers import run_workers
+
+
+class Command(BaseCommand):
+    help = u'Запись на курсы/специализации/апсейлы по сохраненным оплатам с лендинга (OuterPayment)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, dest='workers', default=4,
+                            help=u'Количество параллельных обработчиков')
+        parser.add_argument('--batch-size', type=int, dest='batch_size', default=5,
+                            help=u'Количество платежей, захватываемых обработчиком за раз')
+        parser.add_argument('--once', action='store_true', dest='once', default=False,
+                            help=u'Завершить работу, когда очередь опустеет')
+
+    def handle(self, *args, **options):
+        run_workers(OuterPayment.objects, process_outer_payment, workers=options['workers'],
+                    batch_size=options['batch_size'], once=options['once'])
@@ -0,0 +1,23 @@
+# coding: utf-8
+
+from django.core.management.base import BaseCommand
+from opro_payments.models import PaymentTask
+from opro_payments.tasks import run_task
+from opro_payments.workers import run_workers
+
+
+class Command(BaseCommand):
+    help = u'Выполнение отложенных действий после оплаты (запись в edx, письма, аналитика) ' \
+           u'из очереди PaymentTask с повторными попытками'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, dest='workers', default=4,
+                            help=u'Количество параллельных обработчиков')
+        parser.add_argument('--batch-size', type=int, dest='batch_size', default=10,
+                            help=u'Количество задач, захватываемых обработчиком за раз')
+        parser.add_argument('--once', action='store_true', dest='once', default=False,
+                            help=u'Завершить работу, когда очередь опустеет')
+
+    def handle(self, *args, **options):
+        run_workers(PaymentTask.objects, run_task, workers=options['workers'],
+                    batch_size=options['batch_size'], once=options['once'])
@@ -0,0 +1,15 @@
+# coding: utf-8
+
+from django.core.management.base import BaseCommand
+from opro_payments.ratelimit import get_rejected_counts, RATE_LIMITS
+
+
+class Command(BaseCommand):
+    help = u'Количество запросов, отклоненных ограничениями частоты запросов (OPRO_PAYMENTS_RATE_LIMITS)'
+
+    def handle(self, *args, **options):
+        if not RATE_LIMITS:
+            self.stdout.write(u'Rate limits are disabled, set OPRO_PAYMENTS_RATE_LIMITS to enable them')
+        for name, count in sorted(get_rejected_counts().items()):
+            per_minute, burst = RATE_LIMITS[name]
+            self.stdout.write(u'%s (%s/min, burst %s): %s rejected' % (name, per_minute, burst, count))
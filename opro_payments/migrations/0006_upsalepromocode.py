@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opro_payments', '0005_outerpayment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UpsalePromoCode',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('code', models.CharField(max_length=255, verbose_name='\u041f\u0440\u043e\u043c\u043e\u043a\u043e\u0434')),
+                ('line', models.PositiveIntegerField(verbose_name='\u041d\u043e\u043c\u0435\u0440 \u0441\u0442\u0440\u043e\u043a\u0438 \u0432 \u0444\u0430\u0439\u043b\u0435 \u043f\u0440\u043e\u043c\u043e\u043a\u043e\u0434\u043e\u0432')),
+                ('is_used', models.BooleanField(default=False, verbose_name='\u041f\u0440\u043e\u043c\u043e\u043a\u043e\u0434 \u0432\u044b\u0434\u0430\u043d')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='\u0412\u0440\u0435\u043c\u044f \u0441\u043e\u0437\u0434\u0430\u043d\u0438\u044f')),
+                ('enrollment', models.OneToOneField(related_name='promo_code', null=True, blank=True, on_delete=django.db.models.deletion.SET_NULL, verbose_name='\u0417\u0430\u043f\u0438\u0441\u044c \u043d\u0430 \u043e\u0431\u044a\u0435\u043a\u0442', to='opro_payments.ObjectEnrollment')),
+                ('upsale_link', models.ForeignKey(related_name='promo_codes', verbose_name='\u0410\u043f\u0441\u0435\u0439\u043b', to='opro_payments.UpsaleLink')),
+            ],
+            options={
+                'verbose_name': '\u041f\u0440\u043e\u043c\u043e\u043a\u043e\u0434 \u0430\u043f\u0441\u0435\u0439\u043b\u0430',
+                'verbose_name_plural': '\u041f\u0440\u043e\u043c\u043e\u043a\u043e\u0434\u044b \u0430\u043f\u0441\u0435\u0439\u043b\u043e\u0432',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='upsalepromocode',
+            unique_together=set([('upsale_link', 'line')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='upsalepromocode',
+            index_together=set([('upsale_link', 'is_used')]),
+        ),
+    ]
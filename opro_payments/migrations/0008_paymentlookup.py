@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('payments', '__first__'),
+        ('opro_payments', '0007_paymenttask'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentLookup',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('object_id', models.PositiveIntegerField(verbose_name='\u041e\u0431\u044a\u0435\u043a\u0442')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='\u0412\u0440\u0435\u043c\u044f \u043e\u0431\u043d\u043e\u0432\u043b\u0435\u043d\u0438\u044f')),
+                ('content_type', models.ForeignKey(verbose_name='\u0422\u0438\u043f \u043e\u0431\u044a\u0435\u043a\u0442\u0430', to='contenttypes.ContentType')),
+                ('payment', models.ForeignKey(related_name='+', verbose_name='\u041f\u043b\u0430\u0442\u0435\u0436', to='payments.YandexPayment')),
+                ('user', models.ForeignKey(related_name='+', verbose_name='\u041f\u043e\u043b\u044c\u0437\u043e\u0432\u0430\u0442\u0435\u043b\u044c', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='paymentlookup',
+            unique_together=set([('user', 'content_type', 'object_id')]),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '__first__'),
+        ('opro_payments', '0008_paymentlookup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PromoCodeUsage',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('promocode', models.CharField(max_length=255, verbose_name='\u041f\u0440\u043e\u043c\u043e\u043a\u043e\u0434')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='\u0412\u0440\u0435\u043c\u044f \u0441\u043e\u0437\u0434\u0430\u043d\u0438\u044f')),
+                ('payment', models.OneToOneField(related_name='+', verbose_name='\u041f\u043b\u0430\u0442\u0435\u0436', to='payments.YandexPayment')),
+            ],
+            options={
+                'verbose_name': '\u0418\u0441\u043f\u043e\u043b\u044c\u0437\u043e\u0432\u0430\u043d\u0438\u0435 \u043f\u0440\u043e\u043c\u043e\u043a\u043e\u0434\u0430',
+                'verbose_name_plural': '\u0418\u0441\u043f\u043e\u043b\u044c\u0437\u043e\u0432\u0430\u043d\u0438\u044f \u043f\u0440\u043e\u043c\u043e\u043a\u043e\u0434\u043e\u0432',
+            },
+        ),
+    ]
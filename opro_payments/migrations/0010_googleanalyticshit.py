@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opro_payments', '0009_promocodeusage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GoogleAnalyticsHit',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('status', models.PositiveSmallIntegerField(default=0, verbose_name='\u0421\u0442\u0430\u0442\u0443\u0441', choices=[(0, b'Pending'), (1, b'Processing'), (2, b'Done'), (3, b'Failed')])),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='\u041a\u043e\u043b\u0438\u0447\u0435\u0441\u0442\u0432\u043e \u043f\u043e\u043f\u044b\u0442\u043e\u043a')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='\u0412\u0440\u0435\u043c\u044f \u0441\u043b\u0435\u0434\u0443\u044e\u0449\u0435\u0439 \u043f\u043e\u043f\u044b\u0442\u043a\u0438')),
+                ('last_error', models.TextField(default='', verbose_name='\u041f\u043e\u0441\u043b\u0435\u0434\u043d\u044f\u044f \u043e\u0448\u0438\u0431\u043a\u0430', blank=True)),
+                ('payment_id', models.PositiveIntegerField(null=True, verbose_name='id \u043f\u043b\u0430\u0442\u0435\u0436\u0430', blank=True)),
+                ('data', models.TextField(verbose_name='\u0414\u0430\u043d\u043d\u044b\u0435')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='\u0412\u0440\u0435\u043c\u044f \u0441\u043e\u0437\u0434\u0430\u043d\u0438\u044f')),
+            ],
+            options={
+                'verbose_name': '\u0414\u0430\u043d\u043d\u044b\u0435 \u0433\u0443\u0433\u043b \u0430\u043d\u0430\u043b\u0438\u0442\u0438\u043a\u0438',
+                'verbose_name_plural': '\u0414\u0430\u043d\u043d\u044b\u0435 \u0433\u0443\u0433\u043b \u0430\u043d\u0430\u043b\u0438\u0442\u0438\u043a\u0438',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='googleanalyticshit',
+            index_together=set([('status', 'next_attempt_at')]),
+        ),
+    ]
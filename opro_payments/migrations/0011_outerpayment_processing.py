@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+def mark_existing_processed(apps, schema_editor):
+    # \u0432\u043d\u0435\u0448\u043d\u0438\u0435 \u043f\u043b\u0430\u0442\u0435\u0436\u0438, \u0441\u043e\u0445\u0440\u0430\u043d\u0435\u043d\u043d\u044b\u0435 \u0434\u043e \u043f\u043e\u044f\u0432\u043b\u0435\u043d\u0438\u044f \u0444\u043e\u043d\u043e\u0432\u043e\u0439 \u043e\u0431\u0440\u0430\u0431\u043e\u0442\u043a\u0438, \u0443\u0436\u0435 \u0431\u044b\u043b\u0438 \u043e\u0431\u0440\u0430\u0431\u043e\u0442\u0430\u043d\u044b
+    OuterPayment = apps.get_model('opro_payments', 'OuterPayment')
+    OuterPayment.objects.update(status=2)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opro_payments', '0010_googleanalyticshit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outerpayment',
+            name='status',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='\u0421\u0442\u0430\u0442\u0443\u0441', choices=[(0, b'Pending'), (1, b'Processing'), (2, b'Done'), (3, b'Failed')]),
+        ),
+        migrations.AddField(
+            model_name='outerpayment',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='\u041a\u043e\u043b\u0438\u0447\u0435\u0441\u0442\u0432\u043e \u043f\u043e\u043f\u044b\u0442\u043e\u043a'),
+        ),
+        migrations.AddField(
+            model_name='outerpayment',
+            name='next_attempt_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='\u0412\u0440\u0435\u043c\u044f \u0441\u043b\u0435\u0434\u0443\u044e\u0449\u0435\u0439 \u043f\u043e\u043f\u044b\u0442\u043a\u0438'),
+        ),
+        migrations.AddField(
+            model_name='outerpayment',
+            name='last_error',
+            field=models.TextField(default='', verbose_name='\u041f\u043e\u0441\u043b\u0435\u0434\u043d\u044f\u044f \u043e\u0448\u0438\u0431\u043a\u0430', blank=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='outerpayment',
+            index_together=set([('status', 'next_attempt_at')]),
+        ),
+        migrations.RunPython(mark_existing_processed, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opro_payments', '0011_outerpayment_processing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outerpayment',
+            name='order_id',
+            field=models.CharField(max_length=64, unique=True, null=True, verbose_name='\u041d\u043e\u043c\u0435\u0440 \u0437\u0430\u043a\u0430\u0437\u0430', blank=True),
+        ),
+        migrations.AddField(
+            model_name='outerpayment',
+            name='body_digest',
+            field=models.CharField(max_length=64, unique=True, null=True, verbose_name='\u0425\u044d\u0448 \u0442\u0435\u043b\u0430 \u0437\u0430\u043f\u0440\u043e\u0441\u0430', blank=True),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('payments', '__first__'),
+        ('opro_payments', '0012_outerpayment_dedup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentOrder',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('object_id', models.PositiveIntegerField(verbose_name='\u041e\u0431\u044a\u0435\u043a\u0442')),
+                ('enrollment_type_id', models.PositiveIntegerField(verbose_name='\u0412\u0430\u0440\u0438\u0430\u043d\u0442 \u0437\u0430\u043f\u0438\u0441\u0438')),
+                ('mode', models.CharField(max_length=64, verbose_name='\u0422\u0438\u043f \u0432\u0430\u0440\u0438\u0430\u043d\u0442\u0430 \u0437\u0430\u043f\u0438\u0441\u0438')),
+                ('only_first_course', models.BooleanField(default=False, verbose_name='\u041e\u043f\u043b\u0430\u0442\u0430 \u0442\u043e\u043b\u044c\u043a\u043e \u043f\u0435\u0440\u0432\u043e\u0433\u043e \u043a\u0443\u0440\u0441\u0430 \u043c\u043e\u0434\u0443\u043b\u044f')),
+                ('first_session_id', models.PositiveIntegerField(null=True, verbose_name='\u0421\u0435\u0441\u0441\u0438\u044f \u043f\u0435\u0440\u0432\u043e\u0433\u043e \u043a\u0443\u0440\u0441\u0430 \u043c\u043e\u0434\u0443\u043b\u044f', blank=True)),
+                ('promocode', models.CharField(default='', max_length=255, verbose_name='\u041f\u0440\u043e\u043c\u043e\u043a\u043e\u0434', blank=True)),
+                ('ga_cid', models.CharField(default='', max_length=64, verbose_name='\u0418\u0434\u0435\u043d\u0442\u0438\u0444\u0438\u043a\u0430\u0442\u043e\u0440 \u043a\u043b\u0438\u0435\u043d\u0442\u0430 GA', blank=True)),
+                ('is_paid', models.BooleanField(default=False, verbose_name='\u041e\u043f\u043b\u0430\u0447\u0435\u043d')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='\u0412\u0440\u0435\u043c\u044f \u0441\u043e\u0437\u0434\u0430\u043d\u0438\u044f')),
+                ('paid_at', models.DateTimeField(null=True, verbose_name='\u0412\u0440\u0435\u043c\u044f \u043e\u043f\u043b\u0430\u0442\u044b', blank=True)),
+                ('content_type', models.ForeignKey(verbose_name='\u0422\u0438\u043f \u043e\u0431\u044a\u0435\u043a\u0442\u0430', to='contenttypes.ContentType')),
+                ('gift_receiver', models.ForeignKey(related_name='+', verbose_name='\u041f\u043e\u043b\u0443\u0447\u0430\u0442\u0435\u043b\u044c \u043f\u043e\u0434\u0430\u0440\u043a\u0430', blank=True, to=settings.AUTH_USER_MODEL, null=True)),
+                ('payment', models.OneToOneField(related_name='opro_order', verbose_name='\u041f\u043b\u0430\u0442\u0435\u0436', to='payments.YandexPayment')),
+                ('user', models.ForeignKey(related_name='+', verbose_name='\u041f\u043e\u043b\u044c\u0437\u043e\u0432\u0430\u0442\u0435\u043b\u044c', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': '\u0417\u0430\u043a\u0430\u0437',
+                'verbose_name_plural': '\u0417\u0430\u043a\u0430\u0437\u044b',
+            },
+        ),
+        migrations.CreateModel(
+            name='PaymentOrderLine',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('price', models.PositiveIntegerField(null=True, verbose_name='\u0426\u0435\u043d\u0430', blank=True)),
+                ('order', models.ForeignKey(related_name='lines', verbose_name='\u0417\u0430\u043a\u0430\u0437', to='opro_payments.PaymentOrder')),
+                ('upsale_link', models.ForeignKey(related_name='+', verbose_name='\u0410\u043f\u0441\u0435\u0439\u043b', to='opro_payments.UpsaleLink')),
+            ],
+            options={
+                'verbose_name': '\u0421\u0442\u0440\u043e\u043a\u0430 \u0437\u0430\u043a\u0430\u0437\u0430',
+                'verbose_name_plural': '\u0421\u0442\u0440\u043e\u043a\u0438 \u0437\u0430\u043a\u0430\u0437\u043e\u0432',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='paymentorderline',
+            unique_together=set([('order', 'upsale_link')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='paymentorder',
+            index_together=set([('content_type', 'object_id', 'is_paid'), ('user', 'is_paid')]),
+        ),
+    ]
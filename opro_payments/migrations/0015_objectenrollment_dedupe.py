@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Count
+
+
+def remove_duplicates(apps, schema_editor):
+    # \u0438\u0437 \u0434\u0443\u0431\u043b\u0435\u0439 \u0437\u0430\u043f\u0438\u0441\u0438 \u043d\u0430 \u0430\u043f\u0441\u0435\u0439\u043b \u043e\u0441\u0442\u0430\u0435\u0442\u0441\u044f \u0437\u0430\u043f\u0438\u0441\u044c \u0441 \u043f\u0440\u043e\u043c\u043e\u043a\u043e\u0434\u043e\u043c (\u0438\u043b\u0438 \u0441\u0430\u043c\u0430\u044f \u0440\u0430\u043d\u043d\u044f\u044f),
+    # \u043e\u043d\u0430 \u0430\u043a\u0442\u0438\u0432\u043d\u0430, \u0435\u0441\u043b\u0438 \u0431\u044b\u043b\u0430 \u0430\u043a\u0442\u0438\u0432\u043d\u0430 \u0445\u043e\u0442\u044f \u0431\u044b \u043e\u0434\u043d\u0430 \u0438\u0437 \u0434\u0443\u0431\u043b\u0435\u0439
+    ObjectEnrollment = apps.get_model('opro_payments', 'ObjectEnrollment')
+    duplicates = ObjectEnrollment.objects.values('user', 'upsale').annotate(n=Count('id')).filter(n__gt=1)
+    for dup in duplicates:
+        rows = list(ObjectEnrollment.objects.filter(user_id=dup['user'], upsale_id=dup['upsale']).order_by('id'))
+        keep = next((i for i in rows if (i.jsonfield or {}).get('promo_code')), rows[0])
+        if not keep.is_active and any(i.is_active for i in rows):
+            keep.is_active = True
+            keep.save(update_fields=['is_active'])
+        ObjectEnrollment.objects.filter(id__in=[i.id for i in rows if i.id != keep.id]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opro_payments', '0014_paymentorder_order_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('opro_payments', '0015_objectenrollment_dedupe'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='objectenrollment',
+            unique_together=set([('user', 'upsale')]),
+        ),
+    ]
@@ -1,18 +1,43 @@
 # coding: utf-8
 
 import os
-import linecache
 import logging
 import json
+from collections import OrderedDict
+from datetime import timedelta
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import models, transaction
+from django.db import models, transaction, connection, IntegrityError
+from django.db.models import F, Case, When, Value
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from imagekit.models import ImageSpecField
 from imagekit.processors import Resize
 from jsonfield import JSONField
+from .entitlements import invalidate_entitlements
+
+
+def _select_locked_ids(model, where, params, limit=1, order_by='id'):
+    """
+    Возвращает id записей model, удовлетворяющих условию where, блокируя их до конца текущей
+    транзакции (SELECT ... FOR UPDATE). Для postgresql строки, уже заблокированные другими
+    транзакциями, пропускаются (SKIP LOCKED), поэтому параллельные обработчики не ждут друг друга
+    и не получают одни и те же записи. Вызывать только внутри transaction.atomic()
+    """
+    lock = ''
+    if connection.features.has_select_for_update:
+        lock = ' FOR UPDATE SKIP LOCKED' if connection.vendor == 'postgresql' else ' FOR UPDATE'
+    sql = 'SELECT id FROM {table} WHERE {where} ORDER BY {order_by} LIMIT %s{lock}'.format(
+        table=connection.ops.quote_name(model._meta.db_table),
+        where=where,
+        order_by=order_by,
+        lock=lock,
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, list(params) + [limit])
+        return [row[0] for row in cursor.fetchall()]
 
 
 class Upsale(models.Model):
@@ -89,6 +114,18 @@ class Upsale(models.Model):
         return u'%s - %s' % (self.slug, self.title)
 
 
+class UpsaleLinkQuerySet(models.QuerySet):
+    def for_object(self, obj):
+        """
+        апсейлы, привязанные к объекту obj (CourseSession или EducationalModule), с подгруженными
+        Upsale - одним запросом вместо обращения к content_object каждого апсейла
+        """
+        return self.filter(
+            content_type=ContentType.objects.get_for_model(obj),
+            object_id=obj.id
+        ).select_related('upsale')
+
+
 class UpsaleLink(models.Model):
     class IS_PAID_CHOICES(object):
         free = 0
@@ -122,6 +159,8 @@ class UpsaleLink(models.Model):
                                 help_text=_(u'json вида {"promo": {"file":"123.txt", "already_sent": 4}}. '
                                             u'"already_sent" - служебное поле, не менять'))
 
+    objects = UpsaleLinkQuerySet.as_manager()
+
     def get_price(self):
         return self.price if self.price is not None else self.upsale.price
 
@@ -142,6 +181,12 @@ class UpsaleLink(models.Model):
         except (ObjectDoesNotExist, AssertionError):
             return ''
 
+    def get_promocodes_left(self):
+        """
+        количество невыданных промокодов в пуле апсейла
+        """
+        return self.promo_codes.filter(is_used=False).count()
+
     @classmethod
     def get_promocode_dir(cls):
         path = getattr(settings, 'UPSALE_PROMOCODES_DIR', None)
@@ -161,6 +206,128 @@ class UpsaleLink(models.Model):
         }, ensure_ascii=False)
 
 
+class ObjectEnrollmentManager(models.Manager):
+    def grant(self, upsale_link, users, enrollment_type, payment_type, batch_size=500, **kwargs):
+        """
+        Массовая запись пользователей users на апсейл upsale_link. Пользователи, уже записанные
+        на апсейл, пропускаются. Записи создаются пачками по batch_size через bulk_create, промокоды
+        для всей пачки выдаются из пула одним запросом в той же транзакции
+        :param kwargs: остальные поля ObjectEnrollment (is_active, payment_descriptions, ...)
+        :return: (количество созданных записей, количество пропущенных пользователей)
+        """
+        kwargs.setdefault('is_active', True)
+        user_ids = list(OrderedDict.fromkeys(getattr(u, 'id', u) for u in users))
+        created = skipped = 0
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            with transaction.atomic():
+                enrolled = set(self.filter(upsale=upsale_link, user__id__in=batch).values_list('user_id', flat=True))
+                to_create = [i for i in batch if i not in enrolled]
+                skipped += len(enrolled)
+                if not to_create:
+                    continue
+                promos = UpsalePromoCode.objects.claim_many(upsale_link.id, len(to_create))
+                if len(promos) < len(to_create) and (upsale_link.additional_info or {}).get('promo', {}).get('file'):
+                    logging.error('No promocodes left for upsale link %s' % upsale_link.id)
+                promo_by_user = dict(zip(to_create, promos))
+                objs = []
+                for user_id in to_create:
+                    promo = promo_by_user.get(user_id)
+                    objs.append(self.model(user_id=user_id, upsale=upsale_link, enrollment_type=enrollment_type,
+                                           payment_type=payment_type,
+                                           jsonfield={'promo_code': promo.code} if promo else None, **kwargs))
+                self.bulk_create(objs)
+                if promo_by_user:
+                    # bulk_create не возвращает id созданных записей, поэтому привязка промокодов
+                    # к записям делается одним update по id записей, прочитанным после вставки
+                    enrollment_ids = dict(self.filter(upsale=upsale_link, user__id__in=promo_by_user.keys())
+                                          .values_list('user_id', 'id'))
+                    UpsalePromoCode.objects.filter(id__in=[p.id for p in promos]).update(enrollment=Case(
+                        *[When(id=promo.id, then=Value(enrollment_ids[user_id]))
+                          for user_id, promo in promo_by_user.items()],
+                        output_field=models.IntegerField()
+                    ))
+                created += len(to_create)
+                # bulk_create не отправляет post_save, кэш оплаченного сбрасывается явно
+                invalidate_entitlements(*to_create)
+        return created, skipped
+
+    def upsert(self, user, upsale_links, **defaults):
+        """
+        Запись пользователя на апсейлы корзины: отсутствующие записи создаются, у существующих
+        обновляются поля defaults. В postgresql все записи пишутся одним INSERT ... ON CONFLICT,
+        параллельные вызовы не создают дублей (уникальность (user, upsale)). Промокоды из пула
+        выдаются только по действительно созданным записям. Вызывать внутри transaction.atomic()
+        :param defaults: enrollment_type, payment_type, payment_order_id, is_active
+        :return: список (UpsaleLink, запись создана, промокод или None)
+        """
+        links = OrderedDict((i.id, i) for i in upsale_links)
+        if not links:
+            return []
+        if connection.vendor == 'postgresql':
+            created = self._upsert_postgresql(user.id, list(links), defaults)
+        else:
+            created = self._upsert_generic(user.id, list(links), defaults)
+        # записи пишутся без save, поэтому post_save не отправляется
+        invalidate_entitlements(user.id)
+        result = []
+        for link_id, link in links.items():
+            promo = None
+            if link_id in created:
+                promo = UpsalePromoCode.objects.claim(link_id)
+                if promo:
+                    self.filter(id=created[link_id]).update(jsonfield={'promo_code': promo.code})
+                    UpsalePromoCode.objects.filter(id=promo.id).update(enrollment=created[link_id])
+                elif (link.additional_info or {}).get('promo', {}).get('file'):
+                    logging.error('No promocodes left for upsale link %s' % link_id)
+            result.append((link, link_id in created, promo and promo.code))
+        return result
+
+    def _upsert_postgresql(self, user_id, link_ids, defaults):
+        """
+        :return: словарь {id апсейла: id записи} для созданных записей
+        """
+        qn = connection.ops.quote_name
+        columns = [self.model._meta.get_field(name).column for name in ['user', 'upsale'] + sorted(defaults)]
+        values = [defaults[name] for name in sorted(defaults)]
+        sql = 'INSERT INTO {table} ({columns}) VALUES {rows} ON CONFLICT ({user}, {upsale}) DO UPDATE SET {update} ' \
+              'RETURNING id, {upsale}, xmax = 0'.format(
+                  table=qn(self.model._meta.db_table),
+                  columns=', '.join(qn(c) for c in columns),
+                  rows=', '.join(['({})'.format(', '.join(['%s'] * len(columns)))] * len(link_ids)),
+                  user=qn(columns[0]),
+                  upsale=qn(columns[1]),
+                  update=', '.join('{0} = EXCLUDED.{0}'.format(qn(c)) for c in columns[2:]),
+              )
+        params = []
+        for link_id in link_ids:
+            params.extend([user_id, link_id] + values)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            # xmax = 0 только у вставленных, а не обновленных строк
+            return {upsale_id: enrollment_id for enrollment_id, upsale_id, inserted in cursor.fetchall() if inserted}
+
+    def _upsert_generic(self, user_id, link_ids, defaults):
+        """
+        Запись создается в отдельной точке сохранения: если параллельная транзакция уже создала
+        ту же запись, уникальность (user, upsale) дает IntegrityError и запись обновляется
+        :return: словарь {id апсейла: id записи} для созданных записей
+        """
+        created = {}
+        for link_id in link_ids:
+            if self.filter(user__id=user_id, upsale__id=link_id).update(**defaults):
+                continue
+            try:
+                with transaction.atomic():
+                    # bulk_create не вызывает save, промокоды выдает upsert
+                    self.bulk_create([self.model(user_id=user_id, upsale_id=link_id, **defaults)])
+            except IntegrityError:
+                self.filter(user__id=user_id, upsale__id=link_id).update(**defaults)
+                continue
+            created[link_id] = self.filter(user__id=user_id, upsale__id=link_id).values_list('id', flat=True).get()
+        return created
+
+
 class ObjectEnrollment(models.Model):
     class ENROLLMENT_TYPE_CHOICES(object):
         free = 0
@@ -191,50 +358,483 @@ class ObjectEnrollment(models.Model):
     is_active = models.BooleanField(verbose_name=_(u'Статус записи'))
     jsonfield = JSONField(blank=True, null=True)
 
+    objects = ObjectEnrollmentManager()
+
     class Meta:
         verbose_name = _(u'Запись на объект')
         verbose_name_plural = _(u'Записи на объекты')
+        unique_together = ('user', 'upsale')
 
     def __unicode__(self):
         return u'%s - %s' % (self.user, self.upsale)
 
     def save(self, **kwargs):
         """
-        для новых объектов записывается соответствующий промокод из UpsaleLink,
-        если указан файл с промокодами и количество выданных промокодов не исчерпано
+        для новых объектов записывается очередной свободный промокод из пула UpsalePromoCode
+        соответствующего UpsaleLink (пул заполняется командой import_upsale_promocodes)
         """
         if self.id:
             super(ObjectEnrollment, self).save(**kwargs)
             return
         with transaction.atomic():
-            info = UpsaleLink.objects.get(id=self.upsale_id).additional_info or {}
-            promo_file = info.get('promo', {}).get('file')
-            if promo_file:
-                file_path = os.path.join(UpsaleLink.get_promocode_dir(), promo_file)
-                if not os.path.exists(file_path):
-                    logging.error('Upsale promocodes path does not exist: %s' % file_path)
-                try:
-                    line = int(info['promo'].get('already_sent')) + 1
-                except (TypeError, ValueError):
-                    line = 1
-                code = linecache.getline(file_path, line).strip()
-                if not code:
-                    logging.error('Failed to read %s line from %s' % (line, file_path))
-                else:
-                    info['promo']['already_sent'] = line
-                    self.jsonfield = {'promo_code': code}
-                    self.upsale.additional_info = info
-                    self.upsale.save()
+            promo = UpsalePromoCode.objects.claim(self.upsale_id)
+            if promo:
+                self.jsonfield = {'promo_code': promo.code}
+            else:
+                info = UpsaleLink.objects.filter(id=self.upsale_id).values_list('additional_info', flat=True).first()
+                if (info or {}).get('promo', {}).get('file'):
+                    logging.error('No promocodes left for upsale link %s' % self.upsale_id)
             super(ObjectEnrollment, self).save(**kwargs)
+            if promo:
+                UpsalePromoCode.objects.filter(id=promo.id).update(enrollment=self)
 
 
-class OuterPayment(models.Model):
-    data = JSONField(verbose_name=_(u'Данные'))
+class UpsalePromoCodeManager(models.Manager):
+    def claim(self, upsale_link_id):
+        """
+        Выдача одного свободного промокода апсейла. Строка промокода блокируется до конца
+        транзакции, занятые параллельными транзакциями строки пропускаются, поэтому два
+        покупателя не могут получить один и тот же промокод. Вызывать внутри transaction.atomic()
+        :return: UpsalePromoCode или None, если свободных промокодов нет
+        """
+        promos = self.claim_many(upsale_link_id, 1)
+        return promos[0] if promos else None
+
+    def claim_many(self, upsale_link_id, count):
+        """
+        Выдача до count свободных промокодов апсейла одним запросом, см. claim.
+        Вызывать внутри transaction.atomic()
+        :return: список UpsalePromoCode в порядке строк файла, может быть короче count
+        """
+        ids = _select_locked_ids(self.model, 'upsale_link_id = %s AND is_used = %s', [upsale_link_id, False],
+                                 limit=count)
+        if not ids:
+            return []
+        self.filter(id__in=ids).update(is_used=True)
+        return list(self.filter(id__in=ids).order_by('id'))
+
+
+class UpsalePromoCode(models.Model):
+    """
+    Пул промокодов, выдаваемых при записи на апсейл
+    """
+    upsale_link = models.ForeignKey('UpsaleLink', verbose_name=_(u'Апсейл'), related_name='promo_codes')
+    code = models.CharField(max_length=255, verbose_name=_(u'Промокод'))
+    line = models.PositiveIntegerField(verbose_name=_(u'Номер строки в файле промокодов'))
+    is_used = models.BooleanField(default=False, verbose_name=_(u'Промокод выдан'))
+    enrollment = models.OneToOneField('ObjectEnrollment', null=True, blank=True, on_delete=models.SET_NULL,
+                                      verbose_name=_(u'Запись на объект'), related_name='promo_code')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name=_(u'Время создания'))
 
+    objects = UpsalePromoCodeManager()
+
     class Meta:
+        verbose_name = _(u'Промокод апсейла')
+        verbose_name_plural = _(u'Промокоды апсейлов')
+        unique_together = ('upsale_link', 'line')
+        index_together = ('upsale_link', 'is_used')
+
+    def __unicode__(self):
+        return u'%s - %s' % (self.upsale_link_id, self.code)
+
+
+class QueueItemManager(models.Manager):
+    def claim(self, limit=10, lease=600):
+        """
+        Захват до limit записей, готовых к обработке. Захваченные записи переводятся в статус
+        processing на lease секунд: если обработчик не успел отметить результат (например, упал),
+        по истечении этого времени запись снова станет доступна для захвата
+        """
+        now = timezone.now()
+        STATUS = self.model.STATUS
+        with transaction.atomic():
+            ids = _select_locked_ids(self.model, 'status IN (%s, %s) AND next_attempt_at <= %s',
+                                     [STATUS.pending, STATUS.processing, now], limit, order_by='next_attempt_at')
+            if not ids:
+                return []
+            self.filter(id__in=ids).update(status=STATUS.processing, attempts=F('attempts') + 1,
+                                           next_attempt_at=now + timedelta(seconds=lease))
+        return list(self.filter(id__in=ids).order_by('next_attempt_at'))
+
+
+class QueueItem(models.Model):
+    """
+    Абстрактная модель записи, обрабатываемой в фоне с повторными попытками
+    (см. opro_payments.workers)
+    """
+    class STATUS(object):
+        pending = 0
+        processing = 1
+        done = 2
+        failed = 3
+        choices = (
+            (pending, 'Pending'),
+            (processing, 'Processing'),
+            (done, 'Done'),
+            (failed, 'Failed'),
+        )
+
+    # максимальное количество попыток обработки и задержка перед повторной попыткой в секундах,
+    # задержка удваивается с каждой следующей попыткой
+    MAX_ATTEMPTS = 10
+    RETRY_DELAY = 60
+
+    status = models.PositiveSmallIntegerField(verbose_name=_(u'Статус'), choices=STATUS.choices,
+                                              default=STATUS.pending)
+    attempts = models.PositiveSmallIntegerField(verbose_name=_(u'Количество попыток'), default=0)
+    next_attempt_at = models.DateTimeField(verbose_name=_(u'Время следующей попытки'), default=timezone.now)
+    last_error = models.TextField(verbose_name=_(u'Последняя ошибка'), blank=True, default='')
+
+    class Meta:
+        abstract = True
+        index_together = ('status', 'next_attempt_at')
+
+    def mark_done(self):
+        self.status = self.STATUS.done
+        self.last_error = ''
+        type(self).objects.filter(id=self.id).update(status=self.status, last_error=self.last_error)
+
+    def mark_failed(self, error, retry=True):
+        if not retry or self.attempts >= self.MAX_ATTEMPTS:
+            self.status = self.STATUS.failed
+        else:
+            self.status = self.STATUS.pending
+            self.next_attempt_at = timezone.now() + timedelta(seconds=self.RETRY_DELAY * 2 ** max(self.attempts - 1, 0))
+        self.last_error = error
+        type(self).objects.filter(id=self.id).update(status=self.status, next_attempt_at=self.next_attempt_at,
+                                                     last_error=self.last_error)
+
+
+class OuterPaymentManager(QueueItemManager):
+    def get_delivered(self, order_id, body_digest):
+        """
+        ранее полученный платеж с тем же номером заказа или тем же телом запроса
+        """
+        query = models.Q(body_digest=body_digest)
+        if order_id:
+            query |= models.Q(order_id=order_id)
+        return self.filter(query).defer('data').first()
+
+
+class OuterPayment(QueueItem):
+    """
+    Данные оплаты с лендинга, запись по ним выполняет команда process_outer_payments
+    """
+    # повторные попытки нужны только при недоступности внешних сервисов
+    MAX_ATTEMPTS = 5
+
+    data = JSONField(verbose_name=_(u'Данные'))
+    order_id = models.CharField(max_length=64, null=True, blank=True, unique=True,
+                                verbose_name=_(u'Номер заказа'))
+    body_digest = models.CharField(max_length=64, null=True, blank=True, unique=True,
+                                   verbose_name=_(u'Хэш тела запроса'))
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name=_(u'Время создания'))
+
+    objects = OuterPaymentManager()
+
+    class Meta(QueueItem.Meta):
         verbose_name = _(u'Внешний платеж')
         verbose_name_plural = _(u'Внешние платежи')
 
     def __unicode__(self):
         return 'Payment #%s' % self.id
+
+
+class PaymentLookupManager(models.Manager):
+    def remember(self, user, obj, payment):
+        """
+        запоминает payment как последний платеж пользователя за объект obj
+        (CourseSession или EducationalModule)
+        """
+        lookup = dict(user=user, content_type=ContentType.objects.get_for_model(obj), object_id=obj.id)
+        if self.filter(**lookup).update(payment=payment, updated_at=timezone.now()):
+            return
+        try:
+            with transaction.atomic():
+                self.create(payment=payment, **lookup)
+        except IntegrityError:
+            self.filter(**lookup).update(payment=payment, updated_at=timezone.now())
+
+    def get_payment(self, user, obj):
+        """
+        последний платеж пользователя за объект obj или None
+        """
+        lookup = self.filter(
+            user=user,
+            content_type=ContentType.objects.get_for_model(obj),
+            object_id=obj.id
+        ).select_related('payment').first()
+        return lookup and lookup.payment
+
+
+class PaymentLookup(models.Model):
+    """
+    Последний созданный платеж пользователя за сессию или модуль, по которому
+    страницы статуса оплаты находят платеж без поиска по префиксу order_number
+    """
+    user = models.ForeignKey('plp.User', verbose_name=_(u'Пользователь'), related_name='+')
+    content_type = models.ForeignKey(ContentType, verbose_name=_(u'Тип объекта'))
+    object_id = models.PositiveIntegerField(verbose_name=_(u'Объект'))
+    payment = models.ForeignKey('payments.YandexPayment', verbose_name=_(u'Платеж'), related_name='+')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name=_(u'Время обновления'))
+
+    objects = PaymentLookupManager()
+
+    class Meta:
+        unique_together = ('user', 'content_type', 'object_id')
+
+    def __unicode__(self):
+        return u'%s - %s' % (self.user_id, self.payment_id)
+
+
+class PaymentOrderQuerySet(models.QuerySet):
+    def for_object(self, obj):
+        return self.filter(content_type=ContentType.objects.get_for_model(obj), object_id=obj.id)
+
+    def paid(self):
+        return self.filter(is_paid=True)
+
+    def for_payment(self, payment):
+        """
+        заказ платежа с данными, нужными для to_metadata, или None для платежей без заказа
+        """
+        return self.select_related('user', 'gift_receiver').prefetch_related('lines').filter(payment=payment).first()
+
+    def by_key(self, order_key):
+        """
+        заказ с платежом по номеру заказа (см. opro_payments.utils.make_order_key) или None
+        """
+        return self.select_related('payment').filter(order_key=order_key).first()
+
+    def save_for_payment(self, payment, obj, enrollment_type, user, upsale_links, order_key=None,
+                         only_first_course=False, first_session_id=None, gift_receiver=None, promocode=None,
+                         ga_cid=None):
+        """
+        создание заказа для платежа, если его еще нет
+        :param obj: CourseSession или EducationalModule
+        :param enrollment_type: SessionEnrollmentType или EducationalModuleEnrollmentType
+        """
+        order = self.filter(payment=payment).first()
+        if order:
+            return order
+        try:
+            with transaction.atomic():
+                order = self.create(
+                    payment=payment,
+                    order_key=order_key,
+                    user=user,
+                    gift_receiver=gift_receiver,
+                    content_type=ContentType.objects.get_for_model(obj),
+                    object_id=obj.id,
+                    enrollment_type_id=enrollment_type.id,
+                    mode=enrollment_type.mode,
+                    only_first_course=bool(only_first_course),
+                    first_session_id=first_session_id if only_first_course else None,
+                    promocode=promocode or '',
+                    ga_cid=ga_cid or '',
+                )
+                PaymentOrderLine.objects.bulk_create([
+                    PaymentOrderLine(order=order, upsale_link=i, price=i.get_payment_price()) for i in upsale_links
+                ])
+        except IntegrityError:
+            # заказ для платежа создан параллельным запросом, иначе занят номер заказа
+            order = self.filter(payment=payment).first()
+            if order is None:
+                raise
+        return order
+
+
+class PaymentOrder(models.Model):
+    """
+    Заказ, оплачиваемый платежом YandexPayment: покупатель, объект (сессия или модуль), вариант записи
+    и апсейлы (строки заказа PaymentOrderLine). Дублирует metadata платежа в виде колонок, по которым
+    можно делать выборки без разбора json
+    """
+    payment = models.OneToOneField('payments.YandexPayment', verbose_name=_(u'Платеж'), related_name='opro_order')
+    order_key = models.CharField(max_length=64, null=True, blank=True, unique=True,
+                                 verbose_name=_(u'Номер заказа'))
+    user = models.ForeignKey('plp.User', verbose_name=_(u'Пользователь'), related_name='+')
+    gift_receiver = models.ForeignKey('plp.User', verbose_name=_(u'Получатель подарка'), related_name='+',
+                                      null=True, blank=True)
+    content_type = models.ForeignKey(ContentType, verbose_name=_(u'Тип объекта'))
+    object_id = models.PositiveIntegerField(verbose_name=_(u'Объект'))
+    content_object = GenericForeignKey('content_type', 'object_id')
+    enrollment_type_id = models.PositiveIntegerField(verbose_name=_(u'Вариант записи'))
+    mode = models.CharField(max_length=64, verbose_name=_(u'Тип варианта записи'))
+    only_first_course = models.BooleanField(default=False, verbose_name=_(u'Оплата только первого курса модуля'))
+    first_session_id = models.PositiveIntegerField(null=True, blank=True,
+                                                   verbose_name=_(u'Сессия первого курса модуля'))
+    promocode = models.CharField(max_length=255, blank=True, default='', verbose_name=_(u'Промокод'))
+    ga_cid = models.CharField(max_length=64, blank=True, default='', verbose_name=_(u'Идентификатор клиента GA'))
+    is_paid = models.BooleanField(default=False, verbose_name=_(u'Оплачен'))
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name=_(u'Время создания'))
+    paid_at = models.DateTimeField(null=True, blank=True, verbose_name=_(u'Время оплаты'))
+
+    objects = PaymentOrderQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = _(u'Заказ')
+        verbose_name_plural = _(u'Заказы')
+        index_together = [
+            ('content_type', 'object_id', 'is_paid'),
+            ('user', 'is_paid'),
+        ]
+
+    def __unicode__(self):
+        return u'%s - %s' % (self.user_id, self.payment_id)
+
+    @property
+    def is_session(self):
+        return ContentType.objects.get_for_id(self.content_type_id).model == 'coursesession'
+
+    def to_metadata(self):
+        """
+        данные заказа в формате metadata платежа (см. opro_payments.utils.payment_for_user) без
+        данных гугл аналитики
+        """
+        metadata = {
+            'user': {
+                'id': self.user.id,
+                'sso_id': self.user.sso_id,
+                'username': self.user.username,
+                'first_name': self.user.first_name,
+                'email': self.user.email
+            },
+            'upsale_links': [i.upsale_link_id for i in self.lines.all()],
+        }
+        if self.is_session:
+            metadata['new_mode'] = {'id': self.enrollment_type_id, 'mode': self.mode}
+        else:
+            metadata['edmodule'] = {'id': self.object_id, 'mode': self.mode, 'only_first_course': self.only_first_course}
+            if self.only_first_course:
+                metadata['edmodule']['first_session_id'] = self.first_session_id
+        if self.promocode:
+            metadata['promocode'] = self.promocode
+        if self.gift_receiver:
+            metadata['gift_receiver'] = {
+                'id': self.gift_receiver.id,
+                'first_name': self.gift_receiver.first_name,
+                'email': self.gift_receiver.email
+            }
+        return metadata
+
+
+class PaymentOrderLine(models.Model):
+    """
+    Апсейл, оплачиваемый в заказе
+    """
+    order = models.ForeignKey('PaymentOrder', verbose_name=_(u'Заказ'), related_name='lines')
+    upsale_link = models.ForeignKey('UpsaleLink', verbose_name=_(u'Апсейл'), related_name='+')
+    price = models.PositiveIntegerField(null=True, blank=True, verbose_name=_(u'Цена'))
+
+    class Meta:
+        verbose_name = _(u'Строка заказа')
+        verbose_name_plural = _(u'Строки заказов')
+        unique_together = ('order', 'upsale_link')
+
+    def __unicode__(self):
+        return u'%s - %s' % (self.order_id, self.upsale_link_id)
+
+
+class PromoCodeUsage(models.Model):
+    """
+    Учтенные использования промокодов: не больше одного на платеж
+    """
+    payment = models.OneToOneField('payments.YandexPayment', verbose_name=_(u'Платеж'), related_name='+')
+    promocode = models.CharField(max_length=255, verbose_name=_(u'Промокод'))
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name=_(u'Время создания'))
+
+    class Meta:
+        verbose_name = _(u'Использование промокода')
+        verbose_name_plural = _(u'Использования промокодов')
+
+    def __unicode__(self):
+        return u'%s - %s' % (self.promocode, self.payment_id)
+
+
+class PaymentTaskManager(QueueItemManager):
+    def enqueue(self, kind, **payload):
+        """
+        Постановка задачи в очередь. Вызывается в той же транзакции, что и запись данных
+        платежа, поэтому задача появится в очереди только вместе с ними
+        """
+        return self.create(kind=kind, payload=payload)
+
+
+class PaymentTask(QueueItem):
+    """
+    Очередь побочных действий после оплаты (запись в edx, письма, zapier),
+    выполняемых командой process_payment_tasks
+    """
+    class KIND(object):
+        edx_enroll = 'edx_enroll'
+        confirmation_email = 'confirmation_email'
+        edmodule_payed = 'edmodule_payed'
+        gift_sender_email = 'gift_sender_email'
+        zapier = 'zapier'
+
+    kind = models.CharField(max_length=64, verbose_name=_(u'Тип задачи'))
+    payload = JSONField(verbose_name=_(u'Данные'), default=dict)
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name=_(u'Время создания'))
+
+    objects = PaymentTaskManager()
+
+    class Meta(QueueItem.Meta):
+        verbose_name = _(u'Задача обработки платежа')
+        verbose_name_plural = _(u'Задачи обработки платежей')
+
+    def __unicode__(self):
+        return u'%s #%s' % (self.kind, self.id)
+
+
+class GoogleAnalyticsHitManager(QueueItemManager):
+    def batch_ready(self, max_wait):
+        """
+        можно ли отправлять: накопилась полная пачка строк или самая старая строка ждет
+        отправки дольше max_wait секунд
+        """
+        now = timezone.now()
+        STATUS = self.model.STATUS
+        ready = self.filter(status__in=[STATUS.pending, STATUS.processing], next_attempt_at__lte=now)
+        if ready[:self.model.BATCH_SIZE].count() >= self.model.BATCH_SIZE:
+            return True
+        return ready.filter(created_at__lte=now - timedelta(seconds=max_wait)).exists()
+
+
+class GoogleAnalyticsHit(QueueItem):
+    """
+    Очередь строк Measurement Protocol гугл аналитики, которые команда flush_google_analytics
+    отправляет пачками по BATCH_SIZE строк независимо от того, к какому платежу они относятся
+    """
+    # максимальное количество строк в одном запросе к /batch
+    BATCH_SIZE = 20
+    # гугл аналитика отбрасывает строки с временем в очереди (qt) больше 4 часов
+    MAX_AGE = 4 * 60 * 60
+    # сколько секунд строка может ждать, пока накопится полная пачка
+    MAX_WAIT = 60
+
+    payment_id = models.PositiveIntegerField(verbose_name=_(u'id платежа'), null=True, blank=True)
+    data = models.TextField(verbose_name=_(u'Данные'))
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name=_(u'Время создания'))
+
+    objects = GoogleAnalyticsHitManager()
+
+    class Meta(QueueItem.Meta):
+        verbose_name = _(u'Данные гугл аналитики')
+        verbose_name_plural = _(u'Данные гугл аналитики')
+
+    def __unicode__(self):
+        return u'%s #%s' % (self.payment_id, self.id)
+
+    def get_age(self, now=None):
+        """
+        время в очереди в секундах
+        """
+        return ((now or timezone.now()) - self.created_at).total_seconds()
+
+    def mark_failed(self, error, retry=True):
+        # повторная попытка позже MAX_AGE бессмысленна, строка все равно будет отброшена
+        delay = self.RETRY_DELAY * 2 ** max(self.attempts - 1, 0)
+        if self.get_age() + delay >= self.MAX_AGE:
+            retry = False
+        super(GoogleAnalyticsHit, self).mark_failed(error, retry=retry)
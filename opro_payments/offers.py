@@ -0,0 +1,65 @@
+# coding: utf-8
+
+import hashlib
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models
+from django.utils import timezone
+from plp.models import Course
+from plp_edmodule.models import EducationalModule
+from .caching import get_or_set
+
+# пространство имен кэша, инвалидируется при изменении курсов и модулей (см. opro_payments.signals)
+CACHE_NAMESPACE = 'offer_text'
+# время кэширования страницы оферты браузером и CDN в секундах
+OFFER_MAX_AGE = getattr(settings, 'OPRO_PAYMENTS_OFFER_MAX_AGE', 60 * 60)
+
+
+def get_offer(offer_type, obj_id):
+    """
+    текст оферты курса или модуля: словарь {'found': bool, 'content': текст, 'etag': хэш текста,
+    'last_modified': время изменения текста (см. _modified_at)}
+    """
+    def _build():
+        model = Course if offer_type == 'course' else EducationalModule
+        obj = model.objects.filter(id=obj_id).first()
+        if not obj:
+            return {'found': False}
+        content = obj.offer_text or u''
+        etag = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        return {
+            'found': True,
+            'content': content,
+            'etag': etag,
+            'last_modified': _modified_at(obj, etag),
+        }
+    return get_or_set(CACHE_NAMESPACE, [offer_type, obj_id], _build)
+
+
+def _modified_at(obj, etag):
+    """
+    время изменения объекта из его поля с auto_now, а если у модели такого поля нет - время, когда
+    текст с этим etag был впервые отдан. Не меняется при перестроении записи кэша, поэтому условные
+    запросы не промахиваются после инвалидации
+    """
+    for field in obj._meta.fields:
+        if isinstance(field, models.DateTimeField) and field.auto_now and getattr(obj, field.attname):
+            return getattr(obj, field.attname).replace(microsecond=0)
+    key = 'opro_payments:%s:modified:%s:%s:%s' % (CACHE_NAMESPACE, obj._meta.model_name, obj.id, etag)
+    cache.add(key, timezone.now().replace(microsecond=0), None)
+    return cache.get(key) or timezone.now().replace(microsecond=0)
+
+
+def offer_etag(request, offer_type=None, obj_id=None):
+    """
+    etag страницы: хэш текста и пользователь, страница авторизованного пользователя отличается
+    от анонимной
+    """
+    etag = get_offer(offer_type, obj_id).get('etag')
+    if etag and request.user.is_authenticated():
+        return '%s-%s' % (etag, request.user.id)
+    return etag
+
+
+def offer_last_modified(request, offer_type=None, obj_id=None):
+    return get_offer(offer_type, obj_id).get('last_modified')
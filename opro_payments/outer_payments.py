@@ -0,0 +1,253 @@
+# coding: utf-8
+
+import logging
+import re
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.template.loader import get_template
+from django.utils.translation import ugettext as _
+import requests
+from emails.django import Message
+from plp.models import User
+from .entitlements import get_paid_upsale_ids, has_paid_session, has_paid_module
+from .models import UpsaleLink
+from .sku_catalog import resolve_course, resolve_module
+from .sso import register_users
+from .utils import client, outer_payment_for_user
+from .workers import PermanentError
+
+
+class OuterPaymentError(PermanentError):
+    """
+    ошибка в данных внешнего платежа, запись на курс/специализацию/апсейл не происходит
+    """
+
+
+class OuterPaymentTemporaryError(Exception):
+    """
+    ошибка обработки внешнего платежа, после которой обработка будет повторена
+    """
+
+
+def process_outer_payment(outer_payment):
+    OuterPaymentProcessor(outer_payment).process()
+
+
+class OuterPaymentProcessor(object):
+    """
+    Запись на курсы/специализации/апсейлы по данным оплаты с лендинга (OuterPayment)
+    """
+    DEBUG_EMAIL_TO = getattr(settings, 'ENROLLMENT_API_DEBUG_EMAIL', 'debug@openprofession.ru')
+
+    def __init__(self, outer_payment):
+        self.outer_payment = outer_payment
+        # платный вариант записи на объект покупки, определяется в items_to_buy
+        self.new_mode = None
+
+    def process(self):
+        outer_payment = self.outer_payment
+        data = outer_payment.data or {}
+        sku, email = '', ''
+        warnings = []
+        new_user_created = False
+        # при возникновении исключений OuterPaymentError на этом шаге запись на
+        # курс/специализацию/апсейл не происходит
+        try:
+            email = data.get('order', {}).get('customer', {}).get('email')
+            if not email:
+                raise OuterPaymentError(u'Данные не содержат email')
+            sku = data.get('order', {}).get('line_items', [])
+            if len(sku) != 1:
+                raise OuterPaymentError(_(u'Ожидается 1 элемент в line_items, пришло %s') % len(sku))
+            elif not sku[0].get('sku'):
+                raise OuterPaymentError(u'Данные не содержат sku')
+            # разделитель +
+            sku = sku[0]['sku']
+            sku_parts = self.parse_sku(sku)
+            try:
+                validate_email(email)
+            except ValidationError:
+                raise OuterPaymentError(u'Задан невалидный емейл %s' % email)
+            user = User.objects.filter(email=email).first()
+            obj, upsales, log = self.items_to_buy(sku_parts, user)
+            warnings.extend(log)
+            if not user:
+                user = self.create_user(email)
+                new_user_created = True
+        except OuterPaymentError as e:
+            logging.error(u'outer payment %s error: %s' % (outer_payment.id, e))
+            if client:
+                client.captureMessage('outer payment error', extra={
+                    'exception': u'%s' % e,
+                    'request_data': data,
+                })
+            self.send_debug_mail(error=u'%s' % e, sku=sku, email=email, outer_payment=outer_payment)
+            raise
+
+        # далее записываем пользователя на те объекты из sku, на которые он не был записан
+        if not new_user_created:
+            warnings.extend(self.check_items_for_user(user, sku_parts, obj, upsales))
+        mode_data = {'id': self.new_mode.id, 'mode': self.new_mode.mode}
+        if sku_parts['type'] == 'edmodule':
+            mode_data['only_first_course'] = sku_parts['only_first_course']
+            if sku_parts['only_first_course']:
+                mode_data['first_session_id'] = sku_parts['first_session_id']
+        outer_payment_for_user(user, sku_parts, mode_data, upsales)
+        self.send_debug_mail(warnings=warnings, sku=sku, email=email, outer_payment=outer_payment)
+
+    def send_debug_mail(self, **kwargs):
+        msg = Message(
+            subject=get_template('opro_payments/emails/outer_payment_debug_subject.txt'),
+            html=get_template('opro_payments/emails/outer_payment_debug_message.html'),
+            mail_from=settings.EMAIL_NOTIFICATIONS_FROM,
+            mail_to=self.DEBUG_EMAIL_TO
+        )
+        try:
+            msg.send(context={'context': kwargs, 'request': None})
+        except Exception as e:
+            logging.error('Failed to send outer payment debug email: %s' % e)
+            if client:
+                client.captureMessage('Failed to send outer payment debug email', extra={
+                    'exception': str(e),
+                    'email_context': kwargs,
+                })
+
+    def create_user(self, email):
+        post_data = {'emails': [email]}
+        try:
+            logging.info('Request SSO registration with data=%s' % post_data)
+            sso_data = register_users(post_data['emails'])
+            assert len(sso_data) == 1 and 'username' in sso_data[0], 'SSO returned %s' % sso_data
+            return User.objects.get(username=sso_data[0]['username'])
+        except (requests.RequestException, AssertionError, ValueError, User.DoesNotExist) as exc:
+            error_dict = {'data': post_data, 'exception': str(exc)}
+            if client:
+                client.captureMessage('error creating user', extra=error_dict)
+            logging.error('error creating user: data={data}, exception: {exception}'.format(**error_dict))
+            raise OuterPaymentTemporaryError(u'Не удалось создать пользователя %s: %s' % (email, str(exc)))
+
+    def parse_sku(self, sku):
+        parts = sku.split('+')
+        result = {}
+        if len(parts) < 3:
+            raise OuterPaymentError(
+                u'Получен некорректный sku %s, sku должен состоять как минимум из 3 частей' % sku)
+        if parts[0] == 'course':
+            result.update({
+                'type': 'course',
+                'slug': parts[2],
+                'uni_slug': parts[1],
+            })
+        elif parts[0] == 'edmodule':
+            if parts[2] not in ['all', 'one']:
+                raise OuterPaymentError(
+                    u'Получен некорректный sku %s, 3 часть sku при записи на специализацию должна быть all или one'
+                    % sku)
+            only_first_course = parts[2] == 'one'
+            result.update({
+                'type': 'edmodule',
+                'slug': parts[1],
+                'only_first_course': only_first_course,
+            })
+        else:
+            raise OuterPaymentError(
+                u'Получен некорректный sku %s, 1 часть sku должна быть course или edmodule' % sku)
+        upsale_ids = []
+        for p in parts[3:]:
+            upsale_id = re.match(r'^upsalelink(\d+)$', p)
+            if not upsale_id:
+                raise OuterPaymentError(u'Получен некорректный sku %s, не удалось распарсить апсейлы' % sku)
+            upsale_ids.append(int(upsale_id.group(1)))
+        result['upsales'] = upsale_ids
+        return result
+
+    def check_items_for_user(self, user, sku_parts, obj, upsales):
+        """
+        проверка наличия у пользователя уже оплаченных курсов/апсейлов/специализаций
+        """
+        log = []
+        if sku_parts['type'] == 'course':
+            if has_paid_session(user, obj.id):
+                log.append(_(u'Пользователь %s уже оплачивал курс %s') % (user.email, obj.get_absolute_slug_v1()))
+                logging.error('OuterPaymentProcessor: user %s already paid for course %s' %
+                              (user, obj.get_absolute_slug_v1()))
+        elif sku_parts['type'] == 'edmodule':
+            if has_paid_module(user, obj.id):
+                log.append(_(u'Пользователь %s уже оплачивал специализацию %s') % (user.email, obj.code))
+                logging.error('OuterPaymentProcessor: user %s already paid for edmodule %s' % (user, obj.code))
+
+        paid_upsales = get_paid_upsale_ids(user, upsales)
+        if paid_upsales:
+            log.append(_(u'Пользователь уже оплачивал апсейл(ы): %s') %
+                       ', '.join(map(lambda x: str(x), paid_upsales)))
+            logging.error('OuterPaymentProcessor: user %s already paid for upsales %s'
+                          % (user, ', '.join(map(lambda x: str(x), paid_upsales))))
+        return log
+
+    def items_to_buy(self, sku, user):
+        """
+        выбор объектов для покупки
+        """
+        if sku['type'] == 'course':
+            resolved = resolve_course(sku['uni_slug'], sku['slug'])
+            if not resolved['found']:
+                raise OuterPaymentError(u'курс %(uni_slug)s+%(slug)s не найден' % sku)
+            obj = resolved['session']
+            if not obj:
+                raise OuterPaymentError(u'курс %s не имеет открытых сессий' % resolved['course_name'])
+            if not resolved['verified']:
+                raise OuterPaymentError(u'у сессии %s нет платного варианта записи' % obj)
+            if obj.allow_enrollments():
+                raise OuterPaymentError(u'сессия %s не доступна для записи' % obj)
+        else:
+            resolved = resolve_module(sku['slug'])
+            if not resolved['found']:
+                raise OuterPaymentError(u'модуль %(slug)s не найден' % sku)
+            obj = resolved['module']
+            if not resolved['verified']:
+                raise OuterPaymentError(u'у модуля %s нет платного варианта записи' % obj)
+            if sku['only_first_course']:
+                if not user:
+                    user = AnonymousUser()
+                else:
+                    reason = obj.get_enrollment_reason_for_user(user)
+                    if reason:
+                        if reason.full_paid:
+                            msg = _(u'Пользователь %s уже оплачивал полностью специализацию %s') % \
+                                (user.email, obj.code)
+                        else:
+                            msg = _(u'Пользователь %s уже оплачивал частично специализацию %s') % \
+                                (user.email, obj.code)
+                        raise OuterPaymentError(msg)
+                first_session = obj.get_first_session_to_buy(user)
+                if not first_session:
+                    if user.is_authenticated():
+                        raise OuterPaymentError(
+                            _(u'не удалось выбрать курс для частичной оплаты специализации %s для пользователя %s') %
+                            (obj.code, user.username)
+                        )
+                    else:
+                        raise OuterPaymentError(
+                            _(u'не удалось выбрать курс для частичной оплаты специализации %s') %
+                            obj.code
+                        )
+                sku['first_session_id'] = first_session[0].id
+        upsales = UpsaleLink.objects.filter(id__in=sku['upsales'])
+        object_upsale_ids = set(UpsaleLink.objects.for_object(obj).filter(
+            id__in=sku['upsales']).values_list('id', flat=True))
+        log, available_upsales = [], []
+        for u in upsales:
+            if not u.is_active:
+                log.append(_(u'Аспейл #%s не активен') % u.id)
+            elif u.id not in object_upsale_ids:
+                log.append(_(u'Аспейл #%s не относится к выбранному объекту %s') % (u.id, obj))
+            else:
+                available_upsales.append(u.id)
+        not_found_upsales = set([long(i) for i in sku['upsales']]) - set([i.id for i in upsales])
+        if not_found_upsales:
+            log.append(_(u'Апсейлы со следующими id не найдены: %s') %
+                       ', '.join(map(lambda x: str(x), not_found_upsales)))
+        self.new_mode = resolved['verified']
+        return obj, available_upsales, log
@@ -0,0 +1,58 @@
+# coding: utf-8
+
+import hashlib
+import json
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import get_language
+from plp_edmodule.models import PromoCode
+from .caching import make_key, bump_version_on_commit
+
+# пространство имен кэша, инвалидируется при изменении промокодов, их использовании и изменении цен
+# (см. opro_payments.signals, opro_payments.utils.increase_promocode_usage)
+CACHE_NAMESPACE = 'promocodes'
+# срок действия промокода зависит от времени, поэтому результат проверки хранится недолго
+CACHE_TIMEOUT = getattr(settings, 'OPRO_PAYMENTS_PROMOCODE_CACHE_TIMEOUT', 5 * 60)
+NOT_FOUND_TIMEOUT = getattr(settings, 'OPRO_PAYMENTS_PROMOCODE_NOT_FOUND_TIMEOUT', 60)
+
+NOT_FOUND = 'not_found'
+
+
+def _make_key(promocode, product_id, product_type, session_id, only_first_course):
+    """
+    ключ кэша проверки промокода. Промокод и параметры продукта приходят от пользователя и могут
+    содержать пробелы, управляющие символы или быть слишком длинными для ключа memcached, поэтому
+    в ключ входит их хэш. Результат содержит переведенные сообщения, поэтому в ключ входит язык
+    """
+    params = json.dumps([promocode, product_type, product_id, session_id, bool(only_first_course)])
+    return make_key(CACHE_NAMESPACE, hashlib.sha1(params).hexdigest(), get_language())
+
+
+def check_promocode(promocode, product_id, product_type, session_id, only_first_course):
+    """
+    Проверка промокода для продукта и расчет цены со скидкой
+    :return: NOT_FOUND, если промокода нет, иначе результат PromoCode.validate с ненулевым статусом
+        или результат PromoCode.calculate
+    """
+    key = _make_key(promocode, product_id, product_type, session_id, only_first_course)
+    result = cache.get(key)
+    if result is not None:
+        return result
+    try:
+        obj = PromoCode.objects.get(code=promocode)
+    except PromoCode.DoesNotExist:
+        cache.set(key, NOT_FOUND, NOT_FOUND_TIMEOUT)
+        return NOT_FOUND
+    result = obj.validate(int(product_id), product_type)
+    if result['status'] == 0:
+        result = obj.calculate(product_id=product_id, session_id=session_id, only_first_course=only_first_course)
+    cache.set(key, result, CACHE_TIMEOUT)
+    return result
+
+
+def invalidate_promocodes():
+    """
+    сброс кэша проверок после фиксации транзакции, иначе параллельная проверка может закэшировать
+    незафиксированный счетчик использований под новой версией
+    """
+    bump_version_on_commit(CACHE_NAMESPACE)
@@ -0,0 +1,94 @@
+# coding: utf-8
+
+import hashlib
+import logging
+import time
+from functools import wraps
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.encoding import force_bytes
+
+# {имя ограничения: (запросов в минуту, максимальный всплеск)}, рекомендуемые значения - в README.
+# Ограничения включаются только настройкой OPRO_PAYMENTS_RATE_LIMITS: за прокси без
+# OPRO_PAYMENTS_RATE_LIMIT_TRUST_FORWARDED все клиенты имеют один REMOTE_ADDR и делили бы одну корзину
+RATE_LIMITS = getattr(settings, 'OPRO_PAYMENTS_RATE_LIMITS', {})
+
+
+def _bucket_key(name, kind, value):
+    # значение (ip из заголовка, cookie сессии) приходит от клиента и не должно попадать в ключ как есть
+    return 'opro_payments:ratelimit:%s:%s:%s' % (name, kind, hashlib.sha1(force_bytes(value)).hexdigest())
+
+
+def _counter_key(name):
+    return 'opro_payments:ratelimit:%s:rejected' % name
+
+
+def take_token(key, per_minute, burst):
+    """
+    Token bucket в кэше: корзина на burst токенов пополняется со скоростью per_minute токенов в минуту,
+    каждый запрос забирает один токен. Чтение и запись состояния не атомарны, при одновременных
+    запросах лимит может быть превышен на несколько запросов
+    :return: True, если токен есть и запрос можно выполнять
+    """
+    now = time.time()
+    tokens, updated = cache.get(key) or (burst, now)
+    tokens = min(burst, tokens + (now - updated) * per_minute / 60.0)
+    allowed = tokens >= 1
+    if allowed:
+        tokens -= 1
+    # корзина, не тронутая дольше времени полного пополнения, не отличается от новой
+    cache.set(key, (tokens, now), int(burst * 60.0 / per_minute) + 1)
+    return allowed
+
+
+def get_client_ip(request):
+    if getattr(settings, 'OPRO_PAYMENTS_RATE_LIMIT_TRUST_FORWARDED', False):
+        forwarded = request.META.get('HTTP_X_FORWARDED_FOR', '')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def is_allowed(request, name):
+    """
+    проверка ограничения name для ip-адреса и сессии клиента, сессия берется из cookie
+    без обращения к хранилищу сессий. Не заданные в настройках ограничения не проверяются
+    """
+    if name not in RATE_LIMITS:
+        return True
+    per_minute, burst = RATE_LIMITS[name]
+    keys = [_bucket_key(name, 'ip', get_client_ip(request))]
+    session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    if session_key:
+        keys.append(_bucket_key(name, 'session', session_key))
+    return all([take_token(key, per_minute, burst) for key in keys])
+
+
+def rate_limit(name, methods=('POST', )):
+    """
+    Декоратор view: при превышении ограничения name запросы methods получают ответ 429
+    до выполнения view
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method in methods and not is_allowed(request, name):
+                cache.add(_counter_key(name), 0, None)
+                try:
+                    cache.incr(_counter_key(name))
+                except ValueError:
+                    pass
+                logging.warning('Rate limit %s exceeded for %s' % (name, get_client_ip(request)))
+                return HttpResponse('Too many requests', status=429, content_type='text/plain')
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_rejected_counts():
+    """
+    количество отклоненных запросов по каждому ограничению
+    """
+    counts = cache.get_many([_counter_key(name) for name in RATE_LIMITS])
+    return {name: counts.get(_counter_key(name), 0) for name in RATE_LIMITS}
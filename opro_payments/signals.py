@@ -0,0 +1,53 @@
+# coding: utf-8
+
+from django.db.models.signals import post_save, post_delete
+from plp.models import Course, CourseSession, SessionEnrollmentType, EnrollmentReason, Participant
+from plp_edmodule.models import EducationalModule, EducationalModuleEnrollmentType, \
+    EducationalModuleEnrollmentReason, EducationalModuleEnrollment, PromoCode
+from .caching import bump_version_on_commit
+from .entitlements import invalidate_entitlements
+from .models import ObjectEnrollment
+from . import ga_catalog, sku_catalog, promocodes, offers
+
+# модели каталога курсов и модулей, от которых зависят кэши каталога
+CATALOG_MODELS = (Course, CourseSession, SessionEnrollmentType, EducationalModule, EducationalModuleEnrollmentType)
+
+
+def connect_invalidation(namespace, models):
+    """
+    инвалидация пространства имен кэша namespace после фиксации транзакции, в которой сохранены
+    или удалены объекты models
+    """
+    def invalidate(sender, **kwargs):
+        bump_version_on_commit(namespace)
+
+    for model in models:
+        for signal in (post_save, post_delete):
+            signal.connect(invalidate, sender=model, weak=False, dispatch_uid='opro_payments_%s' % namespace)
+
+
+connect_invalidation(ga_catalog.CACHE_NAMESPACE, CATALOG_MODELS)
+connect_invalidation(sku_catalog.CACHE_NAMESPACE, CATALOG_MODELS)
+# цена со скидкой зависит от цен вариантов записи
+connect_invalidation(promocodes.CACHE_NAMESPACE, CATALOG_MODELS + (PromoCode, ))
+connect_invalidation(offers.CACHE_NAMESPACE, (Course, EducationalModule))
+
+
+def invalidate_object_enrollment(sender, instance, **kwargs):
+    invalidate_entitlements(instance.user_id)
+
+
+def invalidate_enrollment_reason(sender, instance, **kwargs):
+    invalidate_entitlements(*Participant.objects.filter(id=instance.participant_id).values_list('user_id', flat=True))
+
+
+def invalidate_module_enrollment_reason(sender, instance, **kwargs):
+    invalidate_entitlements(*EducationalModuleEnrollment.objects.filter(id=instance.enrollment_id)
+                            .values_list('user_id', flat=True))
+
+
+for model, receiver in ((ObjectEnrollment, invalidate_object_enrollment),
+                        (EnrollmentReason, invalidate_enrollment_reason),
+                        (EducationalModuleEnrollmentReason, invalidate_module_enrollment_reason)):
+    for signal in (post_save, post_delete):
+        signal.connect(receiver, sender=model, dispatch_uid='opro_payments_entitlements')
@@ -0,0 +1,68 @@
+# coding: utf-8
+
+from django.conf import settings
+from plp.models import Course, CourseSession, SessionEnrollmentType
+from plp_edmodule.models import EducationalModule, EducationalModuleEnrollmentType
+from .caching import get_or_set
+
+# пространство имен кэша, инвалидируется при изменении курсов, сессий, модулей и их вариантов записи
+# (см. opro_payments.signals)
+CACHE_NAMESPACE = 'sku_catalog'
+# ближайшая сессия курса меняется со временем, поэтому записи живут недолго. В кэше хранятся только id,
+# объекты выбираются по первичному ключу: сериализованные модели не переживают изменения полей при выкладке
+CACHE_TIMEOUT = getattr(settings, 'OPRO_PAYMENTS_SKU_CATALOG_TIMEOUT', 5 * 60)
+
+
+def resolve_course(uni_slug, slug):
+    """
+    ближайшая сессия курса из sku и ее платный вариант записи
+    :return: словарь {'found': bool, 'course_name': str, 'session': CourseSession или None,
+        'verified': SessionEnrollmentType или None}
+    """
+    def _build():
+        course = Course.objects.filter(slug=slug, university__slug=uni_slug).first()
+        if not course:
+            return {'found': False}
+        session = course.next_session
+        verified = session and session.get_verified_mode_enrollment_type()
+        return {
+            'found': True,
+            'course_name': u'%s' % course,
+            'session_id': session and session.id,
+            'verified_id': verified and verified.id,
+        }
+    ids = get_or_set(CACHE_NAMESPACE, ['course_ids', uni_slug, slug], _build, timeout=CACHE_TIMEOUT)
+    if not ids['found']:
+        return ids
+    return {
+        'found': True,
+        'course_name': ids['course_name'],
+        'session': ids['session_id'] and CourseSession.objects.filter(id=ids['session_id']).first(),
+        'verified': ids['verified_id'] and SessionEnrollmentType.objects.filter(id=ids['verified_id']).first(),
+    }
+
+
+def resolve_module(code):
+    """
+    модуль из sku и его платный вариант записи
+    :return: словарь {'found': bool, 'module': EducationalModule, 'verified': EducationalModuleEnrollmentType или None}
+    """
+    def _build():
+        module = EducationalModule.objects.filter(code=code).first()
+        if not module:
+            return {'found': False}
+        verified = module.get_verified_mode_enrollment_type()
+        return {
+            'found': True,
+            'module_id': module.id,
+            'verified_id': verified and verified.id,
+        }
+    ids = get_or_set(CACHE_NAMESPACE, ['edmodule_ids', code], _build, timeout=CACHE_TIMEOUT)
+    module = ids['found'] and EducationalModule.objects.filter(id=ids['module_id']).first()
+    if not module:
+        return {'found': False}
+    return {
+        'found': True,
+        'module': module,
+        'verified': ids['verified_id'] and EducationalModuleEnrollmentType.objects.filter(id=ids['verified_id']).first(),
+    }
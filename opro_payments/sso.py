@@ -0,0 +1,94 @@
+# coding: utf-8
+
+import re
+import threading
+from django.conf import settings
+import requests
+from requests.adapters import HTTPAdapter
+from plp.models import User
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Общая для процесса http-сессия к SSO: соединения переиспользуются (keep-alive)
+    вместо установки нового TCP/TLS соединения на каждый запрос
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                pool_size = getattr(settings, 'OPRO_PAYMENTS_SSO_POOL_SIZE', 10)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+
+def register_users(emails, lazy_send_mail=False):
+    """
+    Регистрация пользователей в SSO
+    :return: список данных пользователей из ответа SSO
+    """
+    r = get_session().post(
+        '{}/users/simple_mass_registration/'.format(settings.SSO_NPOED_URL),
+        json={'emails': emails, 'lazy_send_mail': lazy_send_mail},
+        headers={'X-SSO-Api-Key': settings.SSO_API_KEY},
+        timeout=settings.CONNECTION_TIMEOUT
+    )
+    r.raise_for_status()
+    return r.json().get('users', [])
+
+
+def get_or_create_users(users):
+    """
+    Возвращает пользователей, отсутствующих - создает через SSO.
+    Все новые пользователи регистрируются одним запросом к SSO, локальные пользователи выбираются
+    одним запросом к бд. SSO принимает один флаг lazy_send_mail на запрос, поэтому если он задан
+    хотя бы для одного нового пользователя, письма о регистрации откладываются для всех
+    (например, для отправителя и получателя подарка).
+    Для прохождения упрощенного сценарция задает пользователям переданное имя и пустую фамилию
+    :param users: список словарей вида {'first_name': str, 'email': str, 'lazy_send_mail': bool}
+    :return: список User в порядке users
+    """
+    found = {u.email: u for u in User.objects.filter(email__in=[i['email'] for i in users])}
+
+    to_register, lazy_send_mail = [], False
+    for i in users:
+        if i['email'] not in found and i['email'] not in to_register:
+            to_register.append(i['email'])
+            lazy_send_mail = lazy_send_mail or bool(i.get('lazy_send_mail'))
+    if to_register:
+        sso_emails = {}
+        for data in register_users(to_register, lazy_send_mail=lazy_send_mail):
+            sso_emails[data['email'].lower()] = data['email']
+        registered = {u.email: u for u in User.objects.filter(email__in=sso_emails.values())}
+        for email in to_register:
+            found[email] = registered[sso_emails[email.lower()]]
+
+    result = []
+    for i in users:
+        user = found[i['email']]
+        fields = {
+            'username': re.sub('[^a-zA-Z0-9]', '_', user.email),
+            'first_name': i['first_name'],
+            'last_name': ' ',
+        }
+        changed = [k for k, v in fields.items() if getattr(user, k) != v]
+        if changed:
+            for k in changed:
+                setattr(user, k, fields[k])
+            user.save(update_fields=changed)
+        result.append(user)
+    return result
+
+
+def get_or_create_user(first_name, email, lazy_send_mail=False):
+    """
+    Возвращает пользователя, если его нет - создает, см. get_or_create_users
+    """
+    return get_or_create_users([{'first_name': first_name, 'email': email, 'lazy_send_mail': lazy_send_mail}])[0]
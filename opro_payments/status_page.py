@@ -0,0 +1,88 @@
+# coding: utf-8
+
+import logging
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+from plp.models import CourseSession
+from .caching import make_key, CACHE_TIMEOUT
+from .models import UpsaleLink, ObjectEnrollment, PaymentOrder
+from .utils import client, get_latest_payment, get_payment_metadata, increase_promocode_usage
+
+# записи не инвалидируются: после оплаты данные страницы статуса платежа не меняются
+CACHE_NAMESPACE = 'payment_status'
+
+
+def get_status_context(payment_type, obj, user, status):
+    """
+    Контекст страниц payment success/fail, общий для оплаты из профиля, с лэндинга и в подарок.
+    Для оплаченного платежа данные страницы успешной оплаты (промокоды, апсейлы, первая сессия модуля)
+    кэшируются по id платежа, поэтому обновление страницы не требует запросов к записям на апсейлы.
+    Данные кэшируются только после обработки оплаты: яндекс-касса отмечает платеж оплаченным раньше,
+    чем создаются записи на апсейлы и выдаются промокоды
+    """
+    if payment_type == 'session':
+        context = {'session': obj, 'object': obj.course}
+    else:
+        context = {'module': obj, 'object': obj}
+    if status != 'success':
+        return context
+
+    # считаем, что к моменту перехода на страницу подтверждения оплаты, нам пришел ответ от Яндекса
+    # и были созданы "записи на объекты", иначе пользователь не увидит промокоды
+    payment = get_latest_payment(user, obj)
+    if not payment:
+        raise Http404
+    if payment.is_payed:
+        key = make_key(CACHE_NAMESPACE, payment.id, user.id)
+        data = cache.get(key)
+        if data is None:
+            data = _build_success_data(payment, user)
+            if _is_processed(payment, user, data):
+                cache.set(key, data, CACHE_TIMEOUT)
+    else:
+        logging.error('User %s was redirected to successfull payment page before payment %s was processed' % (
+            user.id, payment.id
+        ))
+        if client:
+            client.captureMessage('User was redirected to successfull payment page before payment was processed',
+                                  extra={'user_id': user.id, 'payment_id': payment.id})
+        data = _build_success_data(payment, user)
+    context.update(data)
+    context['shop_url'] = getattr(settings, 'OPRO_PAYMENT_SHOP_URL', '')
+    return context
+
+
+def _is_processed(payment, user, data):
+    """
+    созданы ли записи по оплаченному платежу. Заказ отмечается оплаченным в той же транзакции,
+    в которой создаются записи на апсейлы; для платежей без заказа записи проверяются напрямую
+    """
+    is_paid = PaymentOrder.objects.filter(payment=payment).values_list('is_paid', flat=True).first()
+    if is_paid is not None:
+        return is_paid
+    upsale_link_ids = [i.id for i in data['upsale_links']]
+    return ObjectEnrollment.objects.filter(user=user, upsale__id__in=upsale_link_ids).count() == len(upsale_link_ids)
+
+
+def _build_success_data(payment, user):
+    metadata = get_payment_metadata(payment)
+    upsale_links = metadata.get('upsale_links', [])
+    promocodes = []
+    object_enrollments = ObjectEnrollment.objects.filter(user=user, upsale__id__in=upsale_links) \
+        .select_related('upsale__upsale')
+    for enrollment in object_enrollments:
+        promo = (enrollment.jsonfield or {}).get('promo_code')
+        if promo:
+            promocodes.append((enrollment.upsale.upsale.title, promo))
+    data = {
+        'promocodes': promocodes,
+        'upsale_links': list(UpsaleLink.objects.filter(id__in=upsale_links).select_related('upsale')),
+    }
+    if metadata.get('edmodule', {}).get('first_session_id'):
+        data['first_session'] = get_object_or_404(CourseSession.objects.select_related('course'),
+                                                  id=metadata['edmodule']['first_session_id'])
+    # повторные вызовы для того же платежа счетчик промокода не меняют
+    increase_promocode_usage(metadata.get('promocode', None), payment.id)
+    return data
@@ -0,0 +1,108 @@
+# coding: utf-8
+
+import logging
+from django.core.mail import send_mail
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.translation import ugettext as _
+from payments.models import YandexPayment
+from plp.models import EnrollmentReason, Participant, User, CourseSession
+from plp.utils.edx_enrollment import EDXEnrollmentError, EDXEnrollment
+from plp.utils.webhook import ZapierInformer
+from plp_edmodule.models import EducationalModuleEnrollmentReason, EducationalModule
+from plp_edmodule.signals import edmodule_payed
+from .models import PaymentTask, UpsaleLink
+from .utils import client
+
+HANDLERS = {}
+
+
+def handler(kind):
+    def decorator(func):
+        HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+def _promocode_pairs(promocodes):
+    """
+    пары (название апсейла, промокод): после сохранения в JSONField кортежи становятся списками
+    """
+    return [tuple(i) for i in promocodes or []]
+
+
+def run_task(task):
+    """
+    Выполнение задачи PaymentTask. Исключение в обработчике означает, что задача
+    будет повторена позже (см. opro_payments.workers.process_item)
+    """
+    HANDLERS[task.kind](**task.payload)
+
+
+@handler(PaymentTask.KIND.edx_enroll)
+def edx_enroll(reason_id):
+    reason = EnrollmentReason.objects.select_related(
+        'participant__user', 'session_enrollment_type__session').get(id=reason_id)
+    session = reason.session_enrollment_type.session
+    user = reason.participant.user
+    try:
+        EDXEnrollment(edx_url=session.get_edx_url()).enroll(
+            course_id=session.get_absolute_slug_v1(),
+            user=user.username,
+            mode=reason.session_enrollment_type.mode
+        )
+    except EDXEnrollmentError as e:
+        logging.error('Failed to push verified enrollment %s to edx for user %s: %s' % (
+            session, user, e
+        ))
+        if client:
+            client.captureMessage('Failed to push verified enrollment to edx', extra={
+                'user': user.username,
+                'session_id': session.id,
+                'error': str(e)
+            })
+        raise
+    Participant.objects.filter(id=reason.participant_id).update(sent_to_edx=timezone.now())
+
+
+@handler(PaymentTask.KIND.confirmation_email)
+def confirmation_email(reason_id, upsale_links=None, promocodes=None, paid_for_session=None):
+    reason = EnrollmentReason.objects.get(id=reason_id)
+    if upsale_links is None:
+        reason.send_confirmation_email()
+    else:
+        reason.send_confirmation_email(upsales=UpsaleLink.objects.filter(id__in=upsale_links),
+                                       promocodes=_promocode_pairs(promocodes), paid_for_session=paid_for_session)
+
+
+@handler(PaymentTask.KIND.edmodule_payed)
+def edmodule_payed_notify(module_reason_id, new_enrollment, promocodes, upsale_links):
+    edmodule_reason = EducationalModuleEnrollmentReason.objects.get(id=module_reason_id)
+    edmodule_payed.send(EducationalModuleEnrollmentReason, instance=edmodule_reason,
+                        new_enrollment=new_enrollment, promocodes=_promocode_pairs(promocodes),
+                        upsale_links=list(UpsaleLink.objects.filter(id__in=upsale_links)))
+
+
+@handler(PaymentTask.KIND.gift_sender_email)
+def gift_sender_email(email, ctx):
+    send_mail(
+        _(u'Успешная оплата курса «{}» в подарок'.format(ctx['course_name'])),
+        render_to_string('emails/gift_sender.txt', ctx),
+        'OpenProfession <welcome@openprofession.ru>',
+        [email],
+        html_message=render_to_string('emails/gift_sender.html', ctx)
+    )
+
+
+@handler(PaymentTask.KIND.zapier)
+def zapier(action, payment_id, user_id, cookie='', session_id=None, participant_id=None, module_id=None):
+    kwargs = {
+        'cookie': cookie,
+        'user': User.objects.get(id=user_id),
+        'payment': YandexPayment.objects.get(id=payment_id),
+    }
+    if session_id:
+        kwargs.update(session=CourseSession.objects.get(id=session_id), participant_id=participant_id)
+    else:
+        kwargs['module'] = EducationalModule.objects.get(id=module_id)
+    ZapierInformer().push(action, **kwargs)
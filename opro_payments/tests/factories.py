@@ -0,0 +1,28 @@
+# coding: utf-8
+
+from django.apps import apps as global_apps
+from django.conf import settings
+
+
+def make_user(username, apps=global_apps):
+    """
+    :param apps: реестр моделей, для тестов миграций - apps состояния миграции
+    """
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    return User.objects.create(username=username, email='%s@example.com' % username)
+
+
+def make_upsale_link(slug, codes=(), apps=global_apps):
+    """
+    апсейл с привязкой к объекту и пулом промокодов codes
+    """
+    Upsale = apps.get_model('opro_payments', 'Upsale')
+    UpsaleLink = apps.get_model('opro_payments', 'UpsaleLink')
+    UpsalePromoCode = apps.get_model('opro_payments', 'UpsalePromoCode')
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    upsale = Upsale.objects.create(slug=slug, title=slug, short_description=slug, icon='icon.png', image='image.png')
+    content_type, _created = ContentType.objects.get_or_create(app_label='opro_payments', model='upsale')
+    link = UpsaleLink.objects.create(upsale=upsale, content_type=content_type, object_id=upsale.id, is_paid=1)
+    for line, code in enumerate(codes, 1):
+        UpsalePromoCode.objects.create(upsale_link=link, code=code, line=line)
+    return link
@@ -0,0 +1,44 @@
+# coding: utf-8
+
+from django.contrib.auth.models import AnonymousUser
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.test import TestCase, RequestFactory
+from django.test.utils import override_settings, CaptureQueriesContext
+from opro_payments import db_router
+from opro_payments.models import PaymentTask
+
+
+@override_settings(DATABASE_ROUTERS=['opro_payments.db_router.ReplicaRouter'])
+class ReplicaRouterTestCase(TestCase):
+    def setUp(self):
+        self._replica_db, db_router.REPLICA_DB = db_router.REPLICA_DB, 'replica'
+        self.task = PaymentTask.objects.create(kind='test')
+        self.request = RequestFactory().get('/')
+        self.request.user = AnonymousUser()
+
+    def tearDown(self):
+        db_router.REPLICA_DB = self._replica_db
+
+    def test_reads_go_to_replica(self):
+        @db_router.read_from_replica
+        def view(request):
+            return PaymentTask.objects.filter(id=self.task.id).db
+
+        self.assertEqual(view(self.request), 'replica')
+        self.assertEqual(PaymentTask.objects.filter(id=self.task.id).db, DEFAULT_DB_ALIAS)
+
+    def test_object_read_from_replica_is_saved_to_primary(self):
+        @db_router.read_from_replica
+        def view(request):
+            # объект, прочитанный из реплики (для теста вторая бд не нужна)
+            task = PaymentTask.objects.using(DEFAULT_DB_ALIAS).get(id=self.task.id)
+            task._state.db = 'replica'
+            task.kind = 'changed'
+            with CaptureQueriesContext(connections[DEFAULT_DB_ALIAS]) as queries:
+                task.save()
+            return task, queries
+
+        task, queries = view(self.request)
+        self.assertEqual(task._state.db, DEFAULT_DB_ALIAS)
+        self.assertTrue(any(q['sql'].startswith('UPDATE') for q in queries.captured_queries))
+        self.assertEqual(PaymentTask.objects.get(id=self.task.id).kind, 'changed')
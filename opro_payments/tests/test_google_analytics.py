@@ -0,0 +1,42 @@
+# coding: utf-8
+
+from datetime import timedelta
+from django.test import TestCase
+from django.utils import timezone
+from opro_payments.models import GoogleAnalyticsHit
+
+
+class GoogleAnalyticsHitRetryTestCase(TestCase):
+    def make_hit(self, age):
+        hit = GoogleAnalyticsHit.objects.create(payment_id=1, data='v=1', attempts=1)
+        GoogleAnalyticsHit.objects.filter(id=hit.id).update(created_at=timezone.now() - timedelta(seconds=age))
+        return GoogleAnalyticsHit.objects.get(id=hit.id)
+
+    def test_fresh_hit_is_retried(self):
+        hit = self.make_hit(60)
+        hit.mark_failed('error')
+        self.assertEqual(GoogleAnalyticsHit.objects.get(id=hit.id).status, GoogleAnalyticsHit.STATUS.pending)
+
+    def test_hit_is_not_retried_past_max_age(self):
+        hit = self.make_hit(GoogleAnalyticsHit.MAX_AGE - GoogleAnalyticsHit.RETRY_DELAY // 2)
+        hit.mark_failed('error')
+        self.assertEqual(GoogleAnalyticsHit.objects.get(id=hit.id).status, GoogleAnalyticsHit.STATUS.failed)
+
+
+class GoogleAnalyticsBatchReadyTestCase(TestCase):
+    def make_hits(self, count, age=0):
+        GoogleAnalyticsHit.objects.bulk_create([GoogleAnalyticsHit(payment_id=1, data='v=1') for _i in range(count)])
+        GoogleAnalyticsHit.objects.update(created_at=timezone.now() - timedelta(seconds=age))
+
+    def test_waits_for_full_batch(self):
+        self.make_hits(GoogleAnalyticsHit.BATCH_SIZE - 1)
+        self.assertFalse(GoogleAnalyticsHit.objects.batch_ready(max_wait=60))
+        self.make_hits(1)
+        self.assertTrue(GoogleAnalyticsHit.objects.batch_ready(max_wait=60))
+
+    def test_partial_batch_is_sent_after_max_wait(self):
+        self.make_hits(1, age=61)
+        self.assertTrue(GoogleAnalyticsHit.objects.batch_ready(max_wait=60))
+
+    def test_empty_queue(self):
+        self.assertFalse(GoogleAnalyticsHit.objects.batch_ready(max_wait=0))
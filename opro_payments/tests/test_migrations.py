@@ -0,0 +1,56 @@
+# coding: utf-8
+
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TransactionTestCase
+from .factories import make_user, make_upsale_link
+
+
+class ObjectEnrollmentDedupeMigrationTestCase(TransactionTestCase):
+    """
+    миграция 0015 оставляет одну запись на апсейл для каждого пользователя
+    """
+    migrate_from = [('opro_payments', '0014_paymentorder_order_key')]
+    migrate_to = [('opro_payments', '0016_objectenrollment_unique')]
+
+    def setUp(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.migrate_from)
+        self.apps = executor.loader.project_state(self.migrate_from).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def migrate(self):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(self.migrate_to)
+        return executor.loader.project_state(self.migrate_to).apps
+
+    def test_remove_duplicates(self):
+        ObjectEnrollment = self.apps.get_model('opro_payments', 'ObjectEnrollment')
+        user, other_user = make_user('buyer', apps=self.apps), make_user('other', apps=self.apps)
+        link, other_link = make_upsale_link('first', apps=self.apps), make_upsale_link('second', apps=self.apps)
+
+        def enroll(user, link, is_active, promo=None):
+            return ObjectEnrollment.objects.create(
+                user=user, upsale=link, enrollment_type=1, payment_type=1, is_active=is_active,
+                jsonfield={'promo_code': promo} if promo else None).id
+
+        enroll(user, link, False)
+        with_promo = enroll(user, link, False, promo='A1')
+        enroll(user, link, True)
+        single = enroll(user, other_link, False)
+        other = enroll(other_user, link, True)
+        first, _duplicate = enroll(other_user, other_link, False), enroll(other_user, other_link, False)
+
+        ObjectEnrollment = self.migrate().get_model('opro_payments', 'ObjectEnrollment')
+        self.assertEqual(sorted(ObjectEnrollment.objects.values_list('id', flat=True)),
+                         sorted([with_promo, single, other, first]))
+        # сохраняется запись с промокодом, активная, если активна была хотя бы одна из дублей
+        kept = ObjectEnrollment.objects.get(id=with_promo)
+        self.assertTrue(kept.is_active)
+        self.assertEqual(kept.jsonfield, {'promo_code': 'A1'})
+        self.assertFalse(ObjectEnrollment.objects.get(id=single).is_active)
+        self.assertFalse(ObjectEnrollment.objects.get(id=first).is_active)
@@ -0,0 +1,52 @@
+# coding: utf-8
+
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase
+from plp.models import SessionEnrollmentType
+from plp_edmodule.models import EducationalModuleEnrollmentType
+from opro_payments.models import UpsaleLink
+from opro_payments.utils import make_order_key
+
+
+class MakeOrderKeyTestCase(SimpleTestCase):
+    """
+    номер заказа определяется только корзиной
+    """
+    def setUp(self):
+        User = get_user_model()
+        self.user = User(id=7)
+        self.session_type = SessionEnrollmentType(id=3, session_id=5, mode='verified')
+        self.module_type = EducationalModuleEnrollmentType(id=4, module_id=9, mode='verified')
+        self.links = [UpsaleLink(id=11), UpsaleLink(id=12)]
+
+    def test_format(self):
+        key = make_order_key(self.session_type, self.user, self.links)
+        self.assertRegexpMatches(key, r'^verified-5-[0-9a-f]{32}$')
+        key = make_order_key(self.module_type, self.user, self.links)
+        self.assertRegexpMatches(key, r'^edmodule-9-[0-9a-f]{32}$')
+
+    def test_same_cart_same_key(self):
+        self.assertEqual(make_order_key(self.session_type, self.user, self.links),
+                         make_order_key(self.session_type, self.user, list(reversed(self.links))))
+        self.assertEqual(make_order_key(self.session_type, self.user, set(self.links)),
+                         make_order_key(self.session_type, self.user, self.links))
+
+    def test_first_session_ignored_for_full_module(self):
+        self.assertEqual(make_order_key(self.module_type, self.user, [], only_first_course=False, first_session_id=1),
+                         make_order_key(self.module_type, self.user, [], only_first_course=False, first_session_id=2))
+
+    def test_different_cart_different_key(self):
+        User = get_user_model()
+        base = make_order_key(self.session_type, self.user, self.links)
+        self.assertNotEqual(base, make_order_key(self.session_type, self.user, self.links[:1]))
+        self.assertNotEqual(base, make_order_key(self.session_type, User(id=8), self.links))
+        self.assertNotEqual(base, make_order_key(self.session_type, self.user, self.links, gift_receiver=User(id=8)))
+        self.assertNotEqual(make_order_key(self.module_type, self.user, [], only_first_course=True, first_session_id=1),
+                            make_order_key(self.module_type, self.user, [], only_first_course=True, first_session_id=2))
+
+    def test_previous_order_chain(self):
+        base = make_order_key(self.session_type, self.user, self.links)
+        first = make_order_key(self.session_type, self.user, self.links, previous_order_id=1)
+        self.assertNotEqual(base, first)
+        self.assertEqual(first, make_order_key(self.session_type, self.user, self.links, previous_order_id=1))
+        self.assertNotEqual(first, make_order_key(self.session_type, self.user, self.links, previous_order_id=2))
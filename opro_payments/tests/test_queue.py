@@ -0,0 +1,47 @@
+# coding: utf-8
+
+from datetime import timedelta
+from django.test import TestCase
+from django.utils import timezone
+from opro_payments.models import PaymentTask
+
+
+class QueueClaimTestCase(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        self.tasks = [
+            PaymentTask.objects.create(kind='test', next_attempt_at=now - timedelta(minutes=3 - i))
+            for i in range(3)
+        ]
+
+    def test_claim_leases_items(self):
+        before = timezone.now()
+        claimed = PaymentTask.objects.claim(limit=2, lease=600)
+        self.assertEqual({i.id for i in claimed}, {i.id for i in self.tasks[:2]})
+        for task in claimed:
+            self.assertEqual(task.status, PaymentTask.STATUS.processing)
+            self.assertEqual(task.attempts, 1)
+            self.assertGreaterEqual(task.next_attempt_at, before + timedelta(seconds=600))
+
+    def test_leased_items_are_not_claimed_again(self):
+        first = PaymentTask.objects.claim(limit=10)
+        self.assertEqual(len(first), 3)
+        self.assertEqual(PaymentTask.objects.claim(limit=10), [])
+
+    def test_expired_lease_is_claimed_again(self):
+        task = PaymentTask.objects.claim(limit=1)[0]
+        # обработчик упал, не отметив результат
+        PaymentTask.objects.filter(id=task.id).update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+        claimed = PaymentTask.objects.claim(limit=1)
+        self.assertEqual([i.id for i in claimed], [task.id])
+        self.assertEqual(claimed[0].attempts, 2)
+
+    def test_done_and_failed_items_are_not_claimed(self):
+        self.tasks[0].mark_done()
+        self.tasks[1].mark_failed('error', retry=False)
+        claimed = PaymentTask.objects.claim(limit=10)
+        self.assertEqual([i.id for i in claimed], [self.tasks[2].id])
+
+    def test_future_items_are_not_claimed(self):
+        PaymentTask.objects.update(next_attempt_at=timezone.now() + timedelta(minutes=1))
+        self.assertEqual(PaymentTask.objects.claim(limit=10), [])
@@ -0,0 +1,84 @@
+# coding: utf-8
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, RequestFactory
+from django.test.utils import override_settings
+from opro_payments import ratelimit
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                             'LOCATION': 'opro_payments_ratelimit_tests'}}
+
+
+class FakeTime(object):
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TakeTokenTestCase(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.clock = FakeTime(1000.0)
+        self._time, ratelimit.time = ratelimit.time, self.clock
+
+    def tearDown(self):
+        ratelimit.time = self._time
+
+    def take(self, per_minute=6, burst=3):
+        return ratelimit.take_token('test', per_minute, burst)
+
+    def test_burst(self):
+        self.assertEqual([self.take() for _i in range(4)], [True, True, True, False])
+
+    def test_refill(self):
+        for _i in range(3):
+            self.take()
+        # 6 токенов в минуту - один токен за 10 секунд
+        self.clock.now += 9
+        self.assertFalse(self.take())
+        self.clock.now += 1
+        self.assertTrue(self.take())
+        self.assertFalse(self.take())
+
+    def test_refill_is_capped_by_burst(self):
+        self.take()
+        self.clock.now += 3600
+        self.assertEqual([self.take() for _i in range(4)], [True, True, True, False])
+
+    def test_rejected_requests_do_not_spend_tokens(self):
+        for _i in range(5):
+            self.take()
+        self.clock.now += 10
+        self.assertTrue(self.take())
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class IsAllowedTestCase(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self._limits = ratelimit.RATE_LIMITS
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        ratelimit.RATE_LIMITS = self._limits
+
+    def test_disabled_by_default(self):
+        ratelimit.RATE_LIMITS = {}
+        request = self.factory.post('/')
+        self.assertTrue(all(ratelimit.is_allowed(request, 'promocode') for _i in range(50)))
+
+    def test_configured_limit(self):
+        ratelimit.RATE_LIMITS = {'promocode': (1, 2)}
+        request = self.factory.post('/')
+        self.assertEqual([ratelimit.is_allowed(request, 'promocode') for _i in range(3)], [True, True, False])
+        other = self.factory.post('/', REMOTE_ADDR='10.0.0.2')
+        self.assertTrue(ratelimit.is_allowed(other, 'promocode'))
+
+    def test_identity_is_hashed(self):
+        key = ratelimit._bucket_key('promocode', 'session', 'bad key \n' + 'x' * 300)
+        self.assertLess(len(key), 250)
+        self.assertNotIn(' ', key)
+        self.assertNotIn('\n', key)
@@ -0,0 +1,46 @@
+# coding: utf-8
+
+from django.test import TestCase
+from opro_payments.models import ObjectEnrollment, UpsalePromoCode
+from .factories import make_user, make_upsale_link
+
+
+class UpsertTestCase(TestCase):
+    def setUp(self):
+        self.user = make_user('buyer')
+        self.links = [make_upsale_link('first', codes=['A1', 'A2']), make_upsale_link('second')]
+        self.defaults = dict(
+            enrollment_type=ObjectEnrollment.ENROLLMENT_TYPE_CHOICES.paid,
+            payment_type=ObjectEnrollment.PAYMENT_TYPE_CHOICES.yandex,
+            payment_order_id='order-1',
+            is_active=True,
+        )
+
+    def test_creates_enrollments_and_claims_promocodes(self):
+        result = ObjectEnrollment.objects.upsert(self.user, self.links, **self.defaults)
+        self.assertEqual(result, [(self.links[0], True, 'A1'), (self.links[1], True, None)])
+        enrollment = ObjectEnrollment.objects.get(user=self.user, upsale=self.links[0])
+        self.assertEqual(enrollment.jsonfield, {'promo_code': 'A1'})
+        promo = UpsalePromoCode.objects.get(code='A1')
+        self.assertTrue(promo.is_used)
+        self.assertEqual(promo.enrollment_id, enrollment.id)
+
+    def test_repeated_upsert_is_idempotent(self):
+        ObjectEnrollment.objects.upsert(self.user, self.links, **self.defaults)
+        result = ObjectEnrollment.objects.upsert(self.user, self.links, **self.defaults)
+        self.assertEqual(result, [(self.links[0], False, None), (self.links[1], False, None)])
+        self.assertEqual(ObjectEnrollment.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(UpsalePromoCode.objects.filter(is_used=True).count(), 1)
+        self.assertEqual(ObjectEnrollment.objects.get(user=self.user, upsale=self.links[0]).jsonfield,
+                         {'promo_code': 'A1'})
+
+    def test_existing_enrollments_are_updated(self):
+        ObjectEnrollment.objects.upsert(self.user, self.links[:1], **dict(self.defaults, is_active=False))
+        result = ObjectEnrollment.objects.upsert(self.user, self.links, **dict(self.defaults, payment_order_id='order-2'))
+        self.assertEqual([created for _link, created, _promo in result], [False, True])
+        enrollment = ObjectEnrollment.objects.get(user=self.user, upsale=self.links[0])
+        self.assertTrue(enrollment.is_active)
+        self.assertEqual(enrollment.payment_order_id, 'order-2')
+
+    def test_empty_cart(self):
+        self.assertEqual(ObjectEnrollment.objects.upsert(self.user, [], **self.defaults), [])
@@ -1,5 +1,6 @@
 # coding: utf-8
 
+from django.conf import settings
 from django.conf.urls import url
 from django.views.generic import TemplateView
 from . import views
@@ -22,4 +23,9 @@ urlpatterns = [
     url(r'^op_payment/api/enroll/?$', views.EnrollmentApiView.as_view(), name='op-api-enrollment'),
     url(r'^promocode/?$', views.promocode, name='promocode'),
     url(r'^offer-text/(?P<offer_type>course|edmodule)/(?P<obj_id>\d+)/?$', views.offer_text_view, name='op-offer-text'),
-]
\ No newline at end of file
+]
+
+if settings.DEBUG:
+    urlpatterns += [
+        url(r'^op_payment/ga-stub/batch/?$', views.ga_batch_stub_view, name='op-ga-batch-stub'),
+    ]
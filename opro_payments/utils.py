@@ -1,36 +1,39 @@
 # coding: utf-8
 
+import hashlib
 import json
 import logging
 import re
-import time
 import urllib
+from collections import OrderedDict
 from django.conf import settings
-from django.utils import timezone
-from django.core.mail import send_mail
+from django.db import transaction, IntegrityError
+from django.db.models import F
 from django.core.urlresolvers import reverse
-from django.shortcuts import get_object_or_404
 from django.core.exceptions import ObjectDoesNotExist
-from django.template.loader import render_to_string
-from django.utils.translation import ugettext as _
+from django.utils import timezone
 import requests
 from raven import Client
 from payments.helpers import payment_for_participant_complete
 from payments.models import YandexPayment
 from payments.sources.yandex_money.signals import payment_completed
 from plp.models import Course, Participant, EnrollmentReason, SessionEnrollmentType, User, CourseSession, GiftPaymentInfo
-from plp.utils.edx_enrollment import EDXEnrollmentError, EDXEnrollment
 from plp.utils.webhook import ZapierInformer
 from plp_edmodule.models import EducationalModuleEnrollmentType, EducationalModuleEnrollment, \
     EducationalModuleEnrollmentReason, EducationalModule, PromoCode
-from plp_edmodule.signals import edmodule_payed
 from plp.notifications.base import get_host_url
-from .models import UpsaleLink, ObjectEnrollment
+from .db_router import pin_to_primary
+from .ga_catalog import get_session_item, get_module_items
+from .models import UpsaleLink, ObjectEnrollment, PaymentTask, PaymentLookup, PromoCodeUsage, GoogleAnalyticsHit, \
+    PaymentOrder
+from .promocodes import invalidate_promocodes
 
 # Стандартные значения для Яндекс.Кассы для передачи оператору фискальных данных
 TAX_RATE = 1 # Без НДС
 QUANTITY = 1 # Товар всегда продается в единичном экземпляре
 
+GA_BATCH_URL = 'https://www.google-analytics.com/batch'
+
 RAVEN_CONFIG = getattr(settings, 'RAVEN_CONFIG', {})
 client = None
 
@@ -56,69 +59,6 @@ def get_merchant_receipt(contact, products):
 
     return receipt
 
-def get_object_info(request, session_id, module_id):
-    obj_model = CourseSession if session_id else EducationalModule
-    obj_id = session_id or module_id
-    obj = get_object_or_404(obj_model, id=obj_id)
-    verified_enrollment = obj.get_verified_mode_enrollment_type()
-
-    upsale_link_ids = [i for i in request.GET.getlist('upsale_link_ids') if i.isdigit()]
-    upsale_links = UpsaleLink.objects.filter(id__in=upsale_link_ids, is_active=True)
-    upsales = []
-    for upsale in upsale_links:
-        s = upsale.content_object
-        if s and isinstance(s, obj_model) and s.id == obj.id:
-            upsales.append(upsale)    
-
-    return obj, verified_enrollment, upsales
-
-def get_obj_price(session_id, verified_enrollment, only_first_course, obj, upsales, new_price=None):
-    session = None
-    first_session_id = None
-    products = []
-    if session_id:
-        obj_price = verified_enrollment.price
-        products.append({ 
-            'title': verified_enrollment.session.course.title, 
-            'price': obj_price 
-        })
-    else:
-        if only_first_course:
-            try:
-                session, price = obj.get_first_session_to_buy(None)
-                obj_price = price
-                first_session_id = session.id
-                products.append({
-                    'title': session.course.title,
-                    'price': obj_price 
-                })
-            except TypeError:
-                return HttpResponseServerError()
-        else:
-            obj_price = get_edmodule_price(obj)
-
-            products.append({
-                'title': obj.title, 
-                'price': obj_price 
-            })
-            
-    if new_price:
-        obj_price = new_price
-        products[0]['price'] = new_price
-
-    upsales_price = 0
-    for i in upsales:
-        upsale_price = i.get_payment_price()
-        upsales_price += upsale_price
-        products.append({
-            'title': i.upsale.title,
-            'price': upsale_price
-        })
-
-    total_price = float(obj_price) + upsales_price
-
-    return session, first_session_id, obj_price, total_price, products
-
 def get_edmodule_price(module):
     try:
         verified = EducationalModuleEnrollmentType.objects.get(module=module, active=True, mode='verified')
@@ -127,32 +67,6 @@ def get_edmodule_price(module):
 
     return verified.price
 
-def get_or_create_user(first_name, email, lazy_send_mail=False):
-    """
-    Возвращает пользователя, если его нет - создает
-    Для прохождения упрощенного сценарция задает пользователю переданное имя и пустую фамилию
-    """
-
-    post_data = { 'emails': [email], 'lazy_send_mail': lazy_send_mail }
-    request_url = '{}/users/simple_mass_registration/'.format(settings.SSO_NPOED_URL)
-    r = requests.post(
-        request_url,
-        json = post_data,
-        headers = { 'X-SSO-Api-Key': settings.SSO_API_KEY },
-        timeout = settings.CONNECTION_TIMEOUT
-    )
-
-    sso_data = r.json().get('users', [])
-    email = sso_data[0]['email']
-
-    user = User.objects.get(email=email)
-    user.username = re.sub('[^a-zA-Z0-9]', '_', email)
-    user.first_name = first_name
-    user.last_name = ' '
-    user.save()
-
-    return user
-
 def get_payment_urls(request, obj, user, session_id, utm_data):
     """
     Возвращает значения для редиректа пользователя после успешной / неуспешной оплаты
@@ -209,6 +123,24 @@ def get_gift_payment_urls(request, obj, user, session_id, utm_data):
 
     return urls
 
+def make_order_key(enrollment_type, user, upsale_links, only_first_course=False, first_session_id=None,
+                   gift_receiver=None, previous_order_id=None):
+    """
+    Номер заказа: читаемый префикс (тип записи и объект) и первые 32 символа sha256 от канонического
+    представления корзины. Одна и та же корзина всегда получает один и тот же номер фиксированной длины
+    :param previous_order_id: id оплаченного заказа с той же корзиной, если корзину покупают повторно
+    """
+    if isinstance(enrollment_type, SessionEnrollmentType):
+        prefix = '{}-{}'.format(enrollment_type.mode, enrollment_type.session_id)
+        cart = ['session', enrollment_type.id]
+    else:
+        prefix = 'edmodule-{}'.format(enrollment_type.module_id)
+        cart = ['edmodule', enrollment_type.id, bool(only_first_course), first_session_id if only_first_course else None]
+    cart += [user.id, sorted(i.id for i in upsale_links), gift_receiver and gift_receiver.id, previous_order_id]
+    digest = hashlib.sha256(json.dumps(cart, separators=(',', ':'))).hexdigest()[:32]
+    return '{}-{}'.format(prefix, digest)
+
+
 def payment_for_user(request, enrollment_type, upsale_links, price, create=True, only_first_course=False,
                      first_session_id=None, order_number=None, user=None, gift_receiver=None, promocode=None):
     """
@@ -221,26 +153,29 @@ def payment_for_user(request, enrollment_type, upsale_links, price, create=True,
     :param promocode: str - промокод, по которому была совершена оплата
     :param only_first_course: bool - используется в случае оплаты модуля
     :param first_session_id: int - обязательный аргумент в случае only_first_course=True
-    :param order_number: str - взять заданный order_number вместо его генерации (действует только для модуля)
+    :param order_number: str - взять заданный order_number вместо его генерации
     :return: YandexPayment
     """
     assert enrollment_type.active == True
     user = user if user else request.user
-    # Яндекс-Касса не даст провести оплату два раза по одному и тому же order_number
-    upsales = '-'.join([str(i.id) for i in upsale_links])
-    if isinstance(enrollment_type, SessionEnrollmentType):
-        order_number = "{}-{}-{}-{}".format(enrollment_type.mode, enrollment_type.session.id, user.id, upsales)
-    else:
-        if create and order_number:
-            # запись ранее сгенерированного order_number во избежание ошибки несовпадения этого параметра
-            # вследствие использования int(time.time()) как часть order_number
-            order_number = order_number
-        else:
-            order_number = "edmodule-{}-{}-{}-{}".format(
-                enrollment_type.module.id, user.id, int(time.time()), upsales)
-    if len(order_number) > 64:
-        logging.info('Order number exceeds max length: %s' % order_number)
-        order_number = order_number[:64]
+    # Яндекс-Касса не даст провести оплату два раза по одному и тому же order_number, поэтому
+    # номер определяется корзиной, а после оплаты та же корзина получает следующий номер
+    key_args = (enrollment_type, user, upsale_links, only_first_course, first_session_id, gift_receiver)
+    order = None
+    if create and order_number:
+        # номер, показанный пользователю на странице подтверждения оплаты
+        order = PaymentOrder.objects.by_key(order_number)
+        if not order and YandexPayment.objects.filter(order_number=order_number, is_payed=True).exists():
+            # страница подтверждения устарела: номер оплачен платежом, созданным до появления заказов
+            order_number = None
+    if not (create and order_number):
+        order_number = make_order_key(*key_args)
+        order = PaymentOrder.objects.by_key(order_number)
+    # оплаченный заказ повторно не используется (например, при повторной отправке устаревшей
+    # страницы подтверждения), та же корзина получает следующий номер в цепочке
+    while order and order.payment.is_payed:
+        order_number = make_order_key(*key_args, previous_order_id=order.id)
+        order = PaymentOrder.objects.by_key(order_number)
 
     metadata = {
         'user': {
@@ -285,8 +220,11 @@ def payment_for_user(request, enrollment_type, upsale_links, price, create=True,
             'email': gift_receiver.email
         }
 
-    try:
-        payment = YandexPayment.objects.get(order_number=order_number)
+    ga_data = metadata.get('google_analytics')
+    ga_cid = (ga_data[0].get('cid') or '') if ga_data else ''
+    payment = order.payment if order else YandexPayment.objects.filter(order_number=order_number).first()
+    if payment:
+        changed = False
         if payment.order_amount != price:
             assert not payment.is_payed
             logging.warning(
@@ -294,30 +232,89 @@ def payment_for_user(request, enrollment_type, upsale_links, price, create=True,
                 (payment.order_amount, price, payment)
             )
             payment.order_amount = price
+            changed = True
+        if create and not payment.is_payed and json.loads(payment.metadata or '{}') != metadata:
+            # промокод и данные аналитики относятся к последней попытке оплаты неоплаченного заказа
+            payment.metadata = json.dumps(metadata)
+            changed = True
+        if changed:
             payment.save()
-    except YandexPayment.DoesNotExist:
-        payment_dict = dict(order_number=order_number,
-                            order_amount=price,
-                            customer_number=user.username,
-                            metadata=json.dumps(metadata),
-                            user=user)
-        if create:
-            payment = YandexPayment.objects.create(**payment_dict)
-        else:
-            payment = YandexPayment(**payment_dict)
+        if create and order and (order.promocode, order.ga_cid) != (promocode or '', ga_cid):
+            order.promocode, order.ga_cid = promocode or '', ga_cid
+            PaymentOrder.objects.filter(id=order.id).update(promocode=order.promocode, ga_cid=order.ga_cid)
+    else:
+        payment = YandexPayment(order_number=order_number,
+                                order_amount=price,
+                                customer_number=user.username,
+                                metadata=json.dumps(metadata),
+                                user=user)
+
+    if create:
+        obj = enrollment_type.session if isinstance(enrollment_type, SessionEnrollmentType) else enrollment_type.module
+        if not order:
+            try:
+                with transaction.atomic():
+                    if not payment.id:
+                        payment.save()
+                    PaymentOrder.objects.save_for_payment(
+                        payment, obj, enrollment_type, user, upsale_links,
+                        order_key=order_number,
+                        only_first_course=only_first_course and not isinstance(enrollment_type, SessionEnrollmentType),
+                        first_session_id=first_session_id,
+                        gift_receiver=gift_receiver,
+                        promocode=promocode,
+                        ga_cid=ga_cid,
+                    )
+            except IntegrityError:
+                # та же корзина оформлена параллельным запросом
+                order = PaymentOrder.objects.by_key(order_number)
+                if not order:
+                    raise
+                payment = order.payment
+        PaymentLookup.objects.remember(user, obj, payment)
+        pin_to_primary(user.id, gift_receiver and gift_receiver.id)
 
     return payment
 
 
+def get_payment_metadata(payment):
+    """
+    данные платежа в формате metadata: из заказа PaymentOrder, а для платежей, созданных
+    до появления заказов, из json в YandexPayment.metadata
+    """
+    order = PaymentOrder.objects.for_payment(payment)
+    if order:
+        return order.to_metadata()
+    return json.loads(payment.metadata or '{}')
+
+
+def get_latest_payment(user, obj):
+    """
+    Последний платеж пользователя за сессию или модуль для страниц статуса оплаты.
+    Платежи, созданные до появления PaymentLookup, ищутся по префиксу order_number
+    """
+    payment = PaymentLookup.objects.get_payment(user, obj)
+    if payment:
+        return payment
+    if isinstance(obj, CourseSession):
+        order_number = "{}-{}-{}-".format('verified', obj.id, user.id)
+    else:
+        order_number = "edmodule-{}-{}-".format(obj.id, user.id)
+    return YandexPayment.objects.filter(order_number__startswith=order_number).order_by('-id').first()
+
+
 def payment_for_user_complete(sender, **kwargs):
     """
     Обработчик сигнала оплаты от яндекс-кассы.
+    Записи в бд делаются в одной транзакции, запись в edx, письма и отправка данных
+    во внешние сервисы ставятся в очередь PaymentTask (см. команду process_payment_tasks)
     :param sender: объект models.YandexPayment
 
     """
     assert isinstance(sender, YandexPayment)
     payment = sender
-    metadata = json.loads(payment.metadata or "{}")
+    order = PaymentOrder.objects.for_payment(payment)
+    metadata = order.to_metadata() if order else json.loads(payment.metadata or "{}")
 
     user = metadata.get('gift_receiver') if metadata.get('gift_receiver') else metadata.get('user')
     new_mode = metadata.get('new_mode')
@@ -325,66 +322,75 @@ def payment_for_user_complete(sender, **kwargs):
     edmodule = metadata.get('edmodule')
     course_payment = True
 
-    if (user and new_mode and upsale_links is not None):
-        _payment_for_session_complete(payment, metadata, user, new_mode, upsale_links)
-    elif (user and edmodule and upsale_links is not None):
-        _payment_for_module_complete(payment, metadata, user, edmodule, upsale_links)
-        course_payment = False
-    push_google_analytics_for_payment(payment)
-    ga_data = metadata.get('google_analytics', [])
-    cid = ''
-    if ga_data:
-        cid = ga_data[0].get('cid')
-    user = User.objects.get(id=user['id'])
-    kwargs = {'cookie': cid, 'user': user, 'payment': payment}
-    if course_payment:
-        enr_type = SessionEnrollmentType.objects.get(id=new_mode['id'])
-        session = enr_type.session
-        p = Participant.objects.filter(user=user, session=session).first()
-        ZapierInformer().push(ZapierInformer.ACTION.plp_course_pay, session=session,
-                              participant_id=p and p.id, **kwargs)
-    else:
-        module = EducationalModule.objects.get(id=edmodule['id'])
-        ZapierInformer().push(ZapierInformer.ACTION.plp_edmodule_pay, module=module, **kwargs)
+    pin_to_primary((metadata.get('user') or {}).get('id'), (metadata.get('gift_receiver') or {}).get('id'))
+    with transaction.atomic():
+        # повторное уведомление об уже обработанном платеже не должно еще раз отправлять данные во внешние
+        # сервисы: отметка заказа оплаченным блокирует его строку, параллельное уведомление дождется
+        # фиксации и ничего не обновит. Для платежей без заказа повторы не отслеживаются
+        first_notification = True
+        if order:
+            first_notification = bool(PaymentOrder.objects.filter(id=order.id, is_paid=False)
+                                      .update(is_paid=True, paid_at=timezone.now()))
+        if (user and new_mode and upsale_links is not None):
+            _payment_for_session_complete(payment, metadata, user, new_mode, upsale_links)
+        elif (user and edmodule and upsale_links is not None):
+            _payment_for_module_complete(payment, metadata, user, edmodule, upsale_links)
+            course_payment = False
+        increase_promocode_usage(metadata.get('promocode'), payment.id)
+        if not first_notification:
+            logging.info('[payment_for_user_complete] payment %s was already processed' % payment.id)
+            return
+        push_google_analytics_for_payment(payment)
+        if order:
+            cid = order.ga_cid
+        else:
+            ga_data = metadata.get('google_analytics', [])
+            cid = ga_data[0].get('cid') if ga_data else ''
+        task_kwargs = {'cookie': cid, 'user_id': user['id'], 'payment_id': payment.id}
+        if course_payment:
+            enr_type = SessionEnrollmentType.objects.get(id=new_mode['id'])
+            session = enr_type.session
+            p = Participant.objects.filter(user__id=user['id'], session=session).first()
+            PaymentTask.objects.enqueue(PaymentTask.KIND.zapier, action=ZapierInformer.ACTION.plp_course_pay,
+                                        session_id=session.id, participant_id=p and p.id, **task_kwargs)
+        else:
+            PaymentTask.objects.enqueue(PaymentTask.KIND.zapier, action=ZapierInformer.ACTION.plp_edmodule_pay,
+                                        module_id=edmodule['id'], **task_kwargs)
 
 
 def outer_payment_for_user(user, sku_parts, new_mode, upsale_links):
     user_data = {'id': user.id}
-    if sku_parts['type'] == 'course':
-        _payment_for_session_complete(None, None, user_data, new_mode, upsale_links, with_yandex=False)
-    elif sku_parts['type'] == 'edmodule':
-        _payment_for_module_complete(None, None, user_data, new_mode, upsale_links, with_yandex=False)
+    pin_to_primary(user.id)
+    with transaction.atomic():
+        if sku_parts['type'] == 'course':
+            _payment_for_session_complete(None, None, user_data, new_mode, upsale_links, with_yandex=False)
+        elif sku_parts['type'] == 'edmodule':
+            _payment_for_module_complete(None, None, user_data, new_mode, upsale_links, with_yandex=False)
 
 
 def _payment_for_session_complete(payment, metadata, user, new_mode, upsale_links, with_yandex=True):
     if with_yandex:
         logging.info('[payment_for_user_complete] got payment information from yandex.kassa: metadata=%s payment=%s',
                      metadata, payment)
+    metadata = metadata or {}
 
     enr_type = SessionEnrollmentType.objects.get(id=new_mode['id'])
     session = enr_type.session
     user = User.objects.get(id=user['id'])
     participant, created = Participant.objects.get_or_create(session=session, user=user)
 
-    upsales = UpsaleLink.objects.filter(id__in=upsale_links)
+    upsales = list(UpsaleLink.objects.filter(id__in=upsale_links).select_related('upsale'))
     promocodes = []
-    object_enrollment_defaults = {
-        'enrollment_type': ObjectEnrollment.ENROLLMENT_TYPE_CHOICES.paid,
-        'payment_type': ObjectEnrollment.PAYMENT_TYPE_CHOICES.yandex if with_yandex else ObjectEnrollment.PAYMENT_TYPE_CHOICES.other,
-        'payment_order_id': payment.order_number if with_yandex else '',
-        'is_active': True,
-    }
-    for u in upsales:
-        obj, created = ObjectEnrollment.objects.update_or_create(
-            user=user,
-            upsale=u,
-            defaults=object_enrollment_defaults
-        )
-        if created:
-            data = obj.jsonfield or {}
-            promo = data.get('promo_code')
-            if promo:
-                promocodes.append((u.upsale.title, promo))
+    enrollments = ObjectEnrollment.objects.upsert(
+        user, upsales,
+        enrollment_type=ObjectEnrollment.ENROLLMENT_TYPE_CHOICES.paid,
+        payment_type=ObjectEnrollment.PAYMENT_TYPE_CHOICES.yandex if with_yandex else ObjectEnrollment.PAYMENT_TYPE_CHOICES.other,
+        payment_order_id=payment.order_number if with_yandex else '',
+        is_active=True,
+    )
+    for u, created, promo in enrollments:
+        if created and promo:
+            promocodes.append((u.upsale.title, promo))
 
     params = dict(
         participant=participant,
@@ -399,32 +405,11 @@ def _payment_for_session_complete(payment, metadata, user, new_mode, upsale_link
         ).exists()
         reason = EnrollmentReason(**params)
         reason.save_no_edx_push()
-        try:
-            EDXEnrollment(edx_url=reason.session_enrollment_type.session.get_edx_url()).enroll(
-                course_id=reason.session_enrollment_type.session.get_absolute_slug_v1(),
-                user=reason.participant.user.username,
-                mode=reason.session_enrollment_type.mode
-            )
-            Participant.objects.filter(id=participant.id).update(sent_to_edx=timezone.now())
-        except EDXEnrollmentError as e:
-            logging.error('Failed to push verified enrollment %s to edx for user %s: %s' % (
-                session, user, e
-            ))
-            if client:
-                client.captureMessage('Failed to push verified enrollment to edx', extra={
-                    'user': user.username,
-                    'session_id': session.id,
-                    'error': str(e)
-                })
+        PaymentTask.objects.enqueue(PaymentTask.KIND.edx_enroll, reason_id=reason.id)
         if not metadata.get('gift_receiver'):
-            try:
-                reason.send_confirmation_email(upsales=upsales, promocodes=promocodes,
-                                               paid_for_session=paid_for_session)
-            except Exception as e:
-                logging.error(
-                    u'Failed to send course payment message. '
-                    u'User: %s, upsale_links: %s, enrollment_reason %s, error: %s' %
-                    (user.email, upsale_links, reason.id, e))
+            PaymentTask.objects.enqueue(PaymentTask.KIND.confirmation_email, reason_id=reason.id,
+                                        upsale_links=[u.id for u in upsales], promocodes=promocodes,
+                                        paid_for_session=paid_for_session)
 
     if metadata.get('gift_receiver'):
         gift_payment_info = GiftPaymentInfo.objects.filter(
@@ -441,17 +426,7 @@ def _payment_for_session_complete(payment, metadata, user, new_mode, upsale_link
                 'gift_sender_email': metadata.get('user').get('email'),
                 'course_name': u'Дизайнер интерфейсов' if gift_payment_info[0].product == 'ux' else u'VR-разработчик'
             }
-            try:
-                send_mail(
-                    _(u'Успешная оплата курса «{}» в подарок'.format(ctx['course_name'])),
-                    render_to_string('emails/gift_sender.txt', ctx),
-                    'OpenProfession <welcome@openprofession.ru>',
-                    [user.email],
-                    html_message=render_to_string('emails/gift_sender.html', ctx)
-                )
-            except Exception as e:
-                logging.error(u'Failed to send message for gift receiver. Email: %s, ctx: %s, error: %s' %
-                              (user.email, ctx, e))
+            PaymentTask.objects.enqueue(PaymentTask.KIND.gift_sender_email, email=user.email, ctx=ctx)
 
             gift_payment_info[0].has_paid = True
             gift_payment_info[0].save() 
@@ -463,6 +438,7 @@ def _payment_for_module_complete(payment, metadata, user, edmodule, upsale_links
     if with_yandex:
         logging.info('[payment_for_user_complete] got payment information from yandex.kassa: metadata=%s payment=%s',
                      metadata, payment)
+    metadata = metadata or {}
 
     enr_type = EducationalModuleEnrollmentType.objects.get(module__id=edmodule['id'], mode=edmodule['mode'])
     module = enr_type.module
@@ -470,24 +446,18 @@ def _payment_for_module_complete(payment, metadata, user, edmodule, upsale_links
     enrollment, new_enrollment = EducationalModuleEnrollment.objects.update_or_create(
         module=module, user=user, defaults={'is_paid': True, 'is_active': True})
 
-    upsales = UpsaleLink.objects.filter(id__in=upsale_links)
+    upsales = list(UpsaleLink.objects.filter(id__in=upsale_links).select_related('upsale'))
     promocodes, bought_upsales = [], []
-    upsales_defaults = {
-        'enrollment_type': ObjectEnrollment.ENROLLMENT_TYPE_CHOICES.paid,
-        'payment_type': ObjectEnrollment.PAYMENT_TYPE_CHOICES.yandex if with_yandex else ObjectEnrollment.PAYMENT_TYPE_CHOICES.other,
-        'payment_order_id': payment.order_number if with_yandex else '',
-        'is_active': True,
-    }
-    for u in upsales:
-        bought_upsale, _created = ObjectEnrollment.objects.update_or_create(
-            user=user,
-            upsale=u,
-            defaults=upsales_defaults
-        )
+    enrollments = ObjectEnrollment.objects.upsert(
+        user, upsales,
+        enrollment_type=ObjectEnrollment.ENROLLMENT_TYPE_CHOICES.paid,
+        payment_type=ObjectEnrollment.PAYMENT_TYPE_CHOICES.yandex if with_yandex else ObjectEnrollment.PAYMENT_TYPE_CHOICES.other,
+        payment_order_id=payment.order_number if with_yandex else '',
+        is_active=True,
+    )
+    for u, _created, promo in enrollments:
         if _created:
             bought_upsales.append(u)
-            data = bought_upsale.jsonfield or {}
-            promo = data.get('promo_code')
             if promo:
                 promocodes.append((u.upsale.title, promo))
     edmodule_reason, created = EducationalModuleEnrollmentReason.objects.get_or_create(
@@ -497,13 +467,9 @@ def _payment_for_module_complete(payment, metadata, user, edmodule, upsale_links
         payment_order_id=payment.order_number if with_yandex else '',
         full_paid=not edmodule['only_first_course']
     )
-    try:
-        edmodule_payed.send(EducationalModuleEnrollmentReason, instance=edmodule_reason,
-                            new_enrollment=new_enrollment, promocodes=promocodes, upsale_links=bought_upsales)
-    except Exception as e:
-        logging.error(u'Failed to send edmodule payment message. '
-                      u'User: %s, bought_upsales: %s, edmodule_reason: %s, error: %s' %
-                      (user.email, bought_upsales, edmodule_reason.id, e))
+    PaymentTask.objects.enqueue(PaymentTask.KIND.edmodule_payed, module_reason_id=edmodule_reason.id,
+                                new_enrollment=new_enrollment, promocodes=promocodes,
+                                upsale_links=[u.id for u in bought_upsales])
 
     if edmodule['only_first_course'] and edmodule.get('first_session_id'):
         session = CourseSession.objects.get(id=edmodule['first_session_id'])
@@ -516,26 +482,11 @@ def _payment_for_module_complete(payment, metadata, user, edmodule, upsale_links
             payment_order_id=payment.order_number if with_yandex else '',
         )
         if not EnrollmentReason.objects.filter(**params).exists():
-            try:
-                reason = EnrollmentReason.objects.create(**params)
-                Participant.objects.filter(id=participant.id).update(sent_to_edx=timezone.now())
-                if not metadata.get('gift_receiver'):
-                    try:
-                        reason.send_confirmation_email()
-                    except Exception as e:
-                        logging.error(u'Failed to send edmodule first course payment message. '
-                                      u'User: %s, edmodule_reason: %s, reason: %s, error: %s' %
-                                      (user.email, edmodule_reason.id, reason.id, e))
-            except EDXEnrollmentError as e:
-                logging.error('Failed to push verified enrollment %s to edx for user %s: %s' % (
-                    session, user, e
-                ))
-                if client:
-                    client.captureMessage('Failed to push verified enrollment to edx', extra={
-                        'user': user.username,
-                        'session_id': session.id,
-                        'error': str(e)
-                    })
+            reason = EnrollmentReason(**params)
+            reason.save_no_edx_push()
+            PaymentTask.objects.enqueue(PaymentTask.KIND.edx_enroll, reason_id=reason.id)
+            if not metadata.get('gift_receiver'):
+                PaymentTask.objects.enqueue(PaymentTask.KIND.confirmation_email, reason_id=reason.id)
 
     logging.debug('[payment_for_user_complete] enrollment=%s new_mode=%s', enrollment.id, edmodule['mode'])
 
@@ -576,98 +527,117 @@ def prepare_ga_data(order_number, request, price, obj, first_session_id=None):
     data.append(_params)
     # items
     if isinstance(obj, CourseSession):
-        _params = params.copy()
-        _params.update({
-            't': 'item',
-            'in': obj.course.title,
-            'ic': obj.course.slug,
-            'iv': 'course',
-            'ip': obj.get_verified_mode_price(),
-        })
-        data.append(_params)
+        items = [get_session_item(obj.id)]
     elif isinstance(obj, EducationalModule):
+        items = get_module_items(obj.id)
         if first_session_id:
-            session = CourseSession.objects.get(id=first_session_id)
-            session_price = session.get_verified_mode_price()
-            _params = params.copy()
-            _params.update({
-                't': 'item',
-                'in': obj.title,
-                'ic': obj.code,
-                'iv': 'edmodule',
-                'ip': session_price,
-            })
-            data.append(_params)
-
-            _params = params.copy()
-            session = CourseSession.objects.get(id=first_session_id)
-            _params.update({
-                't': 'item',
-                'in': session.course.title,
-                'ic': session.course.slug,
-                'iv': 'course',
-                'ip': session_price,
-            })
-            data.append(_params)
-        else:
-            price_data = obj.get_price_list()
-            _params = params.copy()
-            _params.update({
-                't': 'item',
-                'in': obj.title,
-                'ic': obj.code,
-                'iv': 'edmodule',
-                'ip': price_data['whole_price'],
-            })
-            data.append(_params)
-            for course, course_price in price_data.get('courses', []):
-                if not course_price:
-                    continue
-                _params = params.copy()
-                _params.update({
-                    't': 'item',
-                    'in': course.title,
-                    'ic': course.slug,
-                    'iv': 'course',
-                    'ip': course_price,
-                })
-                data.append(_params)
+            # оплата только первого курса модуля: модуль и курс по цене сессии
+            session_item = get_session_item(first_session_id)
+            items = [dict(items[0], ip=session_item['ip']), session_item]
+    else:
+        items = []
+    for item in items:
+        _params = params.copy()
+        _params['t'] = 'item'
+        _params.update(item)
+        data.append(_params)
     return data
 
 
 def push_google_analytics_for_payment(payment):
     """
-    получение массива строк гугл аналитики из данных платежа и отправка на сервер
+    получение массива строк гугл аналитики из данных платежа и постановка их в очередь
+    GoogleAnalyticsHit, которую отправляет на сервер команда flush_google_analytics
     """
     def _prepare_str(params):
         return urllib.urlencode({k: unicode(v).encode('utf-8') for k, v in params.iteritems()})
 
-    url = 'https://www.google-analytics.com/batch'
     metadata = json.loads(payment.metadata)
     data = metadata.get('google_analytics', [])
-    data = map(_prepare_str, data)
-    if data:
-        try:
-            requests.post(url, data=u'\n'.join(data), timeout=settings.CONNECTION_TIMEOUT)
-        except requests.RequestException as e:
-            if client:
-                client.captureMessage('Failed to send google analytics data', extra={
-                    'payment_id': payment.id,
-                    'exception': str(e),
-                })
-                logging.error('Failed to send google analytics data for payment %s: %s' % (payment.id, e))
+    GoogleAnalyticsHit.objects.bulk_create([
+        GoogleAnalyticsHit(payment_id=payment.id, data=_prepare_str(params)) for params in data
+    ])
+
+
+def send_google_analytics_hits(hits):
+    """
+    отправка пачки строк гугл аналитики (не больше GoogleAnalyticsHit.BATCH_SIZE) одним запросом,
+    отправленные строки удаляются, при ошибке строки отправляются повторно позже.
+    К каждой строке добавляется время в очереди (qt), чтобы гугл аналитика относила ее ко времени
+    оплаты, а не отправки. Строки старше GoogleAnalyticsHit.MAX_AGE не отправляются
+    """
+    now = timezone.now()
+    expired = [i for i in hits if i.get_age(now) >= GoogleAnalyticsHit.MAX_AGE]
+    for i in expired:
+        logging.error('Google analytics hit %s for payment %s expired' % (i.id, i.payment_id))
+        i.mark_failed('Expired', retry=False)
+    hits = [i for i in hits if i not in expired]
+    if not hits:
+        return False
+    url = getattr(settings, 'OPRO_PAYMENTS_GA_BATCH_URL', GA_BATCH_URL)
+    data = u'\n'.join(u'%s&qt=%d' % (i.data, i.get_age(now) * 1000) for i in hits)
+    try:
+        r = requests.post(url, data=data, timeout=settings.CONNECTION_TIMEOUT)
+        r.raise_for_status()
+    except requests.RequestException as e:
+        payment_ids = sorted(set(i.payment_id for i in hits))
+        if client:
+            client.captureMessage('Failed to send google analytics data', extra={
+                'payment_ids': payment_ids,
+                'exception': str(e),
+            })
+        logging.error('Failed to send google analytics data for payments %s: %s' % (payment_ids, e))
+        for i in hits:
+            i.mark_failed(str(e))
+        return False
+    GoogleAnalyticsHit.objects.filter(id__in=[i.id for i in hits]).delete()
+    return True
 
 
 def increase_promocode_usage(promocode, payment_id):
-    if promocode:
-        try:
-            obj = PromoCode.objects.get(code=promocode)
-            obj.used += 1
-            obj.save()
-        except ObjectDoesNotExist:
-            logging.error('Promocode %s wasn\'t found for payment %s' % (
-                promocode, payment_id
-            ))
+    """
+    Учет использования промокода в платеже. Использование записывается в PromoCodeUsage
+    с уникальным платежом, поэтому повторные вызовы для того же платежа (обновление страницы
+    статуса оплаты, повторное уведомление от яндекс-кассы) счетчик не меняют
+    """
+    if not promocode:
+        return
+    try:
+        with transaction.atomic():
+            PromoCodeUsage.objects.create(payment_id=payment_id, promocode=promocode)
+            updated = PromoCode.objects.filter(code=promocode).update(used=F('used') + 1)
+    except IntegrityError:
+        return
+    if not updated:
+        logging.error('Promocode %s wasn\'t found for payment %s' % (
+            promocode, payment_id
+        ))
+    else:
+        # счетчик использований входит в проверку промокода, update не отправляет post_save
+        invalidate_promocodes()
 
 payment_completed.disconnect(payment_for_participant_complete)
 payment_completed.connect(payment_for_user_complete)
+
+
+def read_emails(lines):
+    """
+    email-адреса из строк текста или csv-файла (первая колонка, строки без @ пропускаются)
+    """
+    emails = []
+    for line in lines:
+        if isinstance(line, str):
+            line = line.decode('utf-8')
+        email = line.replace(';', ',').split(',')[0].strip().strip('"').lower()
+        if '@' in email:
+            emails.append(email)
+    return list(OrderedDict.fromkeys(emails))
+
+
+def get_users_by_emails(emails):
+    """
+    :return: (список пользователей, список email, для которых пользователи не найдены)
+    """
+    users = list(User.objects.filter(email__in=emails))
+    found = set(u.email.lower() for u in users)
+    return users, [e for e in emails if e not in found]
@@ -1,26 +1,27 @@
 # coding: utf-8
 
+import hashlib
 import json
 import hmac
 import logging
-import re
 import traceback
 
 from django.conf import settings
 from django.shortcuts import get_object_or_404, render
 from django.contrib.auth.decorators import login_required
-from django.contrib.auth.models import AnonymousUser
-from django.http import Http404, JsonResponse, HttpResponseServerError, HttpResponseRedirect, HttpResponseBadRequest
+from django.http import Http404, HttpResponse, JsonResponse, HttpResponseServerError, HttpResponseRedirect, HttpResponseBadRequest
 from django.views.decorators.csrf import csrf_exempt
-from django.core.exceptions import ValidationError, ObjectDoesNotExist
+from django.views.decorators.http import condition
+from django.views.decorators.vary import vary_on_cookie
 from django.core.urlresolvers import reverse
 from django.core.validators import validate_email
+from django.db import transaction, IntegrityError
 from django.template.loader import get_template
 from django.utils.crypto import constant_time_compare
 from django.utils.html import mark_safe
+from django.utils.cache import patch_cache_control
 from django.utils.translation import ugettext as _
 
-import requests
 from decimal import Decimal
 
 from emails.django import Message
@@ -28,45 +29,44 @@ from rest_framework import status, permissions
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from payments.models import YandexPayment
-from plp.models import CourseSession, User, Course, EnrollmentReason, GiftPaymentInfo
+from plp.models import CourseSession, User, GiftPaymentInfo
 from plp.notifications.base import get_host_url
-from plp_edmodule.models import EducationalModule, EducationalModuleEnrollmentReason, PromoCode
+from plp_edmodule.models import EducationalModule
 from plp.utils.helpers import get_prefix_and_site
 from .forms import CorporatePaymentForm, GiftForm
-from .models import UpsaleLink, ObjectEnrollment, OuterPayment
-from .utils import (increase_promocode_usage, get_merchant_receipt, payment_for_user, client,
-        outer_payment_for_user, get_or_create_user, get_payment_urls, get_gift_payment_urls, 
-        get_object_info, get_obj_price, get_edmodule_price)
+from .models import OuterPayment
+from .sso import get_or_create_user, get_or_create_users
+from .checkout import CheckoutQuote, CheckoutQuoteError
+from .promocodes import check_promocode, NOT_FOUND
+from .db_router import read_from_replica
+from .offers import get_offer, offer_etag, offer_last_modified, OFFER_MAX_AGE
+from .ratelimit import rate_limit
+from .status_page import get_status_context
+from .utils import payment_for_user, get_payment_urls, get_gift_payment_urls
 
 PAYMENT_SESSION_KEY = 'opro_payment_current_order'
 
 def apply_promocode(promocode, product_id, product_type, session_id, only_first_course, request=None):
-    try:
-        obj = PromoCode.objects.get(code=promocode)
-    except ObjectDoesNotExist:
+    result = check_promocode(promocode, product_id, product_type, session_id, only_first_course)
+    if result == NOT_FOUND:
         return {
             'status': 1,
             'message': _(u'Промокод не найден')
         }
+    if result['status'] != 0:
+        return result
 
-    validation_result = obj.validate(int(product_id), product_type)
-    if validation_result['status'] != 0:
-        return validation_result
-
-    calculations = obj.calculate(product_id=product_id, session_id=session_id, only_first_course=only_first_course)
     if request:
-        request.session['promocode'] = {
+        entry = {
             'code': promocode,
-            'new_price' : "%.2f" % calculations['new_price'].quantize(Decimal('.00'))
+            'new_price' : "%.2f" % result['new_price'].quantize(Decimal('.00'))
         }
-    return calculations
-
-    return {
-        'status': 1,
-        'response': _(u'Что-то пошло не так')
-    }
+        # сессия сохраняется в бд только при изменении, повторная проверка того же промокода ее не трогает
+        if request.session.get('promocode') != entry:
+            request.session['promocode'] = entry
+    return result
 
+@rate_limit('promocode')
 def promocode(request):
     if request.method == 'POST' and request.is_ajax():
         promocode = request.POST.get('promocode', '').strip()
@@ -82,6 +82,7 @@ def promocode(request):
     else:
         raise Http404
 
+@rate_limit('landing_checkout')
 def landing_op_payment_view(request):
     """
     Страница подтверждения оплаты сессии или модуля при переходе с лэндинга
@@ -142,28 +143,22 @@ def landing_op_payment_view(request):
     # Сценарий оплаты с регистрацией пользователя с лэндинга
     if request.method == 'POST' and request.is_ajax() and request.POST.get('with_landing_user', ''):
         try:
+            quote = CheckoutQuote.from_request(request)
+            promocode_message = None
             if promocode: 
                 result = apply_promocode(promocode, module_id, 'edmodule' if module_id else 'course', session_id, only_first_course)
                 if result['status'] == 0:
-                    new_price = result['new_price']
-                    promocode_message = None
-                elif result['status'] != 0:
-                    new_price = None
+                    quote.apply_promo_price(result['new_price'])
+                else:
                     promocode_message = result['message']
-            else:
-                new_price = None
-                promocode_message = None
 
-            obj, verified_enrollment, upsales = get_object_info(request, session_id, module_id)
-
-            if not verified_enrollment:
+            if not quote.verified_enrollment:
                 raise Http404
                 
-            session, first_session_id, obj_price, total_price, products = get_obj_price(session_id, verified_enrollment, only_first_course, obj, upsales, new_price)
             user = get_or_create_user(first_name, email)
-            payment_urls = get_payment_urls(request, obj, user, session_id, utm_data) 
-            payment = payment_for_user(request, verified_enrollment, set(upsales), total_price,
-                                user=user, only_first_course=only_first_course, first_session_id=first_session_id, promocode=promocode)
+            payment_urls = get_payment_urls(request, quote.obj, user, session_id, utm_data) 
+            payment = payment_for_user(request, quote.verified_enrollment, set(quote.upsales), quote.total_price,
+                                user=user, only_first_course=only_first_course, first_session_id=quote.first_session_id, promocode=promocode)
 
             return JsonResponse({
                 'status': 0,
@@ -174,7 +169,7 @@ def landing_op_payment_view(request):
                 'shopFailURL': payment_urls['payment_fail'],
                 'shopSuccessURL': payment_urls['payment_success'],
                 'promocode_message': promocode_message,
-                'ym_merchant_receipt': get_merchant_receipt(user.email, products)
+                'ym_merchant_receipt': quote.merchant_receipt(user.email)
             })
         except Exception as e:
             return JsonResponse({
@@ -186,32 +181,22 @@ def landing_op_payment_view(request):
     Сценарий, когда имя и email пользователь вводи на странице OpenProfession
     """
 
-    obj, verified_enrollment, upsales = get_object_info(request, session_id, module_id)
+    quote = CheckoutQuote.from_request(request)
 
-    if not verified_enrollment:
+    if not quote.verified_enrollment:
         raise Http404
 
-    session, first_session_id, obj_price, total_price, products = get_obj_price(session_id, verified_enrollment, only_first_course, obj, upsales)
-
     # Сценарий оплаты с регистрацией пользователя с сайта OpenProfession
     if request.method == 'POST' and request.is_ajax():
         try:
             if 'promocode' in request.session:
-                new_price = Decimal(request.session['promocode']['new_price'])
-                session, first_session_id, obj_price, total_price, products = get_obj_price(
-                                                                                        session_id, 
-                                                                                        verified_enrollment, 
-                                                                                        only_first_course, 
-                                                                                        obj, 
-                                                                                        upsales, 
-                                                                                        new_price
-                                                                                    )
+                quote.apply_promo_price(Decimal(request.session['promocode']['new_price']))
 
             user = get_or_create_user(request.POST.get('firstname', ''), request.POST.get('email', ''))
-            payment_urls = get_payment_urls(request, obj, user, session_id, utm_data) 
+            payment_urls = get_payment_urls(request, quote.obj, user, session_id, utm_data) 
             
-            payment = payment_for_user(request, verified_enrollment, set(upsales), total_price,
-                             user=user, only_first_course=only_first_course, first_session_id=first_session_id, 
+            payment = payment_for_user(request, quote.verified_enrollment, set(quote.upsales), quote.total_price,
+                             user=user, only_first_course=only_first_course, first_session_id=quote.first_session_id, 
                              promocode=request.session.get('promocode', {}).get('code', None))
 
             if 'promocode' in request.session:
@@ -225,7 +210,7 @@ def landing_op_payment_view(request):
                 'cps_email': user.email,
                 'shopFailURL': payment_urls['payment_fail'],
                 'shopSuccessURL': payment_urls['payment_success'],
-                'ym_merchant_receipt': get_merchant_receipt(user.email, products)
+                'ym_merchant_receipt': quote.merchant_receipt(user.email)
             })
         except Exception as e:
             return JsonResponse({
@@ -233,13 +218,19 @@ def landing_op_payment_view(request):
                 'traceback': str(traceback.format_exc())
                 })
 
+    try:
+        total_price = quote.total_price
+    except CheckoutQuoteError:
+        return HttpResponseServerError()
+
+    obj = quote.obj
     context = {
-        'upsale_links': upsales,
+        'upsale_links': quote.upsales,
         'total_price': total_price,
-        'obj_price': obj_price,
+        'obj_price': quote.obj_price,
         'object': obj.course if isinstance(obj, CourseSession) else obj,
-        'first_session': session,
-        'verified': verified_enrollment,
+        'first_session': quote.first_session,
+        'verified': quote.verified_enrollment,
         'landing': True,
         'contented': contented,
         'with_landing_user': with_landing_user,
@@ -253,6 +244,7 @@ def landing_op_payment_view(request):
         context['module'] = obj
     return render(request, 'opro_payments/landing_op_payment.html', context)
 
+@read_from_replica
 def landing_op_payment_status(request, payment_type, obj_id, user_id, status):
     """
     страница payment success/fail, на которую редиректится пользователь после
@@ -266,53 +258,14 @@ def landing_op_payment_status(request, payment_type, obj_id, user_id, status):
     obj = get_object_or_404(obj_model, id=obj_id)
     user = get_object_or_404(User, id=user_id)
 
-    if payment_type == 'session':
-        context = {'session': obj, 'object': obj.course}
-    else:
-        context = {'module': obj, 'object': obj}
-
+    context = get_status_context(payment_type, obj, user, status)
     if status == 'success':
-        if payment_type == 'session':
-            order_number = "{}-{}-{}-".format('verified', obj.id, user.id)
-        else:
-            order_number = "edmodule-{}-{}-".format(obj.id, user.id)
-        # считаем, что к моменту перехода на страницу подтверждения оплаты, нам пришел ответ от Яндекса
-        # и были созданы "записи на объекты", иначе пользователь не увидит промокоды
-        payment = YandexPayment.objects.filter(order_number__startswith=order_number).order_by('-id').first()
-        if not payment:
-            raise Http404
-        if not payment.is_payed:
-            logging.error('User %s was redirected to successfull payment page before payment %s was processed' % (
-                user.id, payment.id
-            ))
-            if client:
-                client.captureMessage('User was redirected to successfull payment page before payment was processed',
-                                      extra={'user_id': user.id, 'payment_id': payment.id})
-        metadata = json.loads(payment.metadata or '{}')
-        upsale_links = metadata.get('upsale_links', [])
-        upsales = UpsaleLink.objects.filter(id__in=upsale_links)
-        object_enrollments = ObjectEnrollment.objects.filter(user=user, upsale__id__in=upsale_links)
-        promocodes = []
-        for obj in object_enrollments:
-            data = obj.jsonfield or {}
-            promo = data.get('promo_code')
-            if promo:
-                promocodes.append((obj.upsale.upsale.title, promo))
-        context.update({
-            'promocodes': promocodes,
-            'upsale_links': upsales,
-            'shop_url': getattr(settings, 'OPRO_PAYMENT_SHOP_URL', ''),
-        })
-        if metadata.get('edmodule', {}).get('first_session_id'):
-            context['first_session'] = get_object_or_404(CourseSession, id=metadata['edmodule']['first_session_id'])
-        
-        increase_promocode_usage(metadata.get('promocode', None), payment.id)
-
         context['landing'] = True
         context['landing_username'] = user.first_name
 
     return render(request, template_path, context)  
 
+@rate_limit('gift_checkout')
 def gift_op_payment_view(request):
 
     session_id = request.GET.get('course_session_id', '')
@@ -342,23 +295,31 @@ def gift_op_payment_view(request):
         "ym_merchant_receipt":""
     }
 
-    obj, verified_enrollment, upsales = get_object_info(request, session_id, module_id)
+    quote = CheckoutQuote.from_request(request)
 
-    if not verified_enrollment:
+    if not quote.verified_enrollment:
         raise Http404
 
     if request.method == 'POST' and request.is_ajax():
         try:
             gift_form = GiftForm(request.POST)
             if gift_form.is_valid():
-                session, first_session_id, obj_price, total_price, products = get_obj_price(session_id, verified_enrollment, only_first_course, obj, upsales)
-                gift_sender = get_or_create_user(gift_form.cleaned_data['gift_sender'], gift_form.cleaned_data['gift_sender_email'])
-                gift_receiver = get_or_create_user(gift_form.cleaned_data['gift_receiver'], gift_form.cleaned_data['gift_receiver_email'], lazy_send_mail=True)
-                payment_urls = get_gift_payment_urls(request, obj, gift_sender, session_id, utm_data)             
-                payment = payment_for_user(request, verified_enrollment, set(upsales), total_price,
+                gift_sender, gift_receiver = get_or_create_users([
+                    {
+                        'first_name': gift_form.cleaned_data['gift_sender'],
+                        'email': gift_form.cleaned_data['gift_sender_email'],
+                    },
+                    {
+                        'first_name': gift_form.cleaned_data['gift_receiver'],
+                        'email': gift_form.cleaned_data['gift_receiver_email'],
+                        'lazy_send_mail': True,
+                    },
+                ])
+                payment_urls = get_gift_payment_urls(request, quote.obj, gift_sender, session_id, utm_data)             
+                payment = payment_for_user(request, quote.verified_enrollment, set(quote.upsales), quote.total_price,
                                 user=gift_sender, 
                                 only_first_course=only_first_course, 
-                                first_session_id=first_session_id,
+                                first_session_id=quote.first_session_id,
                                 gift_receiver=gift_receiver)
 
                 gift_payment_info = GiftPaymentInfo(
@@ -382,7 +343,7 @@ def gift_op_payment_view(request):
                     'cps_email': gift_sender.email,
                     'shopFailURL': payment_urls['payment_fail'],
                     'shopSuccessURL': payment_urls['payment_success'],
-                    'ym_merchant_receipt': get_merchant_receipt(gift_sender.email, products)
+                    'ym_merchant_receipt': quote.merchant_receipt(gift_sender.email)
                 })
             else:
                 return HttpResponseBadRequest()
@@ -402,6 +363,7 @@ def gift_op_payment_view(request):
 
     return render(request, 'opro_payments/gift_op_payment.html', context)
 
+@read_from_replica
 def gift_op_payment_status(request, payment_type, obj_id, user_id, status):
     """
     страница payment success/fail, на которую редиректится пользователь после
@@ -415,63 +377,15 @@ def gift_op_payment_status(request, payment_type, obj_id, user_id, status):
     obj = get_object_or_404(obj_model, id=obj_id)
     user = get_object_or_404(User, id=user_id)
 
-    if payment_type == 'session':
-        context = {'session': obj, 'object': obj.course}
-    else:
-        context = {'module': obj, 'object': obj}
-
+    context = get_status_context(payment_type, obj, user, status)
     if status == 'success':
-        if payment_type == 'session':
-            order_number = "{}-{}-{}-".format('verified', obj.id, user.id)
-        else:
-            order_number = "edmodule-{}-{}-".format(obj.id, user.id)
-        # считаем, что к моменту перехода на страницу подтверждения оплаты, нам пришел ответ от Яндекса
-        # и были созданы "записи на объекты", иначе пользователь не увидит промокоды
-        payment = YandexPayment.objects.filter(order_number__startswith=order_number).order_by('-id').first()
-        if not payment:
-            raise Http404
-        if not payment.is_payed:
-            logging.error('User %s was redirected to successfull payment page before payment %s was processed' % (
-                user.id, payment.id
-            ))
-            if client:
-                client.captureMessage('User was redirected to successfull payment page before payment was processed',
-                                      extra={'user_id': user.id, 'payment_id': payment.id})
-        metadata = json.loads(payment.metadata or '{}')
-        upsale_links = metadata.get('upsale_links', [])
-        upsales = UpsaleLink.objects.filter(id__in=upsale_links)
-        object_enrollments = ObjectEnrollment.objects.filter(user=user, upsale__id__in=upsale_links)
-        promocodes = []
-        for obj in object_enrollments:
-            data = obj.jsonfield or {}
-            promo = data.get('promo_code')
-            if promo:
-                promocodes.append((obj.upsale.upsale.title, promo))
-        context.update({
-            'promocodes': promocodes,
-            'upsale_links': upsales,
-            'shop_url': getattr(settings, 'OPRO_PAYMENT_SHOP_URL', ''),
-        })
-        if metadata.get('edmodule', {}).get('first_session_id'):
-            context['first_session'] = get_object_or_404(CourseSession, id=metadata['edmodule']['first_session_id'])
-
-        promocode = metadata.get('promocode', None)
-        if promocode:
-            try:
-                promocode_object = PromoCode.objects.get(code=promocode)
-                promocode_object.used += 1
-                promocode_object.save()
-            except ObjectDoesNotExist:
-                logging.error('Promocode %s wasn\'t found for payment %s' % (
-                    promocode, payment.id
-                ))
-
         context['landing'] = True
         context['landing_username'] = user.first_name
 
     return render(request, template_path, context)
 
 @login_required
+@read_from_replica
 def op_payment_view(request):
     """
     Страница подтверждения оплаты сессии или модуля
@@ -486,92 +400,29 @@ def op_payment_view(request):
     if (session_id and not session_id.isdigit()) or (module_id and not module_id.isdigit()):
         raise Http404
 
-    obj_model = CourseSession if session_id else EducationalModule
-    obj_id = session_id or module_id
-    obj = get_object_or_404(obj_model, id=obj_id)
-    verified_enrollment = obj.get_verified_mode_enrollment_type()
+    quote = CheckoutQuote.from_request(request, user=request.user)
+    obj = quote.obj
+    verified_enrollment = quote.verified_enrollment
     if not verified_enrollment:
         raise Http404
-    upsale_link_ids = [i for i in request.GET.getlist('upsale_link_ids') if i.isdigit()]
-    upsale_links = UpsaleLink.objects.filter(id__in=upsale_link_ids, is_active=True)
-    upsales = []
-    for upsale in upsale_links:
-        s = upsale.content_object
-        if s and isinstance(s, obj_model) and s.id == obj.id:
-            upsales.append(upsale)
-
-    obj_is_paid = False
-    paid_upsales = [i.upsale for i in
-                    ObjectEnrollment.objects.filter(upsale__in=upsales, user=request.user).select_related('upsale')]
-
-    first_session_id = None
-    session = None
-    products = []
-    if session_id:
-        if verified_enrollment.is_user_enrolled(request.user):
-            obj_is_paid = True
-        obj_price = verified_enrollment.price
-        if not obj_is_paid:
-            products.append({ 
-                'title': verified_enrollment.session.course.title, 
-                'price': obj_price 
-            })
-    else:
-        obj_is_paid = EducationalModuleEnrollmentReason.objects.filter(
-            enrollment__user=request.user,
-            enrollment__module__id=module_id,
-            full_paid=not only_first_course
-        ).exists()
-        if only_first_course:
-            try:
-                session, price = obj.get_first_session_to_buy(request.user)
-                obj_price = price
-                first_session_id = session.id
-                products.append({
-                    'title': session.course.title,
-                    'price': obj_price 
-                })
-            except TypeError:
-                if obj_is_paid:
-                    first_session_id = None
-                    obj_price = 0
-                else:
-                    return HttpResponseServerError()
-        else:
-            obj_price = get_edmodule_price(obj)
-            products.append({
-                'title': obj.title, 
-                'price': obj_price 
-            })
 
-    if obj_is_paid and len(upsales) == len(paid_upsales):
+    if quote.obj_is_paid and len(quote.upsales) == len(quote.paid_upsales):
         return HttpResponseRedirect(reverse('frontpage'))
 
-    total_price = 0 if obj_is_paid else obj_price
-
-    upsales_price = 0
-    for i in upsales:
-        if i not in paid_upsales:
-            upsale_price = i.get_payment_price()
-            upsales_price += upsale_price
-            products.append({
-                'title': i.upsale.title,
-                'price': upsale_price
-            })
-
-    total_price += upsales_price
+    try:
+        total_price = quote.total_price
+    except CheckoutQuoteError:
+        return HttpResponseServerError()
 
     if request.method == 'POST' and request.is_ajax():
         # действительно создаем платеж только перед отправкой
         try:
             if 'promocode' in request.session:
-                new_price = Decimal(request.session['promocode']['new_price'])
-                total_price = 0 if obj_is_paid else float(new_price)
-                total_price += upsales_price
+                quote.apply_promo_price(Decimal(request.session['promocode']['new_price']))
 
             order_number = request.session.get(PAYMENT_SESSION_KEY)
-            payment_for_user(request, verified_enrollment, set(upsales) - set(paid_upsales), total_price,
-                             only_first_course=only_first_course, first_session_id=first_session_id, order_number=order_number, promocode=request.session.get('promocode', {}).get('code', None))
+            payment_for_user(request, verified_enrollment, set(quote.upsales_to_buy), quote.total_price,
+                             only_first_course=only_first_course, first_session_id=quote.first_session_id, order_number=order_number, promocode=request.session.get('promocode', {}).get('code', None))
             
             if 'promocode' in request.session:
                 del request.session['promocode']
@@ -585,8 +436,8 @@ def op_payment_view(request):
                 'traceback': str(traceback.format_exc())
                 })
 
-    payment = payment_for_user(request, verified_enrollment, set(upsales) - set(paid_upsales), total_price, create=False,
-                               only_first_course=only_first_course, first_session_id=first_session_id)
+    payment = payment_for_user(request, verified_enrollment, set(quote.upsales_to_buy), total_price, create=False,
+                               only_first_course=only_first_course, first_session_id=quote.first_session_id)
     request.session[PAYMENT_SESSION_KEY] = payment.order_number
     host_url = get_host_url(request)
     payment_fail = host_url + reverse('op_payment_status', kwargs={
@@ -605,13 +456,13 @@ def op_payment_view(request):
         payment_success = '{}?{}'.format(payment_success, utm_data)
 
     context = {
-        'upsale_links': upsales,
+        'upsale_links': quote.upsales,
         'total_price': total_price,
-        'obj_price': obj_price,
-        'obj_is_paid': obj_is_paid,
-        'paid_upsales': paid_upsales,
+        'obj_price': quote.obj_price,
+        'obj_is_paid': quote.obj_is_paid,
+        'paid_upsales': quote.paid_upsales,
         'object': obj.course if isinstance(obj, CourseSession) else obj,
-        'first_session': session,
+        'first_session': quote.first_session,
         'verified': verified_enrollment,
         'fields': {
             "shopId": settings.YANDEX_MONEY_SHOP_ID,
@@ -623,7 +474,7 @@ def op_payment_view(request):
             "cps_phone": "",
             "shopFailURL": payment_fail,
             "shopSuccessURL": payment_success,
-            "ym_merchant_receipt": json.dumps(get_merchant_receipt(request.user.email, products), ensure_ascii=False)
+            "ym_merchant_receipt": json.dumps(quote.merchant_receipt(request.user.email), ensure_ascii=False)
         },
         'shop_url': settings.YANDEX_MONEY_SHOP_URL,
     }
@@ -636,6 +487,7 @@ def op_payment_view(request):
 
 @csrf_exempt
 @login_required
+@read_from_replica
 def op_payment_status(request, payment_type, obj_id, user_id, status):
     """
     страница payment success/fail, на которую редиректится пользователь после
@@ -652,48 +504,7 @@ def op_payment_status(request, payment_type, obj_id, user_id, status):
     obj = get_object_or_404(obj_model, id=obj_id)
     user = request.user
 
-    if payment_type == 'session':
-        context = {'session': obj, 'object': obj.course}
-    else:
-        context = {'module': obj, 'object': obj}
-
-    if status == 'success':
-        if payment_type == 'session':
-            order_number = "{}-{}-{}-".format('verified', obj.id, user.id)
-        else:
-            order_number = "edmodule-{}-{}-".format(obj.id, user.id)
-        # считаем, что к моменту перехода на страницу подтверждения оплаты, нам пришел ответ от Яндекса
-        # и были созданы "записи на объекты", иначе пользователь не увидит промокоды
-        payment = YandexPayment.objects.filter(order_number__startswith=order_number).order_by('-id').first()
-        if not payment:
-            raise Http404
-        if not payment.is_payed:
-            logging.error('User %s was redirected to successfull payment page before payment %s was processed' % (
-                user.id, payment.id
-            ))
-            if client:
-                client.captureMessage('User was redirected to successfull payment page before payment was processed',
-                                      extra={'user_id': user.id, 'payment_id': payment.id})
-        metadata = json.loads(payment.metadata or '{}')
-        upsale_links = metadata.get('upsale_links', [])
-        upsales = UpsaleLink.objects.filter(id__in=upsale_links)
-        object_enrollments = ObjectEnrollment.objects.filter(user=user, upsale__id__in=upsale_links)
-        promocodes = []
-        for obj in object_enrollments:
-            data = obj.jsonfield or {}
-            promo = data.get('promo_code')
-            if promo:
-                promocodes.append((obj.upsale.upsale.title, promo))
-        context.update({
-            'promocodes': promocodes,
-            'upsale_links': upsales,
-            'shop_url': getattr(settings, 'OPRO_PAYMENT_SHOP_URL', ''),
-        })
-        if metadata.get('edmodule', {}).get('first_session_id'):
-            context['first_session'] = get_object_or_404(CourseSession, id=metadata['edmodule']['first_session_id'])
-
-        increase_promocode_usage(metadata.get('promocode', None), payment.id)
-
+    context = get_status_context(payment_type, obj, user, status)
     return render(request, template_path, context)
 
 
@@ -750,10 +561,6 @@ def corporate_order_view(request, order_type, obj_id):
     return render(request, 'opro_payments/corporate_order.html', context)
 
 
-class EnrollmentApiViewException(Exception):
-    pass
-
-
 class EnrollmentApiPermission(permissions.BasePermission):
     """
     Проверка подлинности запроса оплаты по лендингу:
@@ -768,242 +575,68 @@ class EnrollmentApiPermission(permissions.BasePermission):
 class EnrollmentApiView(APIView):
     """
     view обработки записи на курсы/специализации с лендинга.
+    Запрос сохраняется как OuterPayment и сразу подтверждается, запись выполняет
+    команда process_outer_payments (см. opro_payments.outer_payments).
+    На повторную доставку того же заказа отвечаем по результату обработки первой
     """
-    DEBUG_EMAIL_TO = getattr(settings, 'ENROLLMENT_API_DEBUG_EMAIL', 'debug@openprofession.ru')
     permission_classes = (EnrollmentApiPermission, )
+    STATUS_RESPONSES = {
+        OuterPayment.STATUS.done: status.HTTP_200_OK,
+        OuterPayment.STATUS.failed: status.HTTP_400_BAD_REQUEST,
+    }
 
     def post(self, request):
-        outer_payment = OuterPayment.objects.create(data=request.data)
-        sku, email = '', ''
-        warnings = []
-        new_user_created = False
-        # при возникновении исключений EnrollmentApiViewException на этом шаге запись на
-        # курс/специализацию/апсейл не происходит
-        try:
-            email = request.data.get('order', {}).get('customer', {}).get('email')
-            if not email:
-                raise EnrollmentApiViewException(u'Данные не содержат email')
-            sku = request.data.get('order', {}).get('line_items', [])
-            if len(sku) != 1:
-                raise EnrollmentApiViewException(_(u'Ожидается 1 элемент в line_items, пришло %s') % len(sku))
-            elif not sku[0].get('sku'):
-                raise EnrollmentApiViewException(u'Данные не содержат sku')
-            # разделитель +
-            sku = sku[0]['sku']
-            sku_parts = self.parse_sku(sku)
+        order_id = request.data.get('order', {}).get('id')
+        order_id = order_id and unicode(order_id)
+        body_digest = hashlib.sha256(request.stream.body).hexdigest()
+        outer_payment = OuterPayment.objects.get_delivered(order_id, body_digest)
+        if not outer_payment:
             try:
-                validate_email(email)
-            except ValidationError:
-                raise EnrollmentApiViewException(u'Задан невалидный емейл %s' % email)
-            user = User.objects.filter(email=email).first()
-            obj, upsales, log = self.items_to_buy(sku_parts, user)
-            warnings.extend(log)
-            if not user:
-                user = self.create_user(email)
-                new_user_created = True
-        except EnrollmentApiViewException as e:
-            logging.error(u'outer payment %s error: %s' % (outer_payment.id, e))
-            if client:
-                client.captureMessage('outer payment error', extra={
-                    'exception': u'%s' % e,
-                    'request_data': request.data,
-                })
-            self.send_debug_mail(error=u'%s' % e, sku=sku, email=email, outer_payment=outer_payment)
-            return Response(status=status.HTTP_400_BAD_REQUEST)
-
-        # далее записываем пользователя на те объекты из sku, на которые он не был записан
-        if not new_user_created:
-            warnings.extend(self.check_items_for_user(user, sku_parts, obj, upsales))
-        new_mode = obj.get_verified_mode_enrollment_type()
-        mode_data = {'id': new_mode.id, 'mode': new_mode.mode}
-        if sku_parts['type'] == 'edmodule':
-            mode_data['only_first_course'] = sku_parts['only_first_course']
-            if sku_parts['only_first_course']:
-                mode_data['first_session_id'] = sku_parts['first_session_id']
-        outer_payment_for_user(user, sku_parts, mode_data, upsales)
-        self.send_debug_mail(warnings=warnings, sku=sku, email=email, outer_payment=outer_payment)
-        return Response(status=status.HTTP_200_OK)
-
-    def send_debug_mail(self, **kwargs):
-        msg = Message(
-            subject=get_template('opro_payments/emails/outer_payment_debug_subject.txt'),
-            html=get_template('opro_payments/emails/outer_payment_debug_message.html'),
-            mail_from=settings.EMAIL_NOTIFICATIONS_FROM,
-            mail_to=self.DEBUG_EMAIL_TO
-        )
-        try:
-            msg.send(context={'context': kwargs, 'request': self.request})
-        except Exception as e:
-            logging.error('Failed to send outer payment debug email: %s' % e)
-            if client:
-                client.captureMessage('Failed to send outer payment debug email', extra={
-                    'exception': str(e),
-                    'email_context': kwargs,
-                })
-
-    def create_user(self, email):
-        post_data = {'emails': [email]}
-        request_url = '{}/users/simple_mass_registration/'.format(settings.SSO_NPOED_URL)
-        try:
-            logging.info('Request %s with data=%s' % (request_url, post_data))
-            r = requests.post(
-                request_url,
-                json=post_data,
-                headers={'X-SSO-Api-Key': settings.SSO_API_KEY},
-                timeout=settings.CONNECTION_TIMEOUT
-            )
-            assert r.status_code == 200, 'SSO status code %s' % r.status_code
-            sso_data = r.json().get('users', [])
-            assert len(sso_data) == 1 and 'username' in sso_data[0], 'SSO returned %s' % sso_data
-            return User.objects.get(username=sso_data[0]['username'])
-        except (requests.RequestException, AssertionError, ValueError, User.DoesNotExist) as exc:
-            error_dict = {'data': post_data, 'exception': str(exc)}
-            if client:
-                client.captureMessage('error creating user', extra=error_dict)
-            logging.error('error creating user: data={data}, exception: {exception}'.format(**error_dict))
-            raise EnrollmentApiViewException(u'Не удалось создать пользователя %s: %s' % (email, str(exc)))
-
-    def parse_sku(self, sku):
-        parts = sku.split('+')
-        result = {}
-        if len(parts) < 3:
-            raise EnrollmentApiViewException(
-                u'Получен некорректный sku %s, sku должен состоять как минимум из 3 частей' % sku)
-        if parts[0] == 'course':
-            result.update({
-                'type': 'course',
-                'slug': parts[2],
-                'uni_slug': parts[1],
-            })
-        elif parts[0] == 'edmodule':
-            if parts[2] not in ['all', 'one']:
-                raise EnrollmentApiViewException(
-                    u'Получен некорректный sku %s, 3 часть sku при записи на специализацию должна быть all или one'
-                    % sku)
-            only_first_course = parts[2] == 'one'
-            result.update({
-                'type': 'edmodule',
-                'slug': parts[1],
-                'only_first_course': only_first_course,
-            })
-        else:
-            raise EnrollmentApiViewException(
-                u'Получен некорректный sku %s, 1 часть sku должна быть course или edmodule' % sku)
-        upsale_ids = []
-        for p in parts[3:]:
-            upsale_id = re.match(r'^upsalelink(\d+)$', p)
-            if not upsale_id:
-                raise EnrollmentApiViewException(u'Получен некорректный sku %s, не удалось распарсить апсейлы' % sku)
-            upsale_ids.append(int(upsale_id.group(1)))
-        result['upsales'] = upsale_ids
-        return result
-
-    def check_items_for_user(self, user, sku_parts, obj, upsales):
-        """
-        проверка наличия у пользователя уже оплаченных курсов/апсейлов/специализаций
-        """
-        log = []
-        if sku_parts['type'] == 'course':
-            has_paid = EnrollmentReason.objects.filter(
-                participant__user=user,
-                participant__session=obj,
-                session_enrollment_type__mode='verified'
-            ).exists()
-            if has_paid:
-                log.append(_(u'Пользователь %s уже оплачивал курс %s') % (user.email, obj.get_absolute_slug_v1()))
-                logging.error('EnrollmentApiView: user %s already paid for course %s' %
-                              (user, obj.get_absolute_slug_v1()))
-        elif sku_parts['type'] == 'edmodule':
-            has_paid = obj.get_enrollment_reason_for_user(user)
-            if has_paid:
-                log.append(_(u'Пользователь %s уже оплачивал специализацию %s') % (user.email, obj.code))
-                logging.error('EnrollmentApiView: user %s already paid for edmodule %s' % (user, obj.code))
-
-        paid_upsales = ObjectEnrollment.objects.filter(
-            user=user,
-            upsale__id__in=upsales
-        ).values_list('upsale_id', flat=True)
-        if paid_upsales:
-            log.append(_(u'Пользователь уже оплачивал апсейл(ы): %s') %
-                       ', '.join(map(lambda x: str(x), paid_upsales)))
-            logging.error('EnrollmentApiView: user %s already paid for upsales %s'
-                          % (user, ', '.join(map(lambda x: str(x), paid_upsales))))
-        return log
-
-    def items_to_buy(self, sku, user):
-        """
-        выбор объектов для покупки
-        """
-        if sku['type'] == 'course':
-            try:
-                course = Course.objects.get(slug=sku['slug'], university__slug=sku['uni_slug'])
-                obj = course.next_session
-            except Course.DoesNotExist:
-                raise EnrollmentApiViewException(u'курс %(uni_slug)s+%(slug)s не найден' % sku)
-            else:
-                if not obj:
-                    raise EnrollmentApiViewException(u'курс %s не имеет открытых сессий' % course)
-                if not obj.get_verified_mode_enrollment_type():
-                    raise EnrollmentApiViewException(u'у сессии %s нет платного варианта записи' % obj)
-                if obj.allow_enrollments():
-                    raise EnrollmentApiViewException(u'сессия %s не доступна для записи' % obj)
-        else:
-            try:
-                obj = EducationalModule.objects.get(code=sku['slug'])
-            except EducationalModule.DoesNotExist:
-                raise EnrollmentApiViewException(u'модуль %(slug)s не найден' % sku)
-            if not obj.get_verified_mode_enrollment_type():
-                raise EnrollmentApiViewException(u'у модуля %s нет платного варианта записи' % obj)
-            if sku['only_first_course']:
-                if not user:
-                    user = AnonymousUser()
-                else:
-                    reason = obj.get_enrollment_reason_for_user(user)
-                    if reason:
-                        if reason.full_paid:
-                            msg = _(u'Пользователь %s уже оплачивал полностью специализацию %s') % \
-                                (user.email, obj.code)
-                        else:
-                            msg = _(u'Пользователь %s уже оплачивал частично специализацию %s') % \
-                                (user.email, obj.code)
-                        raise EnrollmentApiViewException(msg)
-                first_session = obj.get_first_session_to_buy(user)
-                if not first_session:
-                    if user.is_authenticated():
-                        raise EnrollmentApiViewException(
-                            _(u'не удалось выбрать курс для частичной оплаты специализации %s для пользователя %s') %
-                            (obj.code, user.username)
-                        )
-                    else:
-                        raise EnrollmentApiViewException(
-                            _(u'не удалось выбрать курс для частичной оплаты специализации %s') %
-                            obj.code
-                        )
-                sku['first_session_id'] = first_session[0].id
-        upsales = UpsaleLink.objects.filter(id__in=sku['upsales'])
-        log, available_upsales = [], []
-        for u in upsales:
-            if not u.is_active:
-                log.append(_(u'Аспейл #%s не активен') % u.id)
-            elif u.content_object != obj:
-                log.append(_(u'Аспейл #%s не относится к выбранному объекту %s') % (u.id, obj))
-            else:
-                available_upsales.append(u.id)
-        not_found_upsales = set([long(i) for i in sku['upsales']]) - set([i.id for i in upsales])
-        if not_found_upsales:
-            log.append(_(u'Апсейлы со следующими id не найдены: %s') %
-                       ', '.join(map(lambda x: str(x), not_found_upsales)))
-        return obj, available_upsales, log
-
-
+                with transaction.atomic():
+                    OuterPayment.objects.create(data=request.data, order_id=order_id, body_digest=body_digest)
+                return Response(status=status.HTTP_202_ACCEPTED)
+            except IntegrityError:
+                outer_payment = OuterPayment.objects.get_delivered(order_id, body_digest)
+        logging.info('Duplicate outer payment delivery for payment %s, order %s' % (outer_payment.id, order_id))
+        return Response(status=self.STATUS_RESPONSES.get(outer_payment.status, status.HTTP_202_ACCEPTED))
+
+
+@vary_on_cookie
+@condition(etag_func=offer_etag, last_modified_func=offer_last_modified)
+@read_from_replica
 def offer_text_view(request, offer_type=None, obj_id=None):
     """
-    Просмотр текста оферты курса/образовательного модуля
+    Просмотр текста оферты курса/образовательного модуля.
+    Текст и etag берутся из кэша, повторный запрос с If-None-Match/If-Modified-Since получает 304
+    без обращения к записям оферты. Etag учитывает пользователя, а ответы (включая 304) отдаются
+    с Vary: Cookie, поэтому после входа на сайт не показывается закэшированная анонимная страница.
+    Обрамление страницы зависит от запроса (csrf, сообщения, сессия) и рендерится каждый раз
     """
-    model = Course if offer_type == 'course' else EducationalModule
-    obj = get_object_or_404(model, id=obj_id)
+    offer = get_offer(offer_type, obj_id)
+    if not offer['found']:
+        raise Http404
     ctx = {
         'title': _(u'Оферта'),
-        'content': mark_safe(obj.offer_text),
+        'content': mark_safe(offer['content']),
     }
-    return render(request, 'flatpages/default.html', {'flatpage': ctx})
+    response = render(request, 'flatpages/default.html', {'flatpage': ctx})
+    # персонализированную страницу авторизованного пользователя не должны кэшировать CDN.
+    # patch_cache_control выводит и значения False, поэтому передается только нужная директива
+    if request.user.is_authenticated():
+        patch_cache_control(response, private=True, max_age=OFFER_MAX_AGE)
+    else:
+        patch_cache_control(response, public=True, max_age=OFFER_MAX_AGE)
+    return response
+
+
+@csrf_exempt
+def ga_batch_stub_view(request):
+    """
+    Заглушка /batch гугл аналитики для локальной разработки и тестов
+    (settings.OPRO_PAYMENTS_GA_BATCH_URL), подключается только при DEBUG
+    """
+    if request.method != 'POST':
+        raise Http404
+    hits = [i for i in request.body.splitlines() if i]
+    logging.info('Google analytics stub received %s hits' % len(hits))
+    return HttpResponse(status=200)
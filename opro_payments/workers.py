@@ -0,0 +1,89 @@
+# coding: utf-8
+
+import logging
+import threading
+import traceback
+from django.db import connection
+
+
+class PermanentError(Exception):
+    """
+    ошибка обработки, после которой повторять попытку бессмысленно
+    """
+
+
+def process_item(item, func):
+    """
+    Обработка одной записи очереди (QueueItem): при исключении запись
+    отправляется на повторную попытку с текстом ошибки, при PermanentError -
+    отмечается как необработанная
+    """
+    try:
+        func(item)
+    except PermanentError as e:
+        logging.error(u'Failed to process %s #%s: %s' % (item._meta.model_name, item.id, e))
+        item.mark_failed(u'%s' % e, retry=False)
+        return False
+    except Exception:
+        error = traceback.format_exc()
+        logging.error('Failed to process %s #%s: %s' % (item._meta.model_name, item.id, error))
+        item.mark_failed(error)
+        return False
+    item.mark_done()
+    return True
+
+
+def run_workers(manager, func, workers=1, batch_size=10, lease=600, once=False, idle_sleep=5, batch=False,
+                ready=None):
+    """
+    Пул потоков, разбирающих очередь manager (QueueItemManager). Каждый поток захватывает
+    batch_size записей и вызывает для каждой func(item).
+    :param once: bool - завершить работу, когда очередь опустеет
+    :param idle_sleep: int - пауза в секундах при пустой очереди
+    :param batch: bool - вызывать func(items) для всей захваченной пачки, func сама отмечает
+        результат обработки записей
+    :param ready: функция без аргументов - можно ли захватывать записи, пока она возвращает False,
+        поток ждет idle_sleep секунд (например, пока не накопится полная пачка). При once не используется
+    """
+    stop = threading.Event()
+
+    def worker():
+        try:
+            while not stop.is_set():
+                if ready and not once and not ready():
+                    stop.wait(idle_sleep)
+                    continue
+                items = manager.claim(limit=batch_size, lease=lease)
+                if not items:
+                    if once:
+                        break
+                    stop.wait(idle_sleep)
+                    continue
+                if batch:
+                    try:
+                        func(items)
+                    except Exception:
+                        error = traceback.format_exc()
+                        logging.error('Failed to process %s batch: %s' % (manager.model._meta.model_name, error))
+                        for item in items:
+                            item.mark_failed(error)
+                    continue
+                for item in items:
+                    if stop.is_set():
+                        break
+                    process_item(item, func)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=worker, name='opro-worker-%s' % i) for i in range(workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        while any(t.is_alive() for t in threads):
+            for t in threads:
+                t.join(1)
+    except KeyboardInterrupt:
+        stop.set()
+        for t in threads:
+            t.join()